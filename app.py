@@ -1,18 +1,28 @@
 """
-Flask App - Chatbot học tập với Pinecone Vector Store
+Flask App - Chatbot học tập với Pinecone Vector Store (hoặc local, xem VECTOR_BACKEND)
 """
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import os
+import json
 from src.helper import (
     load_all_pdfs,
     split_text_into_chunks,
     create_embeddings,
     create_chatbot,
-    ask_question
+    load_vector_store,
+    ask_question,
+    stream_question,
+    get_index_version,
+    open_keyword_index,
+    prompt_usage_stats,
+    condense_stats,
+    VECTOR_BACKEND,
+    MEMORY_WINDOW
 )
-from src.prompt import prompt_template, welcome_message
-from langchain_pinecone import PineconeVectorStore
+from src.prompt import question_prompt, system_prompt, welcome_message
+from src.cache import CACHE_DIR, ResponseCache, SemanticAnswerCache
+from src.sessions import SessionStore
 
 app = Flask(__name__)
 
@@ -20,22 +30,55 @@ app = Flask(__name__)
 qa_chain = None
 vector_store = None
 embeddings = None
+answer_cache = None
+response_cache = None
+keyword_index = None
 INDEX_NAME = "studychatbot"
 
+# "hybrid" = MMR + BM25 (cần BM25 index do upload_to_pinecone.py build), "mmr", "similarity"
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+
+# Cache khớp chính xác (câu hỏi đã chuẩn hóa): tra trước, không cần embedding
+RESPONSE_CACHE_SIZE = 2000
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "true").lower() == "true"
+
+# Cache câu trả lời theo ngữ nghĩa: câu hỏi diễn đạt khác nhưng cùng ý → trả lời ngay
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_SIZE = 1000
+SEMANTIC_CACHE_TTL = 24 * 3600  # giây
+
+# Lịch sử hội thoại theo session (client gửi session_id): giới hạn số session
+# và thời gian không hoạt động, mỗi session chỉ giữ MEMORY_WINDOW lượt gần nhất
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(30 * 60)))  # giây
+# Nhiều worker process (asgi.py): lưu lịch sử vào SQLite dùng chung giữa các worker
+SESSION_SHARED = os.getenv("SESSION_SHARED", "false").lower() == "true"
+sessions = SessionStore(
+    max_sessions=SESSION_MAX,
+    ttl=SESSION_TTL,
+    window=MEMORY_WINDOW,
+    path=os.path.join(CACHE_DIR, "sessions.sqlite3") if SESSION_SHARED else None
+)
+
+# Flask dev server: debugger (chạy được code tùy ý) chỉ bật khi FLASK_DEBUG=true
+# và khi đó chỉ nghe trên localhost; FLASK_HOST=0.0.0.0 để mở cho máy khác (không debug)
+FLASK_DEBUG = os.getenv("FLASK_DEBUG", "false").lower() == "true"
+FLASK_HOST = "127.0.0.1" if FLASK_DEBUG else os.getenv("FLASK_HOST", "127.0.0.1")
+
 
 def initialize_chatbot():
     """
-    Khởi tạo chatbot với Pinecone vector store (MMR only)
+    Khởi tạo chatbot với vector store theo VECTOR_BACKEND, retrieval theo RETRIEVAL_MODE
     """
-    global qa_chain, vector_store, embeddings
+    global qa_chain, vector_store, embeddings, answer_cache, response_cache, keyword_index
     
     print("=" * 50)
-    print("Đang khởi tạo chatbot với Pinecone...")
+    print(f"Đang khởi tạo chatbot với vector store: {VECTOR_BACKEND}...")
     print("=" * 50)
     
-    # Kiểm tra Pinecone API key
+    # Kiểm tra Pinecone API key (backend local không cần)
     pinecone_api_key = os.getenv("PINECONE_API_KEY")
-    if not pinecone_api_key:
+    if VECTOR_BACKEND == "pinecone" and not pinecone_api_key:
         print("Không tìm thấy PINECONE_API_KEY trong file .env!")
         return False
     
@@ -43,16 +86,29 @@ def initialize_chatbot():
     if embeddings is None:
         embeddings = create_embeddings()
     
-    # Kết nối với Pinecone index
+    # Cache câu trả lời: khớp chính xác trước, sau đó theo ngữ nghĩa
+    # (cache ngữ nghĩa dùng chung embedding model với retrieval)
+    response_cache = ResponseCache(
+        max_entries=RESPONSE_CACHE_SIZE,
+        ttl=SEMANTIC_CACHE_TTL,
+        persist=RESPONSE_CACHE_PERSIST,
+        index_version_fn=lambda: get_index_version(INDEX_NAME)
+    )
+    answer_cache = SemanticAnswerCache(
+        embeddings,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        max_entries=SEMANTIC_CACHE_SIZE,
+        ttl=SEMANTIC_CACHE_TTL,
+        index_version_fn=lambda: get_index_version(INDEX_NAME)
+    )
+    
+    # Kết nối với vector store
     try:
-        print(f"Đang kết nối với Pinecone index: {INDEX_NAME}")
-        vector_store = PineconeVectorStore(
-            index_name=INDEX_NAME,
-            embedding=embeddings
-        )
-        print("Đã kết nối với Pinecone!")
+        print(f"Đang kết nối với index: {INDEX_NAME}")
+        vector_store = load_vector_store(embeddings, INDEX_NAME)
+        print("Đã kết nối với vector store!")
     except Exception as e:
-        print(f"Lỗi kết nối Pinecone: {str(e)}")
+        print(f"Lỗi kết nối vector store: {str(e)}")
         print("Đảm bảo bạn đã chạy upload_to_pinecone.py để tạo index!")
         return False
     
@@ -60,10 +116,21 @@ def initialize_chatbot():
         print("Không thể tạo vector store!")
         return False
     
-    # Create chatbot với MMR (mặc định)
-    qa_chain = create_chatbot(vector_store, prompt_template, 
+    # BM25 index build sẵn lúc upload → chỉ đọc file, không tách từ lại corpus
+    if RETRIEVAL_MODE == "hybrid" and keyword_index is None:
+        keyword_index = open_keyword_index(INDEX_NAME)
+        if keyword_index.load():
+            print(f"Đã đọc BM25 index: {len(keyword_index)} chunks")
+    
+    # Create chatbot (hybrid: MMR + BM25 mặc định)
+    # Chain dùng chung cho mọi người dùng, lịch sử chat lấy từ session của từng request
+    # Phần prompt cố định gửi làm system block được Anthropic prompt caching cache lại
+    qa_chain = create_chatbot(vector_store, question_prompt, 
                               use_memory=True, 
-                              retrieval_mode="mmr")
+                              retrieval_mode=RETRIEVAL_MODE,
+                              session_memory=True,
+                              system_prompt=system_prompt,
+                              keyword_index=keyword_index)
     
     if qa_chain is None:
         print("Không thể tạo chatbot - thiếu Claude API key")
@@ -93,6 +160,7 @@ def ask():
     
     data = request.json
     question = data.get('question', '')
+    session = sessions.get(data.get('session_id'))
     
     if qa_chain is None:
         return jsonify({
@@ -109,12 +177,15 @@ def ask():
         })
     
     try:
-        response = ask_question(qa_chain, question)
+        response = ask_question(qa_chain, question, answer_cache=answer_cache,
+                                response_cache=response_cache, session=session)
         
         return jsonify({
             'success': True,
             'answer': response['answer'],
-            'sources': response['sources']
+            'sources': response['sources'],
+            'cached': response.get('cached', False),
+            'usage': response.get('usage')
         })
     except Exception as e:
         return jsonify({
@@ -124,6 +195,78 @@ def ask():
         })
 
 
+def _sse(event, data):
+    """Đóng gói một Server-Sent Event (data dạng JSON để giữ nguyên xuống dòng)"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route('/api/ask/stream', methods=['POST'])
+def ask_stream():
+    """
+    API endpoint đặt câu hỏi, trả lời dạng stream (Server-Sent Events)
+    
+    Events: "token" {text} khi Claude sinh token, "sources" {sources, cached} ở cuối,
+    "error" {message} nếu có lỗi
+    """
+    data = request.json
+    question = data.get('question', '')
+    session = sessions.get(data.get('session_id'))
+    
+    if qa_chain is None:
+        return Response(_sse('error', {'message': "Chatbot chưa sẵn sàng. Vui lòng thêm API keys "
+                                                  "vào file .env và khởi động lại."}),
+                        mimetype='text/event-stream')
+    if not question:
+        return Response(_sse('error', {'message': "Vui lòng nhập câu hỏi!"}),
+                        mimetype='text/event-stream')
+    
+    def generate():
+        for event in stream_question(qa_chain, question, answer_cache=answer_cache,
+                                     response_cache=response_cache, session=session):
+            event_type = event.pop('type')
+            yield _sse(event_type, event)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Tắt buffer của nginx để token tới ngay
+        }
+    )
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """
+    API endpoint xem hit-rate của cache câu trả lời và prompt cache của Claude
+    """
+    return jsonify({
+        'exact': response_cache.stats() if response_cache is not None else None,
+        'semantic': answer_cache.stats() if answer_cache is not None else None,
+        'prompt': prompt_usage_stats(),
+        'condense': condense_stats()
+    })
+
+
+@app.route('/api/session/reset', methods=['POST'])
+def reset_session():
+    """
+    API endpoint xóa lịch sử hội thoại của session (bắt đầu cuộc trò chuyện mới)
+    """
+    data = request.json or {}
+    sessions.reset(data.get('session_id'))
+    return jsonify({'success': True})
+
+
+@app.route('/api/session/stats', methods=['GET'])
+def session_stats():
+    """
+    API endpoint xem số session đang giữ trong bộ nhớ
+    """
+    return jsonify(sessions.stats())
+
+
 @app.route('/api/rebuild', methods=['POST'])
 def rebuild_index():
     """
@@ -145,7 +288,7 @@ def rebuild_index():
 
 
 if __name__ == '__main__':
-    # Khởi tạo chatbot khi start app (MMR mặc định)
+    # Khởi tạo chatbot khi start app (RETRIEVAL_MODE, mặc định hybrid)
     initialize_chatbot()
     
     # Chạy Flask app
@@ -153,4 +296,4 @@ if __name__ == '__main__':
     print("Mở trình duyệt và truy cập: http://localhost:5000")
     print("Nhấn Ctrl+C để dừng server\n")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    app.run(debug=FLASK_DEBUG, host=FLASK_HOST, port=5000)
@@ -0,0 +1,150 @@
+"""
+Server production (ASGI): cùng API với app.py nhưng xử lý bất đồng bộ
+
+Mỗi request await Claude / Pinecone thay vì giữ một thread trong lúc chờ, nên một
+worker phục vụ được hàng chục câu hỏi đồng thời; chạy nhiều worker process để
+tận dụng nhiều CPU (embedding câu hỏi chạy trong thread pool của mỗi worker).
+Kết nối HTTP tới Anthropic và Pinecone được giữ và dùng lại trong suốt vòng đời worker.
+
+Chạy (backlog lớn để không rớt kết nối khi nhiều client mở cùng lúc):
+    SESSION_SHARED=true hypercorn asgi:app --workers 4 --backlog 2048 --bind 0.0.0.0:5000
+
+Đo tải: python -m src.loadtest --url http://localhost:5000 --concurrency 50
+"""
+
+import asyncio
+from quart import Quart, render_template, request, jsonify, Response
+
+import app as chatbot  # Dùng chung khởi tạo chain / cache / session với app.py
+from src.helper import aask_question, astream_question, prompt_usage_stats, condense_stats
+
+app = Quart(__name__)
+
+
+@app.before_serving
+async def startup():
+    """
+    Khởi tạo chatbot một lần mỗi worker, mở sẵn kết nối async tới Pinecone
+    """
+    await asyncio.to_thread(chatbot.initialize_chatbot)
+    if hasattr(chatbot.vector_store, "__aenter__"):
+        # Giữ client async của Pinecone mở → không tạo kết nối mới mỗi câu hỏi
+        await chatbot.vector_store.__aenter__()
+
+
+@app.after_serving
+async def shutdown():
+    if hasattr(chatbot.vector_store, "aclose"):
+        await chatbot.vector_store.aclose()
+
+
+@app.route('/')
+async def home():
+    """
+    Trang chủ
+    """
+    return await render_template('index.html')
+
+
+@app.route('/api/ask', methods=['POST'])
+async def ask():
+    """
+    API endpoint để đặt câu hỏi (async) - Hỗ trợ conversation memory theo session
+    """
+    data = await request.get_json()
+    question = data.get('question', '')
+    # SessionStore đọc/ghi SQLite (SESSION_SHARED) → chạy ngoài event loop
+    session = await asyncio.to_thread(chatbot.sessions.get, data.get('session_id'))
+    
+    if chatbot.qa_chain is None:
+        return jsonify({
+            'success': False,
+            'answer': "Chatbot chưa sẵn sàng. Vui lòng thêm API keys vào file .env và khởi động lại.",
+            'sources': []
+        })
+    
+    if not question:
+        return jsonify({
+            'success': False,
+            'answer': "Vui lòng nhập câu hỏi!",
+            'sources': []
+        })
+    
+    try:
+        response = await aask_question(chatbot.qa_chain, question,
+                                       answer_cache=chatbot.answer_cache,
+                                       response_cache=chatbot.response_cache,
+                                       session=session)
+        
+        return jsonify({
+            'success': True,
+            'answer': response['answer'],
+            'sources': response['sources'],
+            'cached': response.get('cached', False),
+            'usage': response.get('usage')
+        })
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'answer': f"Lỗi: {str(e)}",
+            'sources': []
+        })
+
+
+@app.route('/api/ask/stream', methods=['POST'])
+async def ask_stream():
+    """
+    API endpoint đặt câu hỏi, trả lời dạng stream (Server-Sent Events) - như app.py
+    """
+    data = await request.get_json()
+    question = data.get('question', '')
+    session = await asyncio.to_thread(chatbot.sessions.get, data.get('session_id'))
+    
+    if chatbot.qa_chain is None:
+        return Response(chatbot._sse('error', {'message': "Chatbot chưa sẵn sàng. Vui lòng thêm "
+                                                          "API keys vào file .env và khởi động lại."}),
+                        mimetype='text/event-stream')
+    if not question:
+        return Response(chatbot._sse('error', {'message': "Vui lòng nhập câu hỏi!"}),
+                        mimetype='text/event-stream')
+    
+    async def generate():
+        async for event in astream_question(chatbot.qa_chain, question,
+                                            answer_cache=chatbot.answer_cache,
+                                            response_cache=chatbot.response_cache,
+                                            session=session):
+            event_type = event.pop('type')
+            yield chatbot._sse(event_type, event)
+    
+    response = Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+    response.timeout = None  # Câu trả lời dài có thể stream lâu hơn timeout mặc định
+    return response
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+async def cache_stats():
+    return jsonify({
+        'exact': chatbot.response_cache.stats() if chatbot.response_cache is not None else None,
+        'semantic': chatbot.answer_cache.stats() if chatbot.answer_cache is not None else None,
+        'prompt': prompt_usage_stats(),
+        'condense': condense_stats()
+    })
+
+
+@app.route('/api/session/reset', methods=['POST'])
+async def reset_session():
+    data = await request.get_json() or {}
+    await asyncio.to_thread(chatbot.sessions.reset, data.get('session_id'))
+    return jsonify({'success': True})
+
+
+@app.route('/api/session/stats', methods=['GET'])
+async def session_stats():
+    return jsonify(await asyncio.to_thread(chatbot.sessions.stats))
@@ -3,10 +3,16 @@ Advanced Retrieval Techniques - Cải thiện chất lượng trả lời
 Bao gồm: Re-ranking, Hybrid Search, Query Expansion
 """
 
-from typing import List, Dict
+import asyncio
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import CohereRerank, LLMChainExtractor
 from langchain_anthropic import ChatAnthropic
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from src.context_packer import reciprocal_rank_fusion
 import os
 
 
@@ -92,153 +98,81 @@ def expand_query_vietnamese(question: str) -> List[str]:
     return queries[:5]
 
 
-class HybridSearchRetriever:
+# Thread chạy nhánh keyword search song song với nhánh vector (retriever đồng bộ)
+_keyword_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="keyword-search")
+atexit.register(_keyword_executor.shutdown, wait=False, cancel_futures=True)
+
+
+class HybridSearchRetriever(BaseRetriever):
     """
     Kết hợp Vector Search (semantic) + Keyword Search (BM25)
     
     Vector Search: Hiểu nghĩa ("nhiệt độ" ≈ "độ nóng")
     Keyword Search: Tìm từ khóa chính xác ("PV = nRT")
+    
+    Hai nhánh chạy đồng thời (thread / asyncio.gather), kết quả gộp bằng
+    reciprocal_rank_fusion.
     """
     
-    def __init__(self, vector_store, documents):
-        """
-        Args:
-            vector_store: FAISS/Pinecone vector store
-            documents: List các document chunks (cần cho BM25)
-        """
-        self.vector_store = vector_store
-        self.documents = documents
-        self.bm25 = None
-        self._init_bm25()
-    
-    def _init_bm25(self):
-        """Khởi tạo BM25 keyword search"""
+    vector_retriever: BaseRetriever
+    keyword_index: Any  # src.keyword_index.BM25Index đã load
+    k: int = 12
+    keyword_k: int = 12
+    vector_weight: float = 1.0
+    keyword_weight: float = 1.0
+    
+    @property
+    def vectorstore(self):
+        """Vector store của nhánh vector (chain dùng embedding model của nó)"""
+        return getattr(self.vector_retriever, 'vectorstore', None)
+    
+    def _fuse(self, vector_docs, keyword_results):
+        return reciprocal_rank_fusion(
+            [vector_docs, [doc for doc, _ in keyword_results]],
+            self.k,
+            weights=[self.vector_weight, self.keyword_weight]
+        )
+    
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        keyword = _keyword_executor.submit(self.keyword_index.search, query, self.keyword_k)
         try:
-            from rank_bm25 import BM25Okapi
-            import jieba
-            
-            # Tách từ cho mỗi document
-            tokenized_docs = [
-                list(jieba.cut(doc['text'])) for doc in self.documents
-            ]
-            self.bm25 = BM25Okapi(tokenized_docs)
-            print("BM25 Keyword Search đã sẵn sàng")
-        except ImportError as e:
-            print(f"Cần cài đặt: pip install rank-bm25 jieba (Lỗi: {e})")
-            self.bm25 = None
-        except Exception as e:
-            print(f"Lỗi khởi tạo BM25: {e}")
-            self.bm25 = None
-    
-    def search(self, query: str, k: int = 8) -> List[Dict]:
-        """
-        Hybrid search: Kết hợp vector + keyword
-        
-        Args:
-            query: Câu hỏi
-            k: Số chunks cần lấy
-        
-        Returns:
-            results: List chunks được ranked
-        """
-        results = {}
-        
-        # 1. Vector search (semantic similarity)
-        vector_docs = self.vector_store.similarity_search_with_score(query, k=k)
-        for doc, score in vector_docs:
-            doc_id = f"{doc.metadata['source']}_{doc.metadata['chunk_id']}"
-            results[doc_id] = {
-                'doc': doc,
-                'vector_score': score,
-                'bm25_score': 0
-            }
-        
-        # 2. BM25 keyword search
-        if self.bm25:
-            import jieba
-            tokenized_query = list(jieba.cut(query))
-            bm25_scores = self.bm25.get_scores(tokenized_query)
-            
-            # Top k results từ BM25
-            top_bm25_indices = sorted(
-                range(len(bm25_scores)), 
-                key=lambda i: bm25_scores[i], 
-                reverse=True
-            )[:k]
-            
-            for idx in top_bm25_indices:
-                doc_data = self.documents[idx]
-                doc_id = f"{doc_data['source']}_{doc_data['chunk_id']}"
-                
-                if doc_id in results:
-                    results[doc_id]['bm25_score'] = bm25_scores[idx]
-                else:
-                    # Create pseudo document object
-                    from langchain.schema import Document
-                    doc = Document(
-                        page_content=doc_data['text'],
-                        metadata={
-                            'source': doc_data['source'],
-                            'chunk_id': doc_data['chunk_id']
-                        }
-                    )
-                    results[doc_id] = {
-                        'doc': doc,
-                        'vector_score': 0,
-                        'bm25_score': bm25_scores[idx]
-                    }
-        
-        # 3. Kết hợp điểm số (weighted average)
-        final_results = []
-        for doc_id, data in results.items():
-            # Normalize scores về [0, 1]
-            vector_norm = 1 / (1 + data['vector_score']) if data['vector_score'] > 0 else 0
-            bm25_norm = data['bm25_score'] / 100 if data['bm25_score'] > 0 else 0
-            
-            # Weighted combination: 70% vector + 30% BM25
-            combined_score = 0.7 * vector_norm + 0.3 * bm25_norm
-            
-            final_results.append({
-                'doc': data['doc'],
-                'score': combined_score
-            })
-        
-        # Sắp xếp theo điểm tổng hợp
-        final_results.sort(key=lambda x: x['score'], reverse=True)
-        
-        return [r['doc'] for r in final_results[:k]]
+            vector_docs = self.vector_retriever.invoke(
+                query, config={"callbacks": run_manager.get_child() if run_manager else None}
+            )
+            return self._fuse(vector_docs, keyword.result())
+        finally:
+            keyword.cancel()
+    
+    async def _aget_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        vector_docs, keyword_results = await asyncio.gather(
+            self.vector_retriever.ainvoke(
+                query, config={"callbacks": run_manager.get_child() if run_manager else None}
+            ),
+            asyncio.to_thread(self.keyword_index.search, query, self.keyword_k)
+        )
+        return self._fuse(vector_docs, keyword_results)
 
 
-def create_hybrid_retriever(vector_store, documents):
+def create_hybrid_retriever(vector_store, keyword_index, k=12, fetch_k=30, lambda_mult=0.5):
     """
-    Wrapper để tạo hybrid retriever tương thích với LangChain
+    Tạo hybrid retriever: nhánh vector dùng MMR như chế độ "mmr", nhánh keyword
+    dùng BM25 index build sẵn
     
     Args:
-        vector_store: FAISS/Pinecone vector store
-        documents: List chunks
+        vector_store: Pinecone vector store hoặc LocalVectorStore
+        keyword_index: BM25Index đã load (src.keyword_index)
+        k: Số chunks trả về (mỗi nhánh cũng lấy k chunks)
+        fetch_k, lambda_mult: Tham số MMR của nhánh vector
     
     Returns:
-        CustomRetriever với hybrid search
+        HybridSearchRetriever
     """
-    from langchain.schema.retriever import BaseRetriever
-    from langchain.callbacks.manager import CallbackManagerForRetrieverRun
-    from typing import List
-    from langchain.schema import Document
-    
-    class CustomHybridRetriever(BaseRetriever):
-        hybrid_searcher: HybridSearchRetriever
-        k: int = 8
-        
-        def _get_relevant_documents(
-            self, 
-            query: str, 
-            *, 
-            run_manager: CallbackManagerForRetrieverRun = None
-        ) -> List[Document]:
-            return self.hybrid_searcher.search(query, k=self.k)
-    
-    hybrid_searcher = HybridSearchRetriever(vector_store, documents)
-    return CustomHybridRetriever(hybrid_searcher=hybrid_searcher, k=8)
+    vector_retriever = vector_store.as_retriever(
+        search_type="mmr",
+        search_kwargs={"k": k, "fetch_k": fetch_k, "lambda_mult": lambda_mult}
+    )
+    return HybridSearchRetriever(vector_retriever=vector_retriever,
+                                 keyword_index=keyword_index, k=k, keyword_k=k)
 
 
 # Test function
@@ -0,0 +1,252 @@
+"""
+Index tìm kiếm gần đúng (ANN) cho LocalVectorStore: IVF và IVF-PQ viết bằng NumPy
+
+- IVF: k-means chia vector thành nlist cụm; mỗi câu hỏi chỉ quét nprobe cụm gần nhất
+- IVF-PQ: thêm product quantization cho phần dư (vector - tâm cụm): mỗi vector còn
+  m byte, điểm tính bằng bảng tra (ADC), sau đó xếp hạng lại chính xác một số
+  nhỏ candidate bằng vector gốc trong memmap
+
+nprobe (và refine với PQ) điều chỉnh cân bằng recall / latency lúc truy vấn;
+đo bằng: python -m src.benchmark ann
+"""
+
+import os
+import numpy as np
+
+
+ANN_INDEX_TYPES = ("flat", "ivf", "ivfpq")
+
+# Số hàng mỗi lần gán cụm (giới hạn bộ nhớ tạm)
+ASSIGN_BLOCK_ROWS = 16384
+
+
+def _assign(data, centroids):
+    """Gán mỗi vector vào tâm gần nhất (khoảng cách Euclid), tính theo block"""
+    half_norms = 0.5 * np.sum(centroids * centroids, axis=1)
+    labels = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), ASSIGN_BLOCK_ROWS):
+        block = np.asarray(data[start:start + ASSIGN_BLOCK_ROWS], dtype=np.float32)
+        labels[start:start + len(block)] = np.argmax(block @ centroids.T - half_norms, axis=1)
+    return labels
+
+
+def kmeans(data, n_clusters, iters=20, seed=0):
+    """
+    K-means (Lloyd) vector hóa bằng NumPy
+
+    Args:
+        data: Ma trận (n, d) float32
+        n_clusters: Số cụm
+        iters: Số vòng lặp
+        seed: Seed khởi tạo
+
+    Returns:
+        centroids: Ma trận (n_clusters, d)
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(data))
+    centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+
+    for _ in range(iters):
+        labels = _assign(data, centroids)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=n_clusters)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        # Cụm rỗng → khởi tạo lại bằng một vector ngẫu nhiên
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted file index (tùy chọn product quantization) trên các hàng của LocalVectorStore
+
+    Index phủ các hàng [0, num_rows) của ma trận; hàng thêm sau đó được
+    gán vào cụm có sẵn bằng extend() mà không cần train lại.
+    """
+
+    def __init__(self, centroids, list_offsets, list_rows, num_rows,
+                 codebooks=None, codes=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets  # (nlist + 1,) vị trí bắt đầu mỗi cụm trong list_rows
+        self.list_rows = list_rows        # Chỉ số hàng, sắp theo cụm
+        self.num_rows = num_rows
+        self.codebooks = codebooks        # (m, ksub, dsub) hoặc None nếu IVF thường
+        self.codes = codes                # (len(list_rows), m) uint8, cùng thứ tự list_rows
+
+    @property
+    def index_type(self):
+        return "ivfpq" if self.codebooks is not None else "ivf"
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors, index_type="ivf", nlist=None, pq_m=None, iters=20,
+              train_size=65536, seed=0):
+        """
+        Train và build index
+
+        Args:
+            vectors: Ma trận (n, d) đã chuẩn hóa (memmap được)
+            index_type: "ivf" hoặc "ivfpq"
+            nlist: Số cụm (mặc định ~4*sqrt(n))
+            pq_m: Số sub-quantizer cho PQ (mặc định d/8 → mỗi vector còn d/8 byte)
+            iters: Số vòng k-means
+            train_size: Số vector tối đa dùng để train
+            seed: Seed
+
+        Returns:
+            index: IVFIndex
+        """
+        num_rows, dim = vectors.shape
+        nlist = nlist or max(1, int(4 * np.sqrt(num_rows)))
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(num_rows, min(num_rows, train_size), replace=False))
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+
+        centroids = kmeans(sample, nlist, iters=iters, seed=seed)
+
+        codebooks = None
+        if index_type == "ivfpq":
+            pq_m = pq_m or max(1, dim // 8)
+            if dim % pq_m:
+                raise ValueError(f"dim={dim} không chia hết cho pq_m={pq_m}")
+            # Codebook 256 tâm mỗi sub-space không cần nhiều mẫu như k-means thô
+            pq_sample = sample[:16384]
+            residuals = pq_sample - centroids[_assign(pq_sample, centroids)]
+            dsub = dim // pq_m
+            ksub = min(256, len(sample))
+            codebooks = np.stack([
+                kmeans(residuals[:, j * dsub:(j + 1) * dsub], ksub, iters=iters, seed=seed + j)
+                for j in range(pq_m)
+            ])
+        elif index_type != "ivf":
+            raise ValueError(f"index_type không hợp lệ: {index_type} ({', '.join(ANN_INDEX_TYPES)})")
+
+        index = cls(centroids, np.zeros(len(centroids) + 1, dtype=np.int64),
+                    np.empty(0, dtype=np.int64), 0, codebooks,
+                    None if codebooks is None else np.empty((0, len(codebooks)), dtype=np.uint8))
+        index.extend(vectors)
+        return index
+
+    def _encode(self, vectors, labels):
+        """Mã hóa PQ phần dư của vector so với tâm cụm"""
+        residuals = vectors - self.centroids[labels]
+        m, _, dsub = self.codebooks.shape
+        codes = np.empty((len(vectors), m), dtype=np.uint8)
+        for j in range(m):
+            codes[:, j] = _assign(residuals[:, j * dsub:(j + 1) * dsub], self.codebooks[j])
+        return codes
+
+    def extend(self, vectors):
+        """
+        Thêm các hàng [num_rows, len(vectors)) vào cụm gần nhất (không train lại)
+        """
+        new_rows = np.arange(self.num_rows, len(vectors), dtype=np.int64)
+        if not len(new_rows):
+            return
+        list_ids = np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+        new_list_ids = np.empty(len(new_rows), dtype=np.int64)
+        new_codes = []
+        for start in range(0, len(new_rows), ASSIGN_BLOCK_ROWS):
+            rows = new_rows[start:start + ASSIGN_BLOCK_ROWS]
+            block = np.asarray(vectors[rows[0]:rows[-1] + 1], dtype=np.float32)
+            labels = _assign(block, self.centroids)
+            new_list_ids[start:start + len(rows)] = labels
+            if self.codebooks is not None:
+                new_codes.append(self._encode(block, labels))
+
+        all_list_ids = np.concatenate([list_ids, new_list_ids])
+        order = np.argsort(all_list_ids, kind="stable")
+        self.list_rows = np.concatenate([self.list_rows, new_rows])[order]
+        if self.codebooks is not None:
+            self.codes = np.concatenate([self.codes] + new_codes)[order]
+        self.list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(all_list_ids, minlength=self.nlist))]
+        ).astype(np.int64)
+        self.num_rows = len(vectors)
+
+    def remap(self, new_row_of):
+        """
+        Cập nhật chỉ số hàng sau khi store thu gọn file
+
+        Args:
+            new_row_of: Mảng (num_rows cũ,) hàng mới của mỗi hàng cũ, -1 nếu đã xóa
+        """
+        list_ids = np.repeat(np.arange(self.nlist), np.diff(self.list_offsets))
+        mapped = new_row_of[self.list_rows]
+        keep = mapped >= 0
+        self.list_rows = mapped[keep]
+        if self.codes is not None:
+            self.codes = self.codes[keep]
+        self.list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(list_ids[keep], minlength=self.nlist))]
+        ).astype(np.int64)
+        self.num_rows = int((new_row_of[:self.num_rows] >= 0).sum())
+
+    def search(self, query_vector, vectors, k, nprobe=8, refine=4):
+        """
+        Tìm k hàng gần nhất trong nprobe cụm gần câu hỏi nhất
+
+        Args:
+            query_vector: Vector câu hỏi đã chuẩn hóa
+            vectors: Ma trận gốc (memmap) để tính điểm chính xác
+            k: Số kết quả
+            nprobe: Số cụm quét (lớn hơn → recall cao hơn, chậm hơn)
+            refine: Với PQ: xếp hạng lại chính xác k*refine candidate tốt nhất theo ADC
+
+        Returns:
+            (rows, scores): Candidate (chưa sắp xếp) và cosine chính xác của chúng
+        """
+        centroid_scores = self.centroids @ query_vector
+        nprobe = min(nprobe, self.nlist)
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+        positions = np.concatenate([
+            np.arange(self.list_offsets[p], self.list_offsets[p + 1]) for p in probes
+        ])
+        rows = self.list_rows[positions]
+        if self.codebooks is not None and len(rows) > k * refine:
+            # ADC: điểm ≈ q·tâm cụm + Σ_j q_j·codebook_j[code_j]
+            m, _, dsub = self.codebooks.shape
+            table = np.einsum("jd,jkd->jk", query_vector.reshape(m, dsub), self.codebooks)
+            list_scores = np.repeat(centroid_scores[probes],
+                                    np.diff(self.list_offsets)[probes])
+            approx = list_scores + table[np.arange(m), self.codes[positions]].sum(axis=1)
+            rows = rows[np.argpartition(-approx, k * refine - 1)[:k * refine]]
+
+        rows = np.sort(rows)  # Đọc memmap theo thứ tự hàng
+        scores = np.asarray(vectors[rows], dtype=np.float32) @ query_vector
+        return rows, scores
+
+    def save(self, path):
+        """Lưu index (ghi file tạm rồi rename)"""
+        arrays = {
+            "centroids": self.centroids,
+            "list_offsets": self.list_offsets,
+            "list_rows": self.list_rows,
+            "num_rows": np.array(self.num_rows),
+        }
+        if self.codebooks is not None:
+            arrays["codebooks"] = self.codebooks
+            arrays["codes"] = self.codes
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data["centroids"], data["list_offsets"], data["list_rows"],
+                int(data["num_rows"]),
+                data["codebooks"] if "codebooks" in data else None,
+                data["codes"] if "codes" in data else None,
+            )
@@ -0,0 +1,321 @@
+"""
+Script benchmark hiệu năng các thành phần của chatbot trên corpus Vật Lý
+
+Chạy:
+    python -m src.benchmark embeddings --backends int8 onnx --limit 512
+    python -m src.benchmark batching --token-budgets 4096 8192 16384
+    python -m src.benchmark ann --synthetic 200000 --nprobes 1 4 16
+    python -m src.benchmark mmr
+"""
+
+import time
+import argparse
+from itertools import islice
+import numpy as np
+
+from src.helper import iter_pdf_documents, iter_chunks, create_embeddings
+from src.embeddings import TokenBudgetEmbeddings
+from src.ann_index import IVFIndex
+from src.local_vector_store import LocalVectorStore, mmr_select, normalize_rows, top_k_indices
+from src.evaluate import TEST_CASES
+
+
+def load_corpus_chunks(data_dir="data", limit=512):
+    """
+    Lấy tối đa `limit` chunk text từ corpus (chỉ text, không gọi Vision)
+    """
+    documents = iter_pdf_documents(data_dir, extract_images=False)
+    return [chunk['text'] for chunk in islice(iter_chunks(documents), limit)]
+
+
+def _percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q)) * 1000
+
+
+def benchmark_embeddings(backends=("int8", "onnx"), use_phobert=True, data_dir="data",
+                         limit=512, num_queries=30):
+    """
+    So sánh backend embedding với PyTorch fp32 trên corpus
+
+    - Parity: cosine giữa vector của backend và vector fp32 cho cùng chunk
+    - Throughput: số chunk/giây khi embed corpus
+    - Latency: thời gian embed một câu hỏi (câu hỏi trong src/evaluate.py)
+
+    Args:
+        backends: Các backend cần so sánh với "torch"
+        use_phobert: True = PhoBERT, False = multilingual
+        data_dir: Thư mục PDF
+        limit: Số chunk tối đa dùng để đo
+        num_queries: Số câu hỏi dùng để đo latency
+
+    Returns:
+        results: Dict {backend: {...số liệu...}}
+    """
+    texts = load_corpus_chunks(data_dir, limit)
+    if not texts:
+        print(f"Không có chunk nào trong {data_dir}/")
+        return {}
+    queries = [test["question"] for test in TEST_CASES][:num_queries]
+
+    print(f"Benchmark embedding: {len(texts)} chunks, {len(queries)} câu hỏi")
+
+    results = {}
+    reference = None
+    for backend in ("torch",) + tuple(b for b in backends if b != "torch"):
+        print(f"\n--- Backend: {backend} ---")
+        embeddings = create_embeddings(use_phobert=use_phobert, use_cache=False, backend=backend)
+
+        # Warm-up (load kernel, export ONNX lần đầu...)
+        embeddings.embed_documents(texts[:8])
+        embeddings.embed_query(queries[0])
+
+        start = time.perf_counter()
+        vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+        elapsed = time.perf_counter() - start
+
+        latencies = []
+        for query in queries:
+            query_start = time.perf_counter()
+            embeddings.embed_query(query)
+            latencies.append(time.perf_counter() - query_start)
+
+        if reference is None:
+            reference = vectors
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1)
+        cosine = np.sum(vectors * reference, axis=1) / np.maximum(norms, 1e-12)
+
+        results[backend] = {
+            "chunks_per_sec": len(texts) / elapsed,
+            "query_p50_ms": _percentile_ms(latencies, 50),
+            "query_p95_ms": _percentile_ms(latencies, 95),
+            "cosine_mean": float(cosine.mean()),
+            "cosine_min": float(cosine.min()),
+        }
+
+    base = results["torch"]
+    print("\n" + "=" * 80)
+    print(f"{'Backend':8s} | {'chunks/s':>9s} | {'speedup':>7s} | {'query p50':>9s} | "
+          f"{'query p95':>9s} | {'cos mean':>8s} | {'cos min':>8s}")
+    print("-" * 80)
+    for backend, r in results.items():
+        print(f"{backend:8s} | {r['chunks_per_sec']:9.1f} | "
+              f"{r['chunks_per_sec'] / base['chunks_per_sec']:6.2f}x | "
+              f"{r['query_p50_ms']:7.1f}ms | {r['query_p95_ms']:7.1f}ms | "
+              f"{r['cosine_mean']:8.4f} | {r['cosine_min']:8.4f}")
+    print("=" * 80)
+    print("Cosine so với fp32 ≥ 0.99 → kết quả retrieval gần như không đổi")
+
+    return results
+
+
+def benchmark_batching(token_budgets=(4096, 8192, 16384), use_phobert=True,
+                       data_dir="data", limit=1024):
+    """
+    So sánh batch cố định (batch_size=32) với batch theo ngân sách token
+
+    Tokens/giây tính trên số token thật (không tính padding) của corpus.
+
+    Args:
+        token_budgets: Các ngân sách token cần thử
+        use_phobert: True = PhoBERT, False = multilingual
+        data_dir: Thư mục PDF
+        limit: Số chunk tối đa dùng để đo
+
+    Returns:
+        results: Dict {tên cấu hình: tokens/giây}
+    """
+    texts = load_corpus_chunks(data_dir, limit)
+    if not texts:
+        print(f"Không có chunk nào trong {data_dir}/")
+        return {}
+
+    hf_embeddings = create_embeddings(use_phobert=use_phobert, use_cache=False, token_budget=None)
+    counter = TokenBudgetEmbeddings(hf_embeddings)
+    total_tokens = int(counter.count_tokens([t.replace("\n", " ") for t in texts]).sum())
+    print(f"Benchmark batching: {len(texts)} chunks, {total_tokens} tokens")
+
+    # Warm-up
+    hf_embeddings.embed_documents(texts[:8])
+
+    results = {}
+    start = time.perf_counter()
+    hf_embeddings.embed_documents(texts)
+    results["fixed batch_size=32"] = total_tokens / (time.perf_counter() - start)
+
+    for budget in token_budgets:
+        bucketed = TokenBudgetEmbeddings(hf_embeddings, token_budget=budget)
+        bucketed.embed_documents(texts)
+        stats = bucketed.last_stats
+        padding = 1 - stats["tokens"] / stats["padded_tokens"]
+        results[f"token_budget={budget} (padding {padding:.0%})"] = stats["tokens_per_sec"]
+
+    base = results["fixed batch_size=32"]
+    print("\n" + "=" * 70)
+    for name, tokens_per_sec in results.items():
+        print(f"{name:40s} | {tokens_per_sec:9.0f} tokens/s | {tokens_per_sec / base:5.2f}x")
+    print("=" * 70)
+
+    return results
+
+
+def _synthetic_vectors(num_vectors, dim, num_clusters=None, seed=0):
+    """Vector ngẫu nhiên phân cụm (mô phỏng corpus lớn), đã chuẩn hóa"""
+    rng = np.random.default_rng(seed)
+    num_clusters = num_clusters or max(1, num_vectors // 200)
+    centers = rng.normal(size=(num_clusters, dim)).astype(np.float32)
+    labels = rng.integers(num_clusters, size=num_vectors)
+    vectors = centers[labels] + 0.6 * rng.normal(size=(num_vectors, dim)).astype(np.float32)
+    return normalize_rows(vectors).astype(np.float16)
+
+
+def benchmark_ann(index_types=("ivf", "ivfpq"), nprobes=(1, 2, 4, 8, 16, 32), k=10,
+                  synthetic=0, dim=768, num_queries=200, index_name="studychatbot"):
+    """
+    Đo recall@k và latency của ANN index so với quét toàn bộ (brute-force)
+
+    Câu hỏi giả lập = vector trong corpus + nhiễu (gần giống câu hỏi về một đoạn có thật).
+
+    Args:
+        index_types: Các loại index cần đo ("ivf", "ivfpq")
+        nprobes: Các giá trị nprobe cần thử
+        k: Số kết quả
+        synthetic: > 0 = dùng corpus giả lập với số vector này, 0 = local index thật
+        dim: Số chiều vector giả lập
+        num_queries: Số câu hỏi
+        index_name: Tên local index (khi synthetic=0)
+
+    Returns:
+        results: Dict {(index_type, nprobe): {...số liệu...}}
+    """
+    if synthetic:
+        vectors = _synthetic_vectors(synthetic, dim)
+    else:
+        vectors = LocalVectorStore(None, name=index_name).vectors
+        if not len(vectors):
+            print(f"Local index '{index_name}' đang trống - chạy upload với VECTOR_BACKEND=local "
+                  "hoặc dùng --synthetic")
+            return {}
+
+    rng = np.random.default_rng(1)
+    queries = np.asarray(vectors[rng.choice(len(vectors), num_queries)], dtype=np.float32)
+    queries = normalize_rows(queries + 0.3 * rng.normal(size=queries.shape) / np.sqrt(queries.shape[1]))
+    print(f"Benchmark ANN: {len(vectors)} vectors x {vectors.shape[1]}D, "
+          f"{num_queries} câu hỏi, k={k}")
+
+    # Brute-force làm chuẩn
+    truth, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        scores = np.asarray(vectors, dtype=np.float32) @ query
+        truth.append(set(top_k_indices(scores, k).tolist()))
+        latencies.append(time.perf_counter() - start)
+    results = {("flat", None): {"recall": 1.0, "p50_ms": _percentile_ms(latencies, 50),
+                                "p95_ms": _percentile_ms(latencies, 95)}}
+
+    for index_type in index_types:
+        start = time.perf_counter()
+        index = IVFIndex.build(vectors, index_type=index_type)
+        print(f"Build {index_type}: {index.nlist} cụm trong {time.perf_counter() - start:.1f}s")
+        for nprobe in nprobes:
+            recalls, latencies = [], []
+            for query, expected in zip(queries, truth):
+                start = time.perf_counter()
+                rows, scores = index.search(query, vectors, k, nprobe=nprobe)
+                found = rows[top_k_indices(scores, k)]
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len(expected & set(found.tolist())) / k)
+            results[(index_type, nprobe)] = {
+                "recall": float(np.mean(recalls)),
+                "p50_ms": _percentile_ms(latencies, 50),
+                "p95_ms": _percentile_ms(latencies, 95),
+            }
+
+    print("\n" + "=" * 60)
+    print(f"{'Index':8s} | {'nprobe':>6s} | {'recall@' + str(k):>9s} | {'p50':>8s} | {'p95':>8s}")
+    print("-" * 60)
+    for (index_type, nprobe), r in results.items():
+        print(f"{index_type:8s} | {str(nprobe or '-'):>6s} | {r['recall']:9.3f} | "
+              f"{r['p50_ms']:6.2f}ms | {r['p95_ms']:6.2f}ms")
+    print("=" * 60)
+    print("Chọn nprobe nhỏ nhất đạt recall mong muốn → đặt VECTOR_NPROBE trong .env")
+
+    return results
+
+
+def benchmark_mmr(k=12, fetch_k=30, dim=768, lambda_mult=0.5, repeats=1000):
+    """
+    So sánh MMR của LangChain (vòng lặp Python) với mmr_select (vector hóa)
+
+    Cấu hình mặc định giống create_chatbot: k=12, fetch_k=30, lambda=0.5.
+
+    Returns:
+        results: Dict {tên: micro giây mỗi lần chọn}
+    """
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+    rng = np.random.default_rng(0)
+    query = normalize_rows(rng.normal(size=dim))
+    candidates = normalize_rows(rng.normal(size=(fetch_k, dim)))
+    candidate_list = candidates.tolist()  # PineconeVectorStore nhận values dạng list
+
+    assert mmr_select(query, candidates, k, lambda_mult) == \
+        maximal_marginal_relevance(query, candidates, lambda_mult, k)
+
+    results = {}
+    for name, fn in (
+        ("langchain maximal_marginal_relevance",
+         lambda: maximal_marginal_relevance(np.array([query]), candidate_list, lambda_mult, k)),
+        ("mmr_select (NumPy)", lambda: mmr_select(query, candidates, k, lambda_mult)),
+    ):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        results[name] = (time.perf_counter() - start) / repeats * 1e6
+
+    print(f"MMR k={k}, fetch_k={fetch_k}, dim={dim}")
+    for name, micros in results.items():
+        print(f"{name:40s} | {micros:8.1f} µs")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark chatbot Vật Lý")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_emb = subparsers.add_parser("embeddings", help="So sánh backend embedding (parity + tốc độ)")
+    parser_emb.add_argument("--backends", nargs="+", default=["int8", "onnx"])
+    parser_emb.add_argument("--multilingual", action="store_true", help="Dùng model multilingual thay vì PhoBERT")
+    parser_emb.add_argument("--data-dir", default="data")
+    parser_emb.add_argument("--limit", type=int, default=512)
+
+    parser_batch = subparsers.add_parser("batching", help="So sánh batch cố định với batch theo token")
+    parser_batch.add_argument("--token-budgets", nargs="+", type=int, default=[4096, 8192, 16384])
+    parser_batch.add_argument("--multilingual", action="store_true", help="Dùng model multilingual thay vì PhoBERT")
+    parser_batch.add_argument("--data-dir", default="data")
+    parser_batch.add_argument("--limit", type=int, default=1024)
+
+    parser_ann = subparsers.add_parser("ann", help="Recall@k / latency của ANN index so với brute-force")
+    parser_ann.add_argument("--index-types", nargs="+", default=["ivf", "ivfpq"])
+    parser_ann.add_argument("--nprobes", nargs="+", type=int, default=[1, 2, 4, 8, 16, 32])
+    parser_ann.add_argument("--k", type=int, default=10)
+    parser_ann.add_argument("--synthetic", type=int, default=0,
+                            help="Số vector giả lập (0 = dùng local index thật)")
+    parser_ann.add_argument("--num-queries", type=int, default=200)
+
+    parser_mmr = subparsers.add_parser("mmr", help="Thời gian chọn MMR (LangChain vs NumPy)")
+    parser_mmr.add_argument("--k", type=int, default=12)
+    parser_mmr.add_argument("--fetch-k", type=int, default=30)
+
+    args = parser.parse_args()
+
+    if args.command == "embeddings":
+        benchmark_embeddings(backends=args.backends, use_phobert=not args.multilingual,
+                             data_dir=args.data_dir, limit=args.limit)
+    elif args.command == "batching":
+        benchmark_batching(token_budgets=args.token_budgets, use_phobert=not args.multilingual,
+                           data_dir=args.data_dir, limit=args.limit)
+    elif args.command == "ann":
+        benchmark_ann(index_types=args.index_types, nprobes=args.nprobes, k=args.k,
+                      synthetic=args.synthetic, num_queries=args.num_queries)
+    elif args.command == "mmr":
+        benchmark_mmr(k=args.k, fetch_k=args.fetch_k)
@@ -0,0 +1,483 @@
+"""
+Các lớp cache dùng trong chatbot
+Bao gồm: Cache mô tả ảnh của Claude Vision (lưu trên đĩa),
+cache câu trả lời theo câu hỏi đã chuẩn hóa (RAM, tùy chọn lưu đĩa) và
+theo ngữ nghĩa câu hỏi (trong RAM)
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+# Thư mục cache mặc định (trong project)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache")
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Khóa độc quyền giữa các process (vd. asgi.py và upload_to_pinecone.py dùng
+    chung .cache/), giữ tới khi ra khỏi khối with
+
+    Args:
+        path: File khóa (tạo nếu chưa có, nội dung không dùng)
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK chỉ thử lại trong ~10 giây
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def perceptual_hash(image, hash_size=16):
+    """
+    Tính difference hash (dHash) của ảnh
+
+    Hai ảnh giống nhau về mặt thị giác (logo, header lặp lại, khác nhau chút ít
+    do nén/scale) sẽ có hash chỉ khác nhau vài bit.
+
+    Args:
+        image: PIL Image object
+        hash_size: Kích thước lưới so sánh (hash dài hash_size^2 bit)
+
+    Returns:
+        phash: Số nguyên hash_size^2 bit
+    """
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+
+    phash = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            phash = (phash << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return phash
+
+
+class VisionCache:
+    """
+    Cache mô tả ảnh của Claude Vision
+
+    - Lưu trên đĩa (SQLite), key = sha256(bytes ảnh + prompt + model)
+      → chạy lại upload_to_pinecone.py không gọi lại API cho trang không đổi
+    - Dedup trong một lần chạy bằng perceptual hash → ảnh lặp lại (logo,
+      header) chỉ phân tích một lần
+    - An toàn khi dùng từ nhiều thread và nhiều process (process pool)
+    """
+
+    def __init__(self, path=None, phash_threshold=6):
+        """
+        Args:
+            path: Đường dẫn file SQLite (mặc định: .cache/vision_cache.sqlite3)
+            phash_threshold: Số bit khác nhau tối đa để coi 2 ảnh là trùng
+        """
+        self.path = path or os.path.join(CACHE_DIR, "vision_cache.sqlite3")
+        self.phash_threshold = phash_threshold
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._seen = []  # [(phash, description)] trong lần chạy hiện tại
+        self.reset_stats()
+
+    def _connection(self):
+        """Mở kết nối SQLite (mở lại nếu đang ở process con sau fork)"""
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS descriptions "
+                "(key TEXT PRIMARY KEY, description TEXT NOT NULL)"
+            )
+            self._pid = os.getpid()
+            self._seen = []
+        return self._conn
+
+    @staticmethod
+    def make_key(image_bytes, prompt, model):
+        """
+        Tạo key cache từ nội dung ảnh, prompt và model
+        """
+        digest = hashlib.sha256()
+        for part in (image_bytes, prompt.encode("utf-8"), model.encode("utf-8")):
+            digest.update(hashlib.sha256(part).digest())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Lấy mô tả đã cache (None nếu chưa có)
+        """
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT description FROM descriptions WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, description):
+        """
+        Lưu mô tả vào cache
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO descriptions (key, description) VALUES (?, ?)",
+                (key, description)
+            )
+            conn.commit()
+
+    def find_similar(self, phash):
+        """
+        Tìm mô tả của ảnh gần giống (theo perceptual hash) trong lần chạy này
+        """
+        with self._lock:
+            self._connection()
+            for seen_hash, description in self._seen:
+                if (seen_hash ^ phash).bit_count() <= self.phash_threshold:
+                    return description
+        return None
+
+    def remember(self, phash, description):
+        """
+        Ghi nhớ perceptual hash của ảnh vừa phân tích (chỉ trong lần chạy này)
+        """
+        with self._lock:
+            self._connection()
+            self._seen.append((phash, description))
+
+    def record(self, status):
+        """
+        Ghi nhận kết quả tra cache: "hit", "dedup" hoặc "miss"
+        """
+        with self._lock:
+            self._stats[status] += 1
+
+    def reset_stats(self):
+        """Đặt lại bộ đếm hit/miss"""
+        self._stats = {"hit": 0, "dedup": 0, "miss": 0}
+
+    def stats(self):
+        """
+        Returns:
+            stats: Dict {"hit", "dedup", "miss"}
+        """
+        return dict(self._stats)
+
+
+def normalize_question(question):
+    """
+    Chuẩn hóa câu hỏi để so khớp chính xác
+
+    - Unicode NFC (dấu tiếng Việt dựng sẵn hay tổ hợp đều như nhau)
+    - Không phân biệt hoa/thường, gộp khoảng trắng
+    - Bỏ dấu câu / khoảng trắng ở cuối ("là gì?" = "là gì ?" = "là gì")
+    """
+    text = unicodedata.normalize("NFC", question).casefold()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip(" ?.!…;:,\"'")
+
+
+class ResponseCache:
+    """
+    Cache câu trả lời theo câu hỏi đã chuẩn hóa (khớp chính xác)
+
+    Đặt trước SemanticAnswerCache: câu hỏi lặp lại (câu ví dụ trong lời chào,
+    đề thi copy-paste) được trả lời bằng một lần tra dict, không gọi embedding
+    model, vector store hay Claude.
+
+    - LRU giới hạn max_entries, TTL
+    - Tùy chọn lưu xuống SQLite (persist=True) để giữ qua các lần restart
+    - Tự xóa khi index được build lại (index_version_fn đổi giá trị)
+    """
+
+    def __init__(self, max_entries=2000, ttl=24 * 3600, persist=False, path=None,
+                 index_version_fn=None):
+        """
+        Args:
+            max_entries: Số câu trả lời tối đa (LRU)
+            ttl: Thời gian sống của một câu trả lời (giây)
+            persist: True = lưu xuống đĩa
+            path: File SQLite (mặc định: .cache/response_cache.sqlite3)
+            index_version_fn: Hàm trả về phiên bản hiện tại của index
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_version_fn = index_version_fn
+        self.path = (path or os.path.join(CACHE_DIR, "response_cache.sqlite3")) if persist else None
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {key: (answer, sources, created)}
+        self._conn = None
+        self._index_version = index_version_fn() if index_version_fn else None
+        self.reset_stats()
+        if self.path:
+            self._load()
+
+    def _load(self):
+        """Đọc các câu trả lời đã lưu (bỏ qua nếu index đã đổi từ lúc lưu)"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Nhiều worker (app/asgi) dùng chung file → WAL + chờ khóa thay vì lỗi "database is locked"
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT NOT NULL, "
+            "sources TEXT NOT NULL, created REAL NOT NULL, index_version TEXT)"
+        )
+        self._conn.execute(
+            "DELETE FROM responses WHERE created < ? OR index_version IS NOT ?",
+            (time.time() - self.ttl, json.dumps(self._index_version))
+        )
+        self._conn.commit()
+        rows = self._conn.execute(
+            "SELECT key, answer, sources, created FROM responses ORDER BY created DESC LIMIT ?",
+            (self.max_entries,)
+        ).fetchall()
+        for key, answer, sources, created in reversed(rows):
+            self._entries[key] = (answer, json.loads(sources), created)
+
+    def _check_index_version(self):
+        """Xóa toàn bộ cache nếu index đã được build lại"""
+        if self.index_version_fn is None:
+            return
+        version = self.index_version_fn()
+        if version != self._index_version:
+            if self._entries:
+                self._stats["invalidations"] += 1
+            self._entries.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.commit()
+            self._index_version = version
+
+    def _delete(self, key):
+        del self._entries[key]
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def lookup(self, question):
+        """
+        Returns:
+            Dict {'answer', 'sources'} hoặc None
+        """
+        key = normalize_question(question)
+        with self._lock:
+            self._check_index_version()
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.time() - self.ttl:
+                self._delete(key)
+                if self._conn is not None:
+                    self._conn.commit()
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return {"answer": entry[0], "sources": entry[1]}
+
+    def store(self, question, answer, sources):
+        """
+        Lưu câu trả lời (loại mục dùng lâu nhất khi vượt max_entries)
+        """
+        key = normalize_question(question)
+        created = time.time()
+        with self._lock:
+            self._check_index_version()
+            self._entries[key] = (answer, sources, created)
+            self._entries.move_to_end(key)
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, answer, json.dumps(sources, ensure_ascii=False), created,
+                     json.dumps(self._index_version))
+                )
+            while len(self._entries) > self.max_entries:
+                self._delete(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+            if self._conn is not None:
+                self._conn.commit()
+
+    def clear(self):
+        """Xóa toàn bộ câu trả lời đã cache"""
+        with self._lock:
+            self._entries.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.commit()
+
+    def reset_stats(self):
+        """Đặt lại bộ đếm"""
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def stats(self):
+        """
+        Returns:
+            stats: Dict {"hits", "misses", "hit_rate", "entries", "evictions", "invalidations"}
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
+
+
+class SemanticAnswerCache:
+    """
+    Cache câu trả lời của /api/ask theo ngữ nghĩa câu hỏi
+
+    - Câu hỏi mới được so cosine với các câu hỏi đã trả lời; nếu vượt
+      threshold → trả lại answer + sources cũ, bỏ qua retrieval và Claude
+    - Dùng embed_query của chính embedding model retrieval (CachedEmbeddings
+      giữ query embedding trong RAM → retrieval sau đó không phải encode lại)
+    - TTL + LRU giới hạn số mục; tự xóa khi index được build lại
+      (index_version_fn trả về giá trị khác lần trước)
+    """
+
+    def __init__(self, embeddings, threshold=0.9, max_entries=1000, ttl=24 * 3600,
+                 index_version_fn=None):
+        """
+        Args:
+            embeddings: Embedding model (có embed_query)
+            threshold: Cosine tối thiểu để coi hai câu hỏi là một
+            max_entries: Số câu trả lời tối đa (LRU)
+            ttl: Thời gian sống của một câu trả lời (giây)
+            index_version_fn: Hàm trả về phiên bản hiện tại của index
+        """
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_version_fn = index_version_fn
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # {câu hỏi: {'vector', 'answer', 'sources', 'created'}}
+        self._matrix = None  # Ma trận vector của _entries (tạo lại khi _entries đổi)
+        self._keys = []
+        self._index_version = index_version_fn() if index_version_fn else None
+        self.reset_stats()
+
+    def _embed(self, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _check_index_version(self):
+        """Xóa toàn bộ cache nếu index đã được build lại"""
+        if self.index_version_fn is None:
+            return
+        version = self.index_version_fn()
+        if version != self._index_version:
+            if self._entries:
+                self._stats["invalidations"] += 1
+            self._entries.clear()
+            self._matrix = None
+            self._index_version = version
+
+    def _expire(self):
+        """Xóa các mục quá TTL (mục cũ nhất nằm đầu OrderedDict theo thời gian dùng)"""
+        deadline = time.time() - self.ttl
+        expired = [q for q, entry in self._entries.items() if entry["created"] < deadline]
+        for question in expired:
+            del self._entries[question]
+        if expired:
+            self._matrix = None
+
+    def lookup(self, question):
+        """
+        Tìm câu trả lời của câu hỏi tương tự
+
+        Returns:
+            Dict {'answer', 'sources', 'question', 'similarity'} hoặc None
+        """
+        vector = self._embed(question)
+        with self._lock:
+            self._check_index_version()
+            self._expire()
+            if self._entries:
+                if self._matrix is None:
+                    self._keys = list(self._entries)
+                    self._matrix = np.stack([self._entries[q]["vector"] for q in self._keys])
+                scores = self._matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    matched = self._keys[best]
+                    entry = self._entries[matched]
+                    self._entries.move_to_end(matched)
+                    self._stats["hits"] += 1
+                    return {
+                        "answer": entry["answer"],
+                        "sources": entry["sources"],
+                        "question": matched,
+                        "similarity": float(scores[best]),
+                    }
+            self._stats["misses"] += 1
+        return None
+
+    def store(self, question, answer, sources):
+        """
+        Lưu câu trả lời (loại mục dùng lâu nhất khi vượt max_entries)
+        """
+        vector = self._embed(question)
+        with self._lock:
+            self._check_index_version()
+            self._entries[question] = {
+                "vector": vector,
+                "answer": answer,
+                "sources": sources,
+                "created": time.time(),
+            }
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+            self._matrix = None
+
+    def clear(self):
+        """Xóa toàn bộ câu trả lời đã cache"""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def reset_stats(self):
+        """Đặt lại bộ đếm"""
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def stats(self):
+        """
+        Returns:
+            stats: Dict {"hits", "misses", "hit_rate", "entries", "evictions", "invalidations"}
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
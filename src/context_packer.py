@@ -0,0 +1,182 @@
+"""
+Đóng gói các chunk tìm được thành {context} của prompt trong giới hạn token
+
+Chunk liền kề của cùng một file (chunk_id i và i + 1) chồng lấp nhau tối đa
+CHUNK_OVERLAP token của embedding model (iter_chunks đếm bằng WordTokenCounter,
+phần chồng lấp gồm các từ nguyên vẹn) → gửi nguyên các chunk thì phần trùng bị
+tính token hai lần ở mỗi câu trả lời. pack_documents:
+- Bỏ chunk trùng (cùng source + chunk_id, hoặc cùng nội dung)
+- Ghép các chunk liền kề của cùng file thành một đoạn, cắt phần chồng lấp
+- Lấy chunk theo thứ tự liên quan (thứ tự retriever trả về) tới khi hết token_budget
+
+reciprocal_rank_fusion gộp nhiều danh sách kết quả tìm kiếm (hybrid search,
+kết quả tìm trước theo câu hỏi gốc) trước khi đóng gói.
+"""
+
+import heapq
+from langchain_core.documents import Document
+
+
+# Ước lượng số ký tự / token của Claude với tiếng Việt có dấu (không gọi API đếm token)
+CHARS_PER_TOKEN = 3
+
+# Dấu nối hai chunk liền kề không chồng lấp
+CHUNK_JOINER = "\n"
+
+# Số từ tối thiểu của phần chồng lấp: đoạn trùng ngắn hơn (vd. "n" ở cuối chunk này
+# và đầu "nhân" ở chunk sau) là trùng ngẫu nhiên, ghép vào sẽ dính chữ
+MIN_OVERLAP_WORDS = 3
+
+# Tên custom callback event báo kết quả đóng gói (PromptUsageHandler ghi vào usage)
+CONTEXT_PACKED_EVENT = "context_packed"
+
+
+def estimate_tokens(text):
+    """Ước lượng số token của text"""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def overlap_length(left, right, min_words=MIN_OVERLAP_WORDS):
+    """
+    Độ dài đoạn dài nhất vừa là phần cuối của `left` vừa là phần đầu của `right`
+
+    Chỉ tính đoạn gồm các từ nguyên vẹn (bắt đầu / kết thúc ở ranh giới khoảng
+    trắng ở cả hai chunk) và có ít nhất min_words từ, ngược lại trả về 0
+    """
+    for length in range(min(len(left), len(right)), 0, -1):
+        if not left.endswith(right[:length]):
+            continue
+        start = len(left) - length
+        starts_at_word = start == 0 or left[start - 1].isspace()
+        ends_at_word = length == len(right) or right[length].isspace()
+        if starts_at_word and ends_at_word and len(right[:length].split()) >= min_words:
+            return length
+    return 0
+
+
+def _chunk_key(doc):
+    """(source, chunk_id) của chunk, None nếu metadata không có"""
+    source = doc.metadata.get("source")
+    chunk_id = doc.metadata.get("chunk_id")
+    if source is None or chunk_id is None:
+        return None
+    return source, int(chunk_id)
+
+
+def reciprocal_rank_fusion(result_lists, k, rrf_k=60, weights=None):
+    """
+    Gộp nhiều danh sách kết quả theo Reciprocal Rank Fusion
+
+    Điểm của chunk = tổng weight / (rrf_k + thứ hạng) ở từng danh sách → không
+    cần đưa cosine và điểm BM25 (khác thang đo) về cùng khoảng.
+
+    Args:
+        result_lists: List các list Document (mỗi list xếp theo độ liên quan)
+        k: Số Document trả về
+        rrf_k: Hằng số làm mượt thứ hạng
+        weights: Trọng số của từng danh sách (mặc định bằng nhau)
+
+    Returns:
+        docs: List k Document có điểm cao nhất
+    """
+    weights = weights or [1.0] * len(result_lists)
+    scores = {}
+    docs = {}
+    for weight, results in zip(weights, result_lists):
+        for rank, doc in enumerate(results):
+            key = _chunk_key(doc) or doc.page_content
+            scores[key] = scores.get(key, 0.0) + weight / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+    best = heapq.nlargest(k, scores, key=scores.get)
+    return [docs[key] for key in best]
+
+
+def _new_text(text, key, selected):
+    """
+    Phần text thêm vào context khi chọn chunk: text chưa có trong các chunk liền kề
+    đã chọn, cộng dấu nối CHUNK_JOINER ở phía không chồng lấp (xem _merge_run)
+    """
+    if key is None:
+        return text
+    source, chunk_id = key
+    left = selected.get((source, chunk_id - 1))
+    right = selected.get((source, chunk_id + 1))
+    start = overlap_length(left[1].page_content, text) if left else 0
+    right_overlap = overlap_length(text, right[1].page_content) if right else 0
+    new_text = text[start:max(start, len(text) - right_overlap)]
+    if left and not start:
+        new_text = CHUNK_JOINER + new_text
+    if right and not right_overlap:
+        new_text += CHUNK_JOINER
+    return new_text
+
+
+def _merge_run(run):
+    """Ghép các chunk liền kề [(rank, Document)] (đã sắp theo chunk_id) thành một Document"""
+    first, last = run[0][1], run[-1][1]
+    parts = [first.page_content]
+    for (_, prev), (_, doc) in zip(run, run[1:]):
+        overlap = overlap_length(prev.page_content, doc.page_content)
+        parts.append(doc.page_content[overlap:] if overlap else CHUNK_JOINER + doc.page_content)
+
+    metadata = dict(first.metadata)
+    if len(run) > 1:
+        metadata["chunk_end"] = last.metadata.get("chunk_id")
+        if "page_end" in last.metadata:
+            metadata["page_end"] = last.metadata["page_end"]
+    return Document(page_content="".join(parts), metadata=metadata)
+
+
+def pack_documents(documents, token_budget=None):
+    """
+    Gộp chunk trùng / chồng lấp và cắt theo giới hạn token
+
+    Args:
+        documents: List Document theo thứ tự liên quan giảm dần (kết quả retriever)
+        token_budget: Số token tối đa của context (None hoặc 0 = không giới hạn)
+
+    Returns:
+        (packed, stats): packed = List Document đã ghép, xếp theo chunk liên quan
+            nhất trong mỗi đoạn; stats = Dict {"chunks", "packed_chunks", "dropped",
+            "tokens_before", "tokens", "tokens_saved"}
+    """
+    selected = {}  # {(source, chunk_id) hoặc (None, rank): (rank, Document)}
+    seen_texts = set()
+    used = dropped = 0
+    for rank, doc in enumerate(documents):
+        key = _chunk_key(doc)
+        if key in selected or doc.page_content in seen_texts:
+            continue
+        cost = estimate_tokens(_new_text(doc.page_content, key, selected))
+        if token_budget and used + cost > token_budget:
+            dropped += 1
+            continue
+        used += cost
+        seen_texts.add(doc.page_content)
+        selected[key if key is not None else (None, rank)] = (rank, doc)
+
+    # Chia các chunk đã chọn thành các dãy chunk_id liên tiếp của cùng file
+    runs = []
+    for key in sorted(selected, key=lambda k: (k[0] is None, str(k[0]), k[1])):
+        source, chunk_id = key
+        if (source is not None and runs and runs[-1][0] == source
+                and runs[-1][1] == chunk_id - 1):
+            runs[-1][1] = chunk_id
+            runs[-1][2].append(selected[key])
+        else:
+            runs.append([source, chunk_id, [selected[key]]])
+    runs.sort(key=lambda run: min(rank for rank, _ in run[2]))
+    packed = [_merge_run(chunks) for _, _, chunks in runs]
+
+    tokens_before = sum(estimate_tokens(doc.page_content) for doc in documents)
+    tokens = sum(estimate_tokens(doc.page_content) for doc in packed)
+    stats = {
+        "chunks": len(documents),
+        "packed_chunks": len(packed),
+        "dropped": dropped,
+        "tokens_before": tokens_before,
+        "tokens": tokens,
+        # Chunk liền kề không chồng lấp: dấu nối làm context dài hơn vài ký tự
+        "tokens_saved": max(0, tokens_before - tokens),
+    }
+    return packed, stats
@@ -0,0 +1,403 @@
+"""
+Các lớp bọc embedding model
+Bao gồm: Cache embedding trên đĩa (float16, memory-mapped), backend suy luận
+tối ưu cho CPU (int8 dynamic quantization, ONNX Runtime), batching theo
+ngân sách token
+"""
+
+import os
+import re
+import json
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from src.cache import CACHE_DIR, file_lock
+
+
+# Backend suy luận hỗ trợ cho HuggingFaceEmbeddings
+# - "torch": PyTorch fp32 (mặc định)
+# - "int8": PyTorch + dynamic int8 quantization cho các lớp Linear
+# - "onnx": ONNX Runtime (cài thêm: pip install optimum[onnxruntime])
+EMBEDDING_BACKENDS = ("torch", "int8", "onnx")
+
+
+def backend_model_kwargs(backend):
+    """
+    model_kwargs bổ sung cho SentenceTransformer theo backend
+
+    Args:
+        backend: Một trong EMBEDDING_BACKENDS
+
+    Returns:
+        kwargs: Dict truyền thêm vào model_kwargs của HuggingFaceEmbeddings
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Backend không hợp lệ: {backend} (chọn {EMBEDDING_BACKENDS})")
+    if backend == "onnx":
+        # SentenceTransformer tự export model sang ONNX nếu hub chưa có file .onnx
+        return {"backend": "onnx"}
+    return {}
+
+
+def quantize_int8(hf_embeddings):
+    """
+    Dynamic int8 quantization cho các lớp Linear của transformer (chỉ CPU)
+
+    Trọng số Linear được lưu int8, activation được quantize lúc chạy → giảm
+    latency và bộ nhớ, vector gần như trùng với fp32 (xem src/benchmark.py).
+
+    Args:
+        hf_embeddings: HuggingFaceEmbeddings dùng backend PyTorch
+
+    Returns:
+        hf_embeddings: Chính object đó, model đã được quantize
+    """
+    import torch
+
+    transformer = hf_embeddings.client[0]
+    transformer.auto_model = torch.quantization.quantize_dynamic(
+        transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return hf_embeddings
+
+
+class TokenBudgetEmbeddings(Embeddings):
+    """
+    Embed theo batch được xếp theo độ dài token, kích thước batch theo ngân sách token
+
+    Batch cố định (batch_size=32) theo thứ tự đầu vào làm chunk ngắn (header,
+    cuối trang) bị pad tới độ dài chunk dài nhất trong batch. Lớp này:
+    1. Đếm token của tất cả text bằng một lần tokenize theo batch
+    2. Sắp xếp theo độ dài giảm dần → các text dài gần bằng nhau nằm chung batch
+    3. Gom batch sao cho (số text × độ dài dài nhất) ≤ token_budget
+    4. Trả vector về đúng thứ tự đầu vào
+    """
+
+    def __init__(self, hf_embeddings, token_budget=8192, max_batch_size=256):
+        """
+        Args:
+            hf_embeddings: HuggingFaceEmbeddings (dùng client SentenceTransformer)
+            token_budget: Số token tối đa (kể cả padding) trong một batch
+            max_batch_size: Số text tối đa trong một batch
+        """
+        self.underlying = hf_embeddings
+        self.token_budget = token_budget
+        self.max_batch_size = max_batch_size
+        self.last_stats = {}
+
+    @property
+    def model_name(self):
+        return self.underlying.model_name
+
+    @property
+    def encode_kwargs(self):
+        return self.underlying.encode_kwargs
+
+    def count_tokens(self, texts):
+        """
+        Đếm số token (đã cắt theo max_seq_length) của từng text
+
+        Args:
+            texts: List text
+
+        Returns:
+            lengths: np.array số token
+        """
+        client = self.underlying.client
+        encoded = client.tokenizer(
+            texts,
+            truncation=True,
+            max_length=client.max_seq_length,
+            return_length=True,
+            return_attention_mask=False,
+        )
+        return np.asarray(encoded["length"])
+
+    def _make_batches(self, lengths):
+        """Chia index (đã sắp theo độ dài giảm dần) thành các batch theo ngân sách token"""
+        order = np.argsort(-lengths, kind="stable")
+        batches = []
+        batch = []
+        batch_max_len = 0
+        for idx in order:
+            # Text đầu tiên của batch là dài nhất → quyết định độ dài padding
+            max_len = batch_max_len or int(lengths[idx])
+            if batch and ((len(batch) + 1) * max_len > self.token_budget
+                          or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch = []
+                max_len = int(lengths[idx])
+            batch.append(int(idx))
+            batch_max_len = max_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed_documents(self, texts):
+        """
+        Embed list text theo batch xếp theo độ dài, trả về đúng thứ tự đầu vào
+        """
+        if not texts:
+            return []
+
+        # Giống HuggingFaceEmbeddings: thay xuống dòng bằng dấu cách
+        texts = [text.replace("\n", " ") for text in texts]
+        start = time.perf_counter()
+
+        lengths = self.count_tokens(texts)
+        encode_kwargs = {k: v for k, v in self.encode_kwargs.items() if k != "batch_size"}
+
+        vectors = None
+        padded_tokens = 0
+        for batch in self._make_batches(lengths):
+            batch_vectors = self.underlying.client.encode(
+                [texts[i] for i in batch],
+                batch_size=len(batch),
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                **encode_kwargs
+            )
+            if vectors is None:
+                vectors = np.zeros((len(texts), batch_vectors.shape[1]), dtype=np.float32)
+            vectors[batch] = batch_vectors
+            padded_tokens += len(batch) * int(lengths[batch[0]])
+
+        elapsed = time.perf_counter() - start
+        self.last_stats = {
+            "texts": len(texts),
+            "tokens": int(lengths.sum()),
+            "padded_tokens": padded_tokens,
+            "elapsed": elapsed,
+            "tokens_per_sec": int(lengths.sum()) / elapsed if elapsed > 0 else 0.0,
+        }
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.underlying.embed_query(text)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Cache embedding trên đĩa, bọc quanh một embedding model bất kỳ
+
+    - Key = (model name, normalize) → thư mục riêng, + sha256(text) → dòng
+    - Vector lưu float16 trong file nhị phân append-only, đọc bằng np.memmap
+      (`vectors.f16`), file `index.txt` lưu "hash dòng" của từng vector (file cũ:
+      chỉ hash, dòng thứ i của index = dòng thứ i của vectors)
+    - Nhiều process ghi chung thư mục (asgi.py, upload_to_pinecone.py): ghi thêm
+      dưới file khóa `.lock`, đọc lại index.txt trước khi ghi, không cắt file
+    - Chỉ text chưa có trong cache mới được encode bằng model gốc
+    - Query embedding được cache trong RAM (LRU) để các bước dùng lại
+    """
+
+    def __init__(self, underlying, model_name, normalize=True, cache_dir=None,
+                 query_cache_size=256):
+        """
+        Args:
+            underlying: Embedding model gốc (HuggingFaceEmbeddings, ...)
+            model_name: Tên model (phần của key cache)
+            normalize: Model có normalize vector không (phần của key cache)
+            cache_dir: Thư mục cache (mặc định: .cache/embeddings)
+            query_cache_size: Số query embedding giữ trong RAM
+        """
+        self.underlying = underlying
+        self.model_name = model_name
+        self.normalize = normalize
+        self.query_cache_size = query_cache_size
+
+        slug = re.sub(r"[^A-Za-z0-9._-]+", "_", model_name)
+        suffix = "norm" if normalize else "raw"
+        self.directory = os.path.join(cache_dir or os.path.join(CACHE_DIR, "embeddings"),
+                                      f"{slug}-{suffix}")
+        self._vectors_path = os.path.join(self.directory, "vectors.f16")
+        self._index_path = os.path.join(self.directory, "index.txt")
+        self._meta_path = os.path.join(self.directory, "meta.json")
+        self._lock_path = os.path.join(self.directory, ".lock")
+
+        self._lock = threading.Lock()
+        self._rows = {}  # {text_hash: row}
+        self._num_rows = 0  # Số dòng vector đầy đủ trong vectors.f16
+        self._dim = None
+        self._vectors = None  # np.memmap, mở lại sau mỗi lần append
+        self._query_cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        """Đọc index và metadata của cache (nếu có, không sửa file)"""
+        if not os.path.exists(self._meta_path):
+            return
+
+        with open(self._meta_path, "r", encoding="utf-8") as f:
+            self._dim = json.load(f)["dim"]
+        self._rows, self._num_rows = self._read_index()
+
+    def _read_index(self):
+        """
+        Đọc index.txt
+
+        Vector ghi trước index → chỉ tin dòng index đã ghi xong và trỏ tới dòng
+        vector đã có đủ trên đĩa (lần ghi bị ngắt để lại phần thừa không được trỏ tới)
+
+        Returns:
+            (rows, num_rows): {text_hash: row}, số dòng vector đầy đủ
+        """
+        num_rows = 0
+        if os.path.exists(self._vectors_path):
+            num_rows = os.path.getsize(self._vectors_path) // (self._dim * 2)
+        rows = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r", encoding="ascii") as f:
+                for line_no, line in enumerate(f):
+                    parts = line.split()
+                    # Bỏ dòng ghi dở (kể cả dòng đã được xuống dòng ở lần ghi sau)
+                    if not line.endswith("\n") or not parts or len(parts[0]) != 64:
+                        continue
+                    row = int(parts[1]) if len(parts) > 1 else line_no
+                    if row < num_rows:
+                        rows[parts[0]] = row
+        return rows, num_rows
+
+    def _matrix(self):
+        """Memory-map toàn bộ vector đã cache (shape: [num_rows, dim])"""
+        if self._vectors is None or self._vectors.shape[0] != self._num_rows:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float16,
+                                      mode="r", shape=(self._num_rows, self._dim))
+        return self._vectors
+
+    def _append(self, hashes, vectors):
+        """
+        Ghi thêm vector mới vào cuối cache (giữ file khóa giữa các process)
+
+        Returns:
+            hashes: Các hash thực sự được ghi (bỏ text process khác vừa ghi)
+        """
+        vectors = np.asarray(vectors, dtype=np.float16)
+        with file_lock(self._lock_path):
+            if self._dim is None and os.path.exists(self._meta_path):
+                self._load()  # Process khác vừa tạo cache
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model_name": self.model_name, "normalize": self.normalize,
+                               "dim": self._dim}, f)
+
+            # Dòng process khác đã ghi từ lần đọc trước
+            self._rows, _ = self._read_index()
+            fresh = [i for i, text_hash in enumerate(hashes) if text_hash not in self._rows]
+            if not fresh:
+                return []
+            hashes = [hashes[i] for i in fresh]
+
+            # Đóng memmap trước khi ghi (Windows không cho ghi file đang được map)
+            self._vectors = None
+            row_bytes = self._dim * 2
+            with open(self._vectors_path, "ab") as f:
+                size = f.seek(0, os.SEEK_END)
+                # Dòng ghi dở của lần trước bị ngắt: bù 0 cho đủ dòng (không được index trỏ tới)
+                if size % row_bytes:
+                    f.write(b"\0" * (row_bytes - size % row_bytes))
+                start = -(-size // row_bytes)
+                f.write(vectors[fresh].tobytes())
+            lines = "".join(f"{text_hash} {start + i}\n" for i, text_hash in enumerate(hashes))
+            with open(self._index_path, "a+b") as f:
+                size = f.seek(0, os.SEEK_END)
+                if size:
+                    f.seek(size - 1)
+                    if f.read(1) != b"\n":
+                        lines = "\n" + lines  # Dòng ghi dở → không dính vào dòng mới
+                f.write(lines.encode("ascii"))
+
+            for i, text_hash in enumerate(hashes):
+                self._rows[text_hash] = start + i
+            self._num_rows = start + len(hashes)
+        return hashes
+
+    @staticmethod
+    def _hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_cached(self, texts):
+        """
+        Lấy vector đã cache cho các text (không gọi model)
+
+        Args:
+            texts: List text
+
+        Returns:
+            (vectors, found): Ma trận float32 [len(texts), dim] và mảng bool
+                cho biết text nào có trong cache (dòng không có = 0)
+        """
+        hashes = [self._hash(text) for text in texts]
+        with self._lock:
+            if self._dim is None:
+                return np.zeros((len(texts), 0), dtype=np.float32), np.zeros(len(texts), dtype=bool)
+            rows = [self._rows.get(text_hash, -1) for text_hash in hashes]
+            found = np.array([row >= 0 for row in rows], dtype=bool)
+            vectors = np.zeros((len(texts), self._dim), dtype=np.float32)
+            if found.any():
+                vectors[found] = self._matrix()[[row for row in rows if row >= 0]]
+        return vectors, found
+
+    def embed_documents(self, texts):
+        """
+        Embed list text, chỉ encode text chưa có trong cache
+
+        Args:
+            texts: List text
+
+        Returns:
+            embeddings: List vector (float, đã qua float16)
+        """
+        if not texts:
+            return []
+        hashes = [self._hash(text) for text in texts]
+
+        with self._lock:
+            missing = OrderedDict()
+            for text_hash, text in zip(hashes, texts):
+                if text_hash not in self._rows and text_hash not in missing:
+                    missing[text_hash] = text
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+
+        if missing:
+            new_vectors = self.underlying.embed_documents(list(missing.values()))
+            with self._lock:
+                # Thread khác có thể đã thêm cùng text trong lúc encode
+                fresh = [(h, v) for h, v in zip(missing, new_vectors) if h not in self._rows]
+                if fresh:
+                    self._append([h for h, _ in fresh], [v for _, v in fresh])
+
+        with self._lock:
+            matrix = self._matrix()
+            return matrix[[self._rows[text_hash] for text_hash in hashes]].astype(np.float32).tolist()
+
+    def embed_query(self, text):
+        """
+        Embed câu hỏi (cache LRU trong RAM)
+        """
+        with self._lock:
+            if text in self._query_cache:
+                self._query_cache.move_to_end(text)
+                return self._query_cache[text]
+
+        vector = self.underlying.embed_query(text)
+
+        with self._lock:
+            self._query_cache[text] = vector
+            if len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return vector
+
+    def stats(self):
+        """
+        Returns:
+            stats: Dict {'hits', 'misses', 'cached'}
+        """
+        return {"hits": self.hits, "misses": self.misses, "cached": len(self._rows)}
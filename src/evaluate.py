@@ -2,7 +2,7 @@
 Script đánh giá chất lượng chatbot RAG với bộ câu hỏi chuẩn
 """
 
-from src.helper import create_chatbot, create_embeddings
+from src.helper import create_chatbot, create_embeddings, load_vector_store, VECTOR_BACKEND
 from anthropic import Anthropic
 import json
 from datetime import datetime
@@ -396,21 +396,18 @@ def run_evaluation(use_llm_judge=False):
     print("\n📚 Đang tải embeddings...")
     embeddings = create_embeddings()
     
-    print("🔗 Đang kết nối với Pinecone...")
-    from langchain_pinecone import PineconeVectorStore
-    from src.prompt import prompt_template
+    print(f"🔗 Đang kết nối với vector store ({VECTOR_BACKEND})...")
+    from src.prompt import question_prompt, system_prompt
     
-    vector_store = PineconeVectorStore(
-        index_name="studychatbot",
-        embedding=embeddings
-    )
+    vector_store = load_vector_store(embeddings, "studychatbot")
     
     print("🤖 Đang tạo chatbot với MMR...")
     qa_chain = create_chatbot(
         vector_store=vector_store,
-        prompt_template=prompt_template,
+        prompt_template=question_prompt,
         use_memory=True,
-        retrieval_mode="mmr"
+        retrieval_mode="mmr",
+        system_prompt=system_prompt  # Phần cố định được Claude cache giữa các câu hỏi
     )
     
     results = []
@@ -0,0 +1,235 @@
+"""
+Server giả lập data plane của Pinecone (REST) chạy local, lưu vector trong RAM
+
+Dùng để chạy thử upload_to_pinecone.py và CachedVectorPineconeStore không cần
+tài khoản Pinecone: đặt PINECONE_HOST=http://localhost:5081 (xem .env.example).
+Hỗ trợ các endpoint project dùng: upsert, query (kèm filter $eq/$ne/$in/$nin),
+fetch, delete (theo id / delete_all), describe_index_stats. --fail-rate trả lỗi
+429 ngẫu nhiên để kiểm tra retry của pipeline ingestion.
+
+Chạy:
+    python -m src.fake_pinecone serve --port 5081
+    python -m src.fake_pinecone check                              # Server trong process
+    python -m src.fake_pinecone check --host http://localhost:5081 # Server đang chạy
+"""
+
+import random
+import hashlib
+import argparse
+import threading
+import numpy as np
+from flask import Flask, jsonify, request
+from langchain_core.embeddings import Embeddings
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from src.local_vector_store import _matches, normalize_rows, top_k_indices
+
+
+DEFAULT_PORT = 5081
+
+
+def create_app(fail_rate=0.0):
+    """
+    Tạo Flask app giả lập data plane
+
+    Args:
+        fail_rate: Tỷ lệ request upsert/query/fetch/delete trả 429 (0 = không lỗi)
+
+    Returns:
+        app: Flask app (app.config["NAMESPACES"] = {namespace: {id: (values, metadata)}})
+    """
+    app = Flask(__name__)
+    namespaces = {}
+    lock = threading.Lock()
+    app.config["NAMESPACES"] = namespaces
+
+    def namespace(name):
+        return namespaces.setdefault(name or "", {})
+
+    @app.before_request
+    def inject_failures():
+        if fail_rate and request.endpoint != "describe_index_stats" and random.random() < fail_rate:
+            return jsonify({"code": 8, "message": "Too many requests (fake)"}), 429
+
+    @app.post("/vectors/upsert")
+    def upsert():
+        body = request.get_json()
+        with lock:
+            vectors = namespace(body.get("namespace"))
+            for vector in body["vectors"]:
+                vectors[vector["id"]] = (vector["values"], vector.get("metadata") or {})
+        return jsonify({"upsertedCount": len(body["vectors"])})
+
+    @app.post("/query")
+    def query():
+        body = request.get_json()
+        with lock:
+            items = list(namespace(body.get("namespace")).items())
+        if body.get("filter"):
+            items = [(i, v) for i, v in items if _matches(v[1], body["filter"])]
+        matches = []
+        if items:
+            scores = normalize_rows([v[0] for _, v in items]) @ normalize_rows(body["vector"])
+            for row in top_k_indices(scores, body.get("topK", 10)):
+                vector_id, (values, metadata) = items[row]
+                match = {"id": vector_id, "score": float(scores[row])}
+                if body.get("includeValues"):
+                    match["values"] = values
+                if body.get("includeMetadata"):
+                    match["metadata"] = metadata
+                matches.append(match)
+        return jsonify({"matches": matches, "namespace": body.get("namespace", "")})
+
+    @app.get("/vectors/fetch")
+    def fetch():
+        name = request.args.get("namespace", "")
+        with lock:
+            vectors = namespace(name)
+            found = {
+                vector_id: {"id": vector_id, "values": vectors[vector_id][0],
+                            "metadata": vectors[vector_id][1]}
+                for vector_id in request.args.getlist("ids") if vector_id in vectors
+            }
+        return jsonify({"vectors": found, "namespace": name})
+
+    @app.post("/vectors/delete")
+    def delete():
+        body = request.get_json()
+        with lock:
+            vectors = namespace(body.get("namespace"))
+            if body.get("deleteAll"):
+                vectors.clear()
+            for vector_id in body.get("ids") or []:
+                vectors.pop(vector_id, None)
+        return jsonify({})
+
+    @app.route("/describe_index_stats", methods=["GET", "POST"])
+    def describe_index_stats():
+        with lock:
+            counts = {name: len(vectors) for name, vectors in namespaces.items() if vectors}
+            dimension = next((len(values) for vectors in namespaces.values()
+                              for values, _ in vectors.values()), 0)
+        return jsonify({
+            "namespaces": {name: {"vectorCount": count} for name, count in counts.items()},
+            "dimension": dimension,
+            "indexFullness": 0.0,
+            "totalVectorCount": sum(counts.values()),
+        })
+
+    return app
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class FakePineconeServer:
+    """
+    Chạy server giả lập trong thread nền (with FakePineconeServer() as server: server.host)
+    """
+
+    def __init__(self, port=0, fail_rate=0.0):
+        self.app = create_app(fail_rate)
+        self._server = make_server("127.0.0.1", port, self.app, threaded=True,
+                                   request_handler=_QuietRequestHandler)
+        self.host = f"http://127.0.0.1:{self._server.server_port}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._thread.join()
+
+
+class HashEmbeddings(Embeddings):
+    """Embedding giả theo hash của text (không cần tải model), cùng text → cùng vector"""
+
+    def __init__(self, dim=32):
+        self.dim = dim
+
+    def embed_query(self, text):
+        seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+        return normalize_rows(np.random.default_rng(seed).normal(size=self.dim)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def check(host, num_chunks=500):
+    """
+    Chạy open_index(), đường upsert (run_ingestion_pipeline) và đường query
+    (CachedVectorPineconeStore) của project với server tại host
+
+    Returns:
+        passed: True nếu mọi bước cho kết quả đúng
+    """
+    from src import upload_to_pinecone
+    from src.ingest_pipeline import call_with_retry, run_ingestion_pipeline
+    from src.pinecone_store import CachedVectorPineconeStore
+
+    upload_to_pinecone.PINECONE_HOST = host
+    index = upload_to_pinecone.open_index()
+    embeddings = HashEmbeddings()
+    call_with_retry(index.delete, delete_all=True, namespace="")
+
+    chunks = [
+        {"id": f"fake.pdf#{i}", "text": f"Đoạn {i}: chu kỳ bán rã của hạt nhân số {i}",
+         "source": "fake.pdf", "chunk_id": i, "page": i // 10}
+        for i in range(num_chunks)
+    ]
+    stats = run_ingestion_pipeline(
+        iter(chunks), embeddings,
+        upsert_fn=lambda vectors: index.upsert(vectors=vectors, namespace=""),
+        upsert_batch_size=upload_to_pinecone.UPSERT_BATCH_SIZE,
+        upsert_workers=upload_to_pinecone.UPSERT_WORKERS,
+    )
+    total = call_with_retry(index.describe_index_stats).total_vector_count
+    print(f"Upsert: {stats['upserted']}/{num_chunks} vectors, {stats['retries']} retry, "
+          f"index có {total} vectors")
+
+    store = CachedVectorPineconeStore(index=index, embedding=embeddings, text_key="text")
+    target = chunks[42]["text"]
+    top = call_with_retry(store.similarity_search_with_score, target, k=3)
+    mmr = call_with_retry(store.max_marginal_relevance_search, target, k=4, fetch_k=20)
+    filtered = call_with_retry(store.similarity_search, target, k=3, filter={"page": {"$in": [7]}})
+    print(f"Query: top-1 {top[0][0].id} (score {top[0][1]:.3f}), "
+          f"MMR {len(mmr)} docs, filter page=7 → {[doc.id for doc in filtered]}")
+
+    call_with_retry(index.delete, ids=[chunk["id"] for chunk in chunks[:100]], namespace="")
+    remaining = call_with_retry(index.describe_index_stats).total_vector_count
+    print(f"Delete: còn {remaining} vectors")
+
+    passed = (stats["upserted"] == total == num_chunks
+              and top[0][0].id == chunks[42]["id"] and top[0][0].page_content == target
+              and mmr[0].id == chunks[42]["id"] and len(mmr) == 4
+              and filtered and all(doc.metadata["page"] == 7 for doc in filtered)
+              and remaining == num_chunks - 100)
+    print("✅ ĐẠT" if passed else "❌ CHƯA ĐẠT")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server giả lập data plane Pinecone")
+    parser.add_argument("command", choices=["serve", "check"])
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--host", help="check: URL server đang chạy (mặc định chạy server trong process)")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="Tỷ lệ request trả 429 (kiểm tra retry)")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        print(f"🔌 Fake Pinecone tại http://127.0.0.1:{args.port}")
+        create_app(args.fail_rate).run(host="127.0.0.1", port=args.port, threaded=True)
+    elif args.host:
+        raise SystemExit(0 if check(args.host) else 1)
+    else:
+        with FakePineconeServer(fail_rate=args.fail_rate) as server:
+            raise SystemExit(0 if check(server.host) else 1)
+
+
+if __name__ == "__main__":
+    main()
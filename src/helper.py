@@ -3,7 +3,19 @@ Helper functions để xử lý PDF và xây dựng chatbot
 """
 
 import os
+import re
+import atexit
+import unicodedata
+import time
 import base64
+import asyncio
+import queue
+import hashlib
+import threading
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from io import BytesIO
 from pypdf import PdfReader
 from pdf2image import convert_from_path
@@ -12,12 +24,30 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_anthropic import ChatAnthropic
 from langchain.chains import ConversationalRetrievalChain
-from langchain.prompts import PromptTemplate
-from langchain.memory import ConversationBufferMemory
-from langchain_pinecone import PineconeVectorStore
+from langchain.chains.conversational_retrieval.base import _get_chat_history
+from langchain.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.messages import SystemMessage
+from langchain.memory import ConversationBufferWindowMemory
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForChainRun,
+    BaseCallbackHandler,
+    CallbackManagerForChainRun
+)
 from pinecone import Pinecone
 from dotenv import load_dotenv
-import anthropic
+from src.cache import CACHE_DIR, VisionCache, perceptual_hash
+from src.ingest_pipeline import run_ingestion_pipeline
+from src.context_packer import CONTEXT_PACKED_EVENT, pack_documents, reciprocal_rank_fusion
+from src.vision import VisionPipeline
+from src.local_vector_store import LocalVectorStore, normalize_rows
+from src.keyword_index import BM25Index
+from src.pinecone_store import CachedVectorPineconeStore
+from src.embeddings import (
+    CachedEmbeddings,
+    TokenBudgetEmbeddings,
+    backend_model_kwargs,
+    quantize_int8
+)
 
 # Import advanced retrieval techniques
 try:
@@ -29,11 +59,150 @@ try:
     ADVANCED_RETRIEVAL_AVAILABLE = True
 except ImportError:
     ADVANCED_RETRIEVAL_AVAILABLE = False
-    print("Advanced retrieval không khả dụng (cài thêm: pip install rank-bm25 jieba)")
+    print("Advanced retrieval không khả dụng (cài thêm: pip install langchain)")
 
 # Load environment variables
 load_dotenv()
 
+# Model Claude Vision dùng để phân tích ảnh trong PDF
+VISION_MODEL = "claude-sonnet-4-5"
+
+# VisionCache dùng chung trong process (tạo lần đầu khi cần)
+_vision_cache = None
+
+# Claude Vision: số request đồng thời, tốc độ tối đa (request/phút) và số lần retry
+# (giới hạn chung cho cả lần đọc PDF, chia đều cho các process đọc song song)
+VISION_CONCURRENCY = int(os.getenv("VISION_CONCURRENCY", "4"))
+VISION_REQUESTS_PER_MINUTE = float(os.getenv("VISION_REQUESTS_PER_MINUTE", "50"))
+VISION_MAX_RETRIES = 5
+
+# Số process đang đọc PDF cùng lúc (đặt trong process con bởi _init_pdf_worker)
+_vision_processes = 1
+
+# VisionPipeline dùng chung trong process + ảnh đang chờ Claude (dedup ảnh trùng)
+_vision_pipeline = None
+_vision_lock = threading.Lock()
+_vision_inflight = {}  # {cache_key: Future}
+_vision_inflight_phash = []  # [(phash, Future)]
+
+# Vector store dùng khi serve/evaluate: "pinecone" (cloud) hoặc "local" (file memory-mapped)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone")
+# ANN index cho backend local: "flat" (quét toàn bộ), "ivf" hoặc "ivfpq" (build khi upload)
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "flat")
+# Số cụm IVF quét mỗi câu hỏi (tăng → recall cao hơn, chậm hơn)
+VECTOR_NPROBE = int(os.getenv("VECTOR_NPROBE", "8"))
+
+# Số lượt hỏi-đáp gần nhất đưa vào prompt (giữ prompt không phình theo độ dài hội thoại)
+MEMORY_WINDOW = int(os.getenv("MEMORY_WINDOW", "4"))
+
+# Model nhỏ, nhanh cho bước viết lại câu hỏi nối tiếp theo lịch sử chat
+# (để trống = dùng chung model trả lời)
+CONDENSE_MODEL = os.getenv("CONDENSE_MODEL", "")
+
+# Tìm tài liệu theo câu hỏi gốc trong lúc Claude viết lại câu hỏi nối tiếp
+# (giấu thời gian embed + query vector store sau lượt gọi LLM)
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+# Cosine tối thiểu giữa câu đã viết lại và câu gốc để dùng luôn kết quả tìm trước;
+# thấp hơn → tìm lại theo câu viết lại và gộp hai kết quả (RRF)
+SPECULATIVE_THRESHOLD = float(os.getenv("SPECULATIVE_THRESHOLD", "0.9"))
+# Trọng số RRF của kết quả tìm theo câu gốc khi gộp (kết quả theo câu viết lại = 1)
+SPECULATIVE_MERGE_WEIGHT = 0.5
+
+# Số token tối đa (ước lượng) của {context}: chunk chồng lấp được ghép lại,
+# lấy theo thứ tự liên quan tới khi đầy (0 = không giới hạn, chỉ ghép)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+
+# Dấu hiệu câu hỏi nối tiếp: đại từ / chỉ từ thay cho nội dung ở lượt trước
+# → cần viết lại câu hỏi theo lịch sử chat trước khi tìm tài liệu
+# ("như thế nào", "chúng ta" là câu hỏi bình thường, không phải chỉ từ)
+FOLLOWUP_PATTERN = re.compile(
+    r"\b(nó|chúng(?! ta\b)|đó|này|ấy|kia|vừa rồi|ở trên|phía trên|như vậy|"
+    r"như thế(?! nào\b)|thì sao)\b",
+    re.IGNORECASE
+)
+FOLLOWUP_START_PATTERN = re.compile(r"^(còn|vậy|thế|và|nhưng)\b", re.IGNORECASE)
+# Yêu cầu nói tiếp / hỏi lý do: chỉ là câu nối tiếp khi không kèm nội dung
+# ("Cho ví dụ cụ thể", "Tại sao vậy?") - "Cho ví dụ về chuyển động tròn đều",
+# "Tại sao bầu trời có màu xanh?" vẫn tự đủ nghĩa
+FOLLOWUP_REQUEST_PATTERN = re.compile(
+    r"\b(ví dụ|giải thích|nói|chi tiết|tại sao|vì sao|tiếp theo|tiếp tục)\b",
+    re.IGNORECASE
+)
+# Từ không mang nội dung khi đi kèm yêu cầu nói tiếp
+FOLLOWUP_FILLER_WORDS = frozenset(
+    "cho thêm lại rõ hơn cụ thể vài một số nữa đi được không giúp em tôi mình "
+    "hãy với nhé nhỉ ạ vậy thế về".split()
+)
+# Số từ nội dung tối thiểu để câu có yêu cầu nói tiếp vẫn tự đủ nghĩa
+MIN_FOLLOWUP_CONTENT_WORDS = 2
+# Câu hỏi quá ngắn ("Tại sao?", "Đơn vị?") coi như nối tiếp
+MIN_SELF_CONTAINED_WORDS = 4
+
+# Dấu ranh giới trang do load_pdf chèn vào text
+PAGE_MARKER_PATTERN = re.compile(r"--- Trang (\d+) ---")
+
+
+def _get_poppler_path():
+    """
+    Trả về poppler path trong project (nếu có), None = dùng Poppler trong PATH
+    """
+    # Poppler path trong project (tự động download)
+    poppler_path = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)),
+        "poppler", "poppler-24.08.0", "Library", "bin"
+    )
+    return poppler_path if os.path.exists(poppler_path) else None
+
+
+def iter_rendered_pages(file_path, first_page=0, last_page=None, window=8,
+                        thread_count=4, dpi=100):
+    """
+    Render các trang PDF thành ảnh theo từng cửa sổ trang
+    
+    Mỗi cửa sổ `window` trang được render bằng một lần gọi pdf2image với
+    `thread_count` tiến trình poppler song song, thay vì một tiến trình poppler
+    (và một lần parse lại toàn bộ PDF) cho mỗi trang. Ảnh được yield dần nên
+    bộ nhớ chỉ giữ tối đa một cửa sổ trang.
+    
+    Args:
+        file_path: Đường dẫn đến file PDF
+        first_page: Trang đầu tiên (bắt đầu từ 0)
+        last_page: Trang kết thúc (không bao gồm), None = hết file
+        window: Số trang render trong một lần gọi poppler
+        thread_count: Số tiến trình poppler chạy song song trong một cửa sổ
+        dpi: Độ phân giải render
+    
+    Yields:
+        (page_num, image): Số trang (bắt đầu từ 0) và PIL Image
+    """
+    if last_page is None:
+        last_page = _count_pdf_pages(file_path)
+    
+    poppler_path = _get_poppler_path()
+    
+    for window_start in range(first_page, last_page, window):
+        window_end = min(window_start + window, last_page)
+        try:
+            images = convert_from_path(
+                file_path,
+                first_page=window_start + 1,
+                last_page=window_end,
+                dpi=dpi,  # Giảm từ 150 → 100 DPI (giảm ~40% cost)
+                thread_count=min(thread_count, window_end - window_start),
+                poppler_path=poppler_path
+            )
+        except Exception as e:
+            print(f"Lỗi khi render trang {window_start + 1}-{window_end}: {e}")
+            print("Lưu ý: Cần cài Poppler. Xem hướng dẫn trong POPPLER_INSTALL.md")
+            continue
+        
+        images.reverse()
+        page_num = window_start
+        while images:
+            # pop() để ảnh đã yield không còn bị giữ trong list
+            yield page_num, images.pop()
+            page_num += 1
+
 
 def extract_images_from_pdf(file_path, page_num):
     """
@@ -46,61 +215,134 @@ def extract_images_from_pdf(file_path, page_num):
     Returns:
         images: List PIL Images
     """
-    try:
-        # Poppler path trong project (tự động download)
-        poppler_path = os.path.join(
-            os.path.dirname(os.path.dirname(__file__)),
-            "poppler", "poppler-24.08.0", "Library", "bin"
+    return [
+        image for _, image in iter_rendered_pages(
+            file_path, page_num, page_num + 1, window=1, thread_count=1
         )
+    ]
+
+
+def _iter_image_xobjects(resources, visited=None):
+    """
+    Duyệt các image XObject trong resources của trang (kể cả trong Form XObject)
+    
+    Args:
+        resources: Dictionary /Resources của trang hoặc Form XObject
+    
+    Yields:
+        xobject: Image XObject (stream có /Subtype /Image)
+    """
+    if visited is None:
+        visited = set()
+    if resources is None:
+        return
+    resources = resources.get_object()
+    if "/XObject" not in resources:
+        return
+    
+    xobjects = resources["/XObject"].get_object()
+    for name in xobjects:
+        ref = xobjects.raw_get(name)
+        ref_id = getattr(ref, "idnum", None)
+        if ref_id is not None:
+            if ref_id in visited:
+                continue
+            visited.add(ref_id)
         
-        images = convert_from_path(
-            file_path, 
-            first_page=page_num + 1, 
-            last_page=page_num + 1,
-            dpi=100,  # Giảm từ 150 → 100 DPI (giảm ~40% cost)
-            poppler_path=poppler_path if os.path.exists(poppler_path) else None
-        )
-        return images
-    except Exception as e:
-        print(f"Lỗi khi trích xuất ảnh từ trang {page_num}: {e}")
-        print("Lưu ý: Cần cài Poppler. Xem hướng dẫn trong POPPLER_INSTALL.md")
-        return []
+        xobject = xobjects[name].get_object()
+        subtype = xobject.get("/Subtype")
+        if subtype == "/Image":
+            yield xobject
+        elif subtype == "/Form":
+            yield from _iter_image_xobjects(xobject.get("/Resources"), visited)
 
 
-def image_to_base64(image):
+def extract_figures_from_page(page, min_side=80, min_area=20000, max_side=1024):
     """
-    Chuyển PIL Image thành base64 string để gửi đến Claude API
+    Phát hiện và trích xuất hình (figure) nhúng trong trang PDF
+    
+    Dùng resources của trang (image XObject) để tìm hình thật sự, bỏ qua
+    icon/đường kẻ nhỏ. Trang chỉ có text không có image XObject → trả về []
+    mà không cần render, và chỉ vùng hình (thay vì cả trang) được gửi cho
+    Claude Vision. Lưu ý: hình vẽ bằng lệnh vector (không phải ảnh nhúng)
+    không được phát hiện - dùng image_mode="page" cho tài liệu loại này.
+    
+    Args:
+        page: pypdf PageObject
+        min_side: Cạnh ngắn tối thiểu (pixel) để coi là hình
+        min_area: Diện tích tối thiểu (pixel) để coi là hình
+        max_side: Thu nhỏ hình có cạnh dài hơn giá trị này (giảm payload)
+    
+    Returns:
+        figures: List PIL Images
+    """
+    figures = []
+    
+    for xobject in _iter_image_xobjects(page.get("/Resources")):
+        width = int(xobject.get("/Width", 0))
+        height = int(xobject.get("/Height", 0))
+        
+        # Kiểm tra kích thước trước khi decode (rẻ)
+        if min(width, height) < min_side or width * height < min_area:
+            continue
+        
+        try:
+            image = xobject.decode_as_image()
+        except Exception as e:
+            print(f"Không decode được hình {width}x{height}: {e}")
+            continue
+        
+        if image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            image = image.convert("RGB")
+        image.thumbnail((max_side, max_side))
+        figures.append(image)
+    
+    return figures
+
+
+def image_to_png_bytes(image):
+    """
+    Chuyển PIL Image thành bytes PNG
     
     Args:
         image: PIL Image object
     
     Returns:
-        base64_str: Base64 encoded string
+        png_bytes: Nội dung ảnh dạng PNG
     """
     buffered = BytesIO()
     image.save(buffered, format="PNG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    return buffered.getvalue()
 
 
-def analyze_image_with_claude(image, context=""):
+def image_to_base64(image):
     """
-    Sử dụng Claude Vision API để phân tích hình ảnh
+    Chuyển PIL Image thành base64 string để gửi đến Claude API
     
     Args:
         image: PIL Image object
-        context: Context text xung quanh ảnh
     
     Returns:
-        description: Mô tả chi tiết về ảnh (tiếng Việt)
+        base64_str: Base64 encoded string
     """
-    try:
-        client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-        
-        # Chuyển image sang base64
-        image_base64 = image_to_base64(image)
-        
-        # Prompt cho Claude Vision (tiếng Việt)
-        prompt = f"""Bạn là trợ lý phân tích hình ảnh trong sách vật lý tiếng Việt.
+    return base64.b64encode(image_to_png_bytes(image)).decode('utf-8')
+
+
+def get_vision_cache():
+    """
+    Trả về VisionCache dùng chung (tạo lần đầu khi cần)
+    """
+    global _vision_cache
+    if _vision_cache is None:
+        _vision_cache = VisionCache()
+    return _vision_cache
+
+
+def _build_vision_prompt(context):
+    """
+    Prompt cho Claude Vision (tiếng Việt)
+    """
+    return f"""Bạn là trợ lý phân tích hình ảnh trong sách vật lý tiếng Việt.
 
 Context văn bản xung quanh: {context}
 
@@ -112,56 +354,222 @@ Hãy phân tích chi tiết hình ảnh này và mô tả bằng tiếng Việt:
 
 Trả lời ngắn gọn, súc tích, tập trung vào thông tin quan trọng."""
 
-        # Gọi Claude Vision API
-        message = client.messages.create(
-            model="claude-sonnet-4-5",
-            max_tokens=500,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/png",
-                                "data": image_base64,
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ],
-                }
-            ],
-        )
+
+def _init_pdf_worker(num_processes):
+    """Initializer của process pool đọc PDF: mỗi process nhận một phần giới hạn Vision"""
+    global _vision_processes
+    _vision_processes = num_processes
+
+
+def get_vision_pipeline():
+    """
+    Trả về VisionPipeline dùng chung (tạo lần đầu khi cần, tạo lại trong process con)
+    
+    Mỗi process nhận 1/_vision_processes của VISION_REQUESTS_PER_MINUTE và
+    VISION_CONCURRENCY → tổng các process không vượt giới hạn (iter_pdf_documents
+    dùng không quá VISION_CONCURRENCY process khi phân tích ảnh, nên mỗi process
+    có ít nhất 1 request đồng thời).
+    """
+    global _vision_pipeline
+    with _vision_lock:
+        if _vision_pipeline is None or not _vision_pipeline.alive:
+            _vision_inflight.clear()
+            _vision_inflight_phash.clear()
+            _vision_pipeline = VisionPipeline(
+                VISION_MODEL,
+                concurrency=max(1, VISION_CONCURRENCY // _vision_processes),
+                requests_per_minute=VISION_REQUESTS_PER_MINUTE / _vision_processes,
+                max_retries=VISION_MAX_RETRIES
+            )
+        return _vision_pipeline
+
+
+def _resolved(value):
+    """Future đã có kết quả (ảnh lấy từ cache)"""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def submit_image_analysis(image, context="", use_cache=True):
+    """
+    Gửi ảnh tới Claude Vision, không chờ kết quả
+    
+    Ảnh đã có trong VisionCache trả về ngay; ảnh trùng (hoặc gần giống) một ảnh
+    đang chờ Claude dùng chung request đó.
+    
+    Args:
+        image: PIL Image object
+        context: Context text xung quanh ảnh
+        use_cache: True = dùng VisionCache
+    
+    Returns:
+        future: concurrent.futures.Future → mô tả (str) hoặc lỗi
+    """
+    png_bytes = image_to_png_bytes(image)
+    prompt = _build_vision_prompt(context)
+    
+    cache = cache_key = phash = None
+    if use_cache:
+        cache = get_vision_cache()
+        cache_key = VisionCache.make_key(png_bytes, prompt, VISION_MODEL)
+        
+        description = cache.get(cache_key)
+        if description is not None:
+            cache.record("hit")
+            return _resolved(description)
         
-        return message.content[0].text
+        phash = perceptual_hash(image)
+        description = cache.find_similar(phash)
+        if description is not None:
+            cache.record("dedup")
+            cache.set(cache_key, description)
+            return _resolved(description)
+    
+    pipeline = get_vision_pipeline()
+    if use_cache:
+        with _vision_lock:
+            future = _vision_inflight.get(cache_key)
+            if future is None:
+                future = next((f for h, f in _vision_inflight_phash
+                               if (h ^ phash).bit_count() <= cache.phash_threshold), None)
+        if future is not None:
+            cache.record("dedup")
+            return future
+        cache.record("miss")
+    
+    # Có thể chờ nếu quá nhiều ảnh đang xếp hàng (giới hạn bộ nhớ)
+    future = pipeline.submit(base64.b64encode(png_bytes).decode('utf-8'), prompt)
     
+    if use_cache:
+        with _vision_lock:
+            if not future.done():
+                _vision_inflight[cache_key] = future
+                _vision_inflight_phash.append((phash, future))
+        
+        def on_done(done):
+            with _vision_lock:
+                _vision_inflight.pop(cache_key, None)
+                _vision_inflight_phash[:] = [(h, f) for h, f in _vision_inflight_phash
+                                             if f is not done]
+            if done.exception() is None:
+                cache.set(cache_key, done.result())
+                cache.remember(phash, done.result())
+        
+        future.add_done_callback(on_done)
+    return future
+
+
+def _vision_result(future):
+    """Kết quả của submit_image_analysis (None nếu lỗi)"""
+    try:
+        return future.result()
     except Exception as e:
         print(f"Lỗi khi phân tích ảnh với Claude: {e}")
         return None
 
 
-def load_all_pdfs(data_dir="data", extract_images=True):
+def analyze_image_with_claude(image, context="", use_cache=True):
     """
-    Đọc tất cả file PDF trong thư mục data (bao gồm text + hình ảnh)
+    Sử dụng Claude Vision API để phân tích hình ảnh
+    
+    Kết quả được cache trên đĩa theo (bytes ảnh, prompt, model); ảnh gần giống
+    ảnh đã phân tích trong cùng lần chạy (logo, header lặp lại) được dùng lại
+    mô tả nhờ perceptual hash.
     
     Args:
-        data_dir: Đường dẫn đến thư mục chứa PDF
-        extract_images: True = phân tích ảnh với Claude Vision
+        image: PIL Image object
+        context: Context text xung quanh ảnh
+        use_cache: True = dùng VisionCache
     
     Returns:
-        documents: List các document với text và metadata
+        description: Mô tả chi tiết về ảnh (tiếng Việt)
     """
-    documents = []
+    try:
+        return _vision_result(submit_image_analysis(image, context, use_cache))
+    except Exception as e:
+        print(f"Lỗi khi phân tích ảnh với Claude: {e}")
+        return None
+
+
+def _count_pdf_pages(file_path):
+    """
+    Đếm số trang của file PDF (trả về 0 nếu không đọc được)
+    """
+    try:
+        return len(PdfReader(file_path).pages)
+    except Exception as e:
+        print(f"Lỗi khi đọc file {file_path}: {e}")
+        return 0
+
+
+def _load_pdf_task(task):
+    """
+    Worker cho process pool: đọc một khoảng trang của một file PDF
+    
+    Args:
+        task: Tuple (file_path, first_page, last_page, extract_images, image_mode)
     
+    Returns:
+        (text, vision_stats): Nội dung text của khoảng trang
+            [first_page, last_page) và số hit/miss của VisionCache
+    """
+    file_path, first_page, last_page, extract_images, image_mode = task
+    
+    vision_cache = get_vision_cache()
+    vision_cache.reset_stats()
+    text = load_pdf(file_path, extract_images=extract_images,
+                    page_range=(first_page, last_page), image_mode=image_mode)
+    return text, vision_cache.stats()
+
+
+def _bounded_map(executor, fn, items, max_pending):
+    """
+    Giống executor.map() nhưng chỉ giữ tối đa max_pending task đang chạy/chờ
+    lấy kết quả, để bộ nhớ không tăng theo số lượng task
+    
+    Yields:
+        result: Kết quả theo đúng thứ tự items
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_pdf_documents(data_dir="data", extract_images=True, num_workers=1,
+                       pages_per_task=50, image_mode="figures", files=None):
+    """
+    Đọc lần lượt các file PDF trong thư mục data, yield từng document
+    
+    Với num_workers > 1, mỗi file (hoặc mỗi khoảng pages_per_task trang của
+    file lớn) được xử lý trong một process riêng. Kết quả được ghép lại theo
+    đúng thứ tự file/trang nên text (và chunk_id) giống hệt chế độ tuần tự.
+    Chỉ text của file đang ghép được giữ trong bộ nhớ.
+    
+    Args:
+        data_dir: Đường dẫn đến thư mục chứa PDF
+        extract_images: True = phân tích ảnh với Claude Vision
+        num_workers: Số process song song (None = số CPU, 1 = tuần tự; không
+            quá VISION_CONCURRENCY khi extract_images)
+        pages_per_task: Số trang tối đa cho mỗi task của process pool
+        image_mode: "figures" = chỉ gửi hình nhúng, "page" = gửi cả trang
+        files: List tên file cần đọc (None = tất cả PDF trong data_dir)
+    
+    Yields:
+        document: Dict {'text', 'source'}
+    """
     if not os.path.exists(data_dir):
         print(f"Thư mục {data_dir} không tồn tại!")
-        return documents
+        return
     
-    pdf_files = [f for f in os.listdir(data_dir) if f.endswith('.pdf')]
+    # Sắp xếp để thứ tự document (và chunk_id) ổn định giữa các lần chạy
+    pdf_files = sorted(f for f in os.listdir(data_dir) if f.endswith('.pdf'))
+    if files is not None:
+        pdf_files = [f for f in pdf_files if f in files]
     
     print(f"Tìm thấy {len(pdf_files)} file PDF")
     if extract_images:
@@ -169,60 +577,165 @@ def load_all_pdfs(data_dir="data", extract_images=True):
     else:
         print("Chế độ: Chỉ trích xuất TEXT")
     
-    for pdf_file in pdf_files:
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if extract_images and num_workers > VISION_CONCURRENCY:
+        # Mỗi process giữ ít nhất 1 request Vision → nhiều process hơn sẽ vượt VISION_CONCURRENCY
+        print(f"Giới hạn {VISION_CONCURRENCY} process đọc PDF (VISION_CONCURRENCY) "
+              f"thay vì {num_workers}")
+        num_workers = max(1, VISION_CONCURRENCY)
+    
+    # Chia mỗi file thành các khoảng trang
+    tasks = []
+    total_pages = 0
+    for file_idx, pdf_file in enumerate(pdf_files):
         file_path = os.path.join(data_dir, pdf_file)
-        print(f"Đang đọc: {pdf_file}...")
-        text = load_pdf(file_path, extract_images=extract_images)
+        num_pages = _count_pdf_pages(file_path)
+        total_pages += num_pages
+        for first_page in range(0, num_pages, pages_per_task):
+            last_page = min(first_page + pages_per_task, num_pages)
+            tasks.append((file_idx, (file_path, first_page, last_page,
+                                     extract_images, image_mode)))
+    
+    start_time = time.perf_counter()
+    vision_stats = {"hit": 0, "dedup": 0, "miss": 0}
+    
+    def run_tasks():
+        if num_workers > 1 and len(tasks) > 1:
+            print(f"Đang đọc {len(tasks)} khoảng trang với {num_workers} process...")
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_pdf_worker,
+                                     initargs=(num_workers,)) as executor:
+                # Kết quả theo đúng thứ tự tasks → ghép lại ổn định
+                yield from _bounded_map(executor, _load_pdf_task,
+                                        [task for _, task in tasks], 2 * num_workers)
+        else:
+            for _, task in tasks:
+                if task[1] == 0:
+                    print(f"Đang đọc: {os.path.basename(task[0])}...")
+                yield _load_pdf_task(task)
+    
+    # Ghép các khoảng trang về từng file theo thứ tự, yield khi xong một file
+    current_idx = None
+    parts = []
+    for (file_idx, _), (text, stats) in zip(tasks, run_tasks()):
+        for status, count in stats.items():
+            vision_stats[status] += count
         
-        if text:
-            documents.append({
-                'text': text,
-                'source': pdf_file
-            })
+        if file_idx != current_idx:
+            if current_idx is not None and any(parts):
+                yield {'text': "".join(parts), 'source': pdf_files[current_idx]}
+            current_idx = file_idx
+            parts = []
+        parts.append(text)
+    
+    if current_idx is not None and any(parts):
+        yield {'text': "".join(parts), 'source': pdf_files[current_idx]}
+    
+    elapsed = time.perf_counter() - start_time
+    if elapsed > 0:
+        print(f"Đã đọc {total_pages} trang trong {elapsed:.1f}s "
+              f"({total_pages / elapsed:.1f} trang/giây, {num_workers} process)")
+    if extract_images:
+        print(f"Vision cache: {vision_stats['hit']} hit, {vision_stats['dedup']} ảnh trùng, "
+              f"{vision_stats['miss']} miss (gọi API)")
+
+
+def load_all_pdfs(data_dir="data", extract_images=True, num_workers=1,
+                  pages_per_task=50, image_mode="figures", files=None):
+    """
+    Đọc tất cả file PDF trong thư mục data (bao gồm text + hình ảnh)
+    
+    Args:
+        data_dir: Đường dẫn đến thư mục chứa PDF
+        extract_images: True = phân tích ảnh với Claude Vision
+        num_workers: Số process song song (None = số CPU, 1 = tuần tự; không
+            quá VISION_CONCURRENCY khi extract_images)
+        pages_per_task: Số trang tối đa cho mỗi task của process pool
+        image_mode: "figures" = chỉ gửi hình nhúng, "page" = gửi cả trang
+        files: List tên file cần đọc (None = tất cả PDF trong data_dir)
     
-    return documents
+    Returns:
+        documents: List các document với text và metadata
+    """
+    return list(iter_pdf_documents(
+        data_dir, extract_images=extract_images, num_workers=num_workers,
+        pages_per_task=pages_per_task, image_mode=image_mode, files=files
+    ))
 
 
-def load_pdf(file_path, extract_images=True):
+def load_pdf(file_path, extract_images=True, page_range=None, image_mode="figures"):
     """
     Đọc và trích xuất text + hình ảnh từ file PDF
     
     Args:
         file_path: Đường dẫn đến file PDF
         extract_images: True = phân tích ảnh với Claude Vision
+        page_range: Tuple (first_page, last_page) bắt đầu từ 0, không gồm
+            last_page. None = toàn bộ file
+        image_mode: "figures" = chỉ gửi hình nhúng trong trang (bỏ qua trang
+            chỉ có text), "page" = render và gửi toàn bộ trang
     
     Returns:
         text: Nội dung text + mô tả hình ảnh từ PDF
     """
     try:
         reader = PdfReader(file_path)
-        full_text = ""
+        # Ghép các phần text bằng list + join (tránh += bậc hai với sách dài)
+        text_parts = []
+        # Ảnh đang chờ Claude Vision: (vị trí trong text_parts, img_idx, page_num, future)
+        pending_images = []
+        
+        first_page, last_page = page_range or (0, len(reader.pages))
         
-        for page_num, page in enumerate(reader.pages):
+        # Render ảnh theo cửa sổ trang, lấy dần theo vòng lặp text
+        rendered_pages = None
+        next_rendered = None
+        if extract_images and image_mode == "page":
+            rendered_pages = iter_rendered_pages(file_path, first_page, last_page)
+            next_rendered = next(rendered_pages, None)
+        
+        for page_num in range(first_page, last_page):
+            page = reader.pages[page_num]
             # Trích xuất text
             page_text = page.extract_text()
-            full_text += f"\n--- Trang {page_num + 1} ---\n"
-            full_text += page_text
+            text_parts.append(f"\n--- Trang {page_num + 1} ---\n")
+            text_parts.append(page_text)
             
             # Trích xuất và phân tích hình ảnh nếu được yêu cầu
-            if extract_images:
-                images = extract_images_from_pdf(file_path, page_num)
+            images = []
+            if extract_images and image_mode == "figures":
+                # Chỉ lấy hình nhúng trong trang, trang chỉ có text → []
+                images = extract_figures_from_page(page)
+            elif extract_images:
+                # Trang render lỗi sẽ không được yield → so khớp theo page_num
+                while next_rendered is not None and next_rendered[0] <= page_num:
+                    if next_rendered[0] == page_num:
+                        images.append(next_rendered[1])
+                    next_rendered = next(rendered_pages, None)
+            
+            for img_idx, image in enumerate(images):  # Xử lý TẤT CẢ ảnh
+                print(f"  Đang phân tích ảnh {img_idx + 1} trang {page_num + 1}...")
                 
-                if images:  # Chỉ xử lý nếu có ảnh
-                    for img_idx, image in enumerate(images):  # Xử lý TẤT CẢ ảnh
-                        print(f"  Đang phân tích ảnh {img_idx + 1} trang {page_num + 1}...")
-                        
-                        # Lấy context xung quanh (200 ký tự gần nhất)
-                        context = page_text[-200:] if page_text else ""
-                        
-                        # Phân tích ảnh với Claude
-                        image_description = analyze_image_with_claude(image, context)
-                        
-                        if image_description:
-                            full_text += f"\n[HÌNH ẢNH {img_idx + 1} - Trang {page_num + 1}]\n"
-                            full_text += image_description + "\n"
-        
-        return full_text
+                # Lấy context xung quanh (200 ký tự gần nhất)
+                context = page_text[-200:] if page_text else ""
+                
+                # Gửi ảnh cho Claude rồi đọc tiếp các trang sau; giữ chỗ trong
+                # text_parts để ghép mô tả đúng vị trí khi có kết quả
+                try:
+                    future = submit_image_analysis(image, context)
+                except Exception as e:
+                    print(f"Lỗi khi phân tích ảnh với Claude: {e}")
+                    continue
+                pending_images.append((len(text_parts), img_idx, page_num, future))
+                text_parts.append("")
+        
+        for position, img_idx, page_num, future in pending_images:
+            image_description = _vision_result(future)
+            if image_description:
+                text_parts[position] = (f"\n[HÌNH ẢNH {img_idx + 1} - Trang {page_num + 1}]\n"
+                                        f"{image_description}\n")
+        
+        return "".join(text_parts)
     except Exception as e:
         print(f"Lỗi khi đọc file {file_path}: {e}")
         return ""
@@ -231,54 +744,255 @@ def load_pdf(file_path, extract_images=True):
 
 
 
-def split_text_into_chunks(documents, chunk_size=1000, chunk_overlap=200):
+class WordTokenCounter:
     """
-    Chia text thành các chunks nhỏ hơn để xử lý
+    Đếm token của embedding tokenizer mà không tokenize lại cả đoạn text
+    
+    Tokenizer của PhoBERT (BPE) và MiniLM (SentencePiece) không tạo token vượt
+    qua khoảng trắng → số token của một đoạn = tổng số token của từng từ.
+    Mỗi document được tokenize một lần theo batch các từ chưa gặp, sau đó
+    length_function của text splitter chỉ còn là tra dict.
+    """
+    
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._word_lengths = {}
+    
+    def prepare(self, text):
+        """Tokenize (theo batch) các từ mới trong text"""
+        new_words = [w for w in set(text.split()) if w not in self._word_lengths]
+        if new_words:
+            encoded = self.tokenizer(new_words, add_special_tokens=False,
+                                     return_attention_mask=False)
+            for word, ids in zip(new_words, encoded["input_ids"]):
+                self._word_lengths[word] = len(ids)
+    
+    def __call__(self, text):
+        total = 0
+        for word in text.split():
+            length = self._word_lengths.get(word)
+            if length is None:
+                # Từ bị cắt giữa chừng khi splitter phải tách theo ký tự
+                length = len(self.tokenizer.tokenize(word))
+                self._word_lengths[word] = length
+            total += length
+        return total
+
+
+def get_embedding_tokenizer(embeddings):
+    """
+    Lấy tokenizer và max_seq_length của embedding model (bỏ qua các lớp bọc)
     
     Args:
-        documents: List các document
-        chunk_size: Kích thước mỗi chunk
-        chunk_overlap: Độ chồng lấp giữa các chunks
+        embeddings: Embedding model từ create_embeddings
     
     Returns:
-        chunks: List các text chunks với metadata
+        (tokenizer, max_seq_length)
+    """
+    model = embeddings
+    while not hasattr(model, 'client') and hasattr(model, 'underlying'):
+        model = model.underlying
+    return model.client.tokenizer, model.client.max_seq_length
+
+
+def _page_of(page_starts, page_numbers, offset):
+    """Số trang chứa vị trí offset (theo các dấu '--- Trang N ---')"""
+    idx = bisect_right(page_starts, offset) - 1
+    return page_numbers[max(idx, 0)] if page_numbers else None
+
+
+def iter_chunks(documents, chunk_size=1000, chunk_overlap=200, tokenizer=None,
+                token_stats=None):
+    """
+    Chia text thành các chunks, yield lần lượt (dùng cho pipeline streaming)
+    
+    Args:
+        documents: Iterable các document (có thể là generator)
+        chunk_size: Kích thước mỗi chunk (ký tự, hoặc token nếu có tokenizer)
+        chunk_overlap: Độ chồng lấp giữa các chunks (cùng đơn vị với chunk_size)
+        tokenizer: Tokenizer của embedding model. Có tokenizer → đo chunk theo
+            số token để chunk không bị cắt khi embed (max_seq_length)
+        token_stats: List (tùy chọn) để ghi số token của từng chunk
+    
+    Yields:
+        chunk: Dict {'text', 'source', 'chunk_id', 'page', 'page_end'}
     """
+    token_counter = WordTokenCounter(tokenizer) if tokenizer is not None else None
+    
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
-        length_function=len,
+        length_function=token_counter or len,
         separators=["\n\n", "\n", " ", ""]
     )
     
-    all_chunks = []
-    
     for doc in documents:
-        chunks = text_splitter.split_text(doc['text'])
-        for i, chunk in enumerate(chunks):
-            all_chunks.append({
+        text = doc['text']
+        if token_counter is not None:
+            token_counter.prepare(text)
+        
+        page_markers = [(m.start(), int(m.group(1))) for m in PAGE_MARKER_PATTERN.finditer(text)]
+        page_starts = [start for start, _ in page_markers]
+        page_numbers = [page for _, page in page_markers]
+        
+        start = 0
+        for i, chunk in enumerate(text_splitter.split_text(text)):
+            # Chunk là substring của text và nằm sau chunk trước
+            found = text.find(chunk, start)
+            if found >= 0:
+                start = found
+            
+            if token_stats is not None:
+                token_stats.append(token_counter(chunk) if token_counter else len(chunk))
+            
+            yield {
                 'text': chunk,
                 'source': doc['source'],
-                'chunk_id': i
-            })
+                'chunk_id': i,
+                'page': _page_of(page_starts, page_numbers, start),
+                'page_end': _page_of(page_starts, page_numbers, start + len(chunk) - 1)
+            }
+            start += 1
+
+
+def print_token_histogram(token_counts, max_tokens=None, num_bins=8):
+    """
+    In histogram kích thước chunk (token hoặc ký tự)
+    
+    Args:
+        token_counts: List số token của từng chunk
+        max_tokens: Giới hạn của model (để đánh dấu chunk bị cắt khi embed)
+        num_bins: Số khoảng của histogram
+    """
+    if not token_counts:
+        return
+    
+    upper = max(max(token_counts), max_tokens or 0)
+    bin_width = max(1, -(-upper // num_bins))
+    bins = [0] * num_bins
+    for count in token_counts:
+        bins[min(count // bin_width, num_bins - 1)] += 1
+    
+    print(f"Kích thước chunk: min {min(token_counts)}, "
+          f"trung bình {sum(token_counts) / len(token_counts):.0f}, max {max(token_counts)}")
+    widest = max(bins)
+    for idx, count in enumerate(bins):
+        bar = "█" * round(30 * count / widest) if widest else ""
+        print(f"  {idx * bin_width:5d}-{(idx + 1) * bin_width - 1:5d} | {bar} {count}")
+    if max_tokens:
+        truncated = sum(1 for count in token_counts if count > max_tokens)
+        print(f"  Chunk vượt {max_tokens} token (bị cắt khi embed): {truncated}")
+
+
+def split_text_into_chunks(documents, chunk_size=1000, chunk_overlap=200, tokenizer=None):
+    """
+    Chia text thành các chunks nhỏ hơn để xử lý
+    
+    Args:
+        documents: List các document
+        chunk_size: Kích thước mỗi chunk (ký tự, hoặc token nếu có tokenizer)
+        chunk_overlap: Độ chồng lấp giữa các chunks
+        tokenizer: Tokenizer của embedding model (None = đo theo ký tự)
+    
+    Returns:
+        chunks: List các text chunks với metadata
+    """
+    token_stats = []
+    all_chunks = list(iter_chunks(documents, chunk_size, chunk_overlap,
+                                  tokenizer=tokenizer, token_stats=token_stats))
     
     print(f"Đã tạo {len(all_chunks)} chunks từ {len(documents)} documents")
+    if tokenizer is not None:
+        print_token_histogram(token_stats)
     return all_chunks
 
 
-def create_embeddings(use_phobert=True):
+def make_vector_id(source, chunk_id):
+    """
+    Tạo vector ID ổn định (ASCII) cho một chunk
+    
+    ID chỉ phụ thuộc vào tên file và vị trí chunk nên chạy lại ingestion sẽ
+    ghi đè đúng vector cũ thay vì tạo bản trùng.
+    
+    Args:
+        source: Tên file PDF
+        chunk_id: Số thứ tự chunk trong file
+    
+    Returns:
+        vector_id: ID dạng "<hash tên file>-<chunk_id>"
+    """
+    source_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+    return f"{source_hash}-{chunk_id}"
+
+
+def hash_text(text):
+    """
+    Hash nội dung text (dùng để phát hiện chunk thay đổi)
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def hash_file(file_path):
+    """
+    Hash nội dung file (dùng để phát hiện file PDF thay đổi)
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_hf_embeddings(model_name, model_kwargs, encode_kwargs, backend):
+    """
+    Load HuggingFaceEmbeddings với backend đã chọn, fallback về PyTorch fp32
+    nếu backend tối ưu không dùng được
+    
+    Returns:
+        (embeddings, backend): Model và backend thực sự được dùng
+    """
+    try:
+        embeddings = HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs={**model_kwargs, **backend_model_kwargs(backend)},
+            encode_kwargs=encode_kwargs
+        )
+        if backend == "int8":
+            quantize_int8(embeddings)
+        return embeddings, backend
+    except Exception as e:
+        if backend == "torch":
+            raise
+        print(f"Không thể dùng backend {backend}: {e}")
+        print("Fallback sang PyTorch fp32...")
+        return _load_hf_embeddings(model_name, model_kwargs, encode_kwargs, "torch")
+
+
+def create_embeddings(use_phobert=True, use_cache=True, backend=None, token_budget=8192):
     """
     Tạo embedding model - Hỗ trợ PhoBERT (tối ưu tiếng Việt) hoặc multilingual
     
     Args:
         use_phobert: True = PhoBERT (tốt cho tiếng Việt), False = multilingual
+        use_cache: True = bọc model bằng CachedEmbeddings (cache vector trên đĩa,
+            chỉ encode text mới)
+        backend: "torch" (fp32), "int8" (dynamic quantization) hoặc "onnx"
+            (ONNX Runtime). None = đọc từ biến môi trường EMBEDDING_BACKEND
+        token_budget: Số token tối đa mỗi batch khi embed chunk (batch xếp theo
+            độ dài token). None = batch cố định theo encode_kwargs['batch_size']
     
     Returns:
         embeddings: Embedding model
     """
+    if backend is None:
+        backend = os.getenv("EMBEDDING_BACKEND", "torch")
+    
+    embeddings = None
+    
     if use_phobert:
-        print("Sử dụng PhoBERT Embeddings (tối ưu cho tiếng Việt)")
+        print(f"Sử dụng PhoBERT Embeddings (tối ưu cho tiếng Việt, backend: {backend})")
         try:
-            return HuggingFaceEmbeddings(
+            embeddings, backend = _load_hf_embeddings(
                 model_name="VoVanPhuc/sup-SimCSE-VietNamese-phobert-base",
                 model_kwargs={
                     'device': 'cpu',
@@ -287,7 +1001,8 @@ def create_embeddings(use_phobert=True):
                 encode_kwargs={
                     'normalize_embeddings': True,  # Normalize vectors
                     'batch_size': 32  # Batch processing
-                }
+                },
+                backend=backend
             )
         except Exception as e:
             print(f"Không thể load PhoBERT: {e}")
@@ -295,15 +1010,31 @@ def create_embeddings(use_phobert=True):
             use_phobert = False
     
     if not use_phobert:
-        print("Sử dụng Multilingual Embeddings (hỗ trợ đa ngôn ngữ)")
-        return HuggingFaceEmbeddings(
+        print(f"Sử dụng Multilingual Embeddings (hỗ trợ đa ngôn ngữ, backend: {backend})")
+        embeddings, backend = _load_hf_embeddings(
             model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
             model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
+            encode_kwargs={'normalize_embeddings': True},
+            backend=backend
         )
-
-
-
+    
+    if token_budget:
+        embeddings = TokenBudgetEmbeddings(embeddings, token_budget=token_budget)
+    
+    if use_cache:
+        # Vector của backend khác nhau lệch nhau chút ít → cache riêng
+        cache_model_name = embeddings.model_name
+        if backend != "torch":
+            cache_model_name += f"@{backend}"
+        embeddings = CachedEmbeddings(
+            embeddings,
+            model_name=cache_model_name,
+            normalize=embeddings.encode_kwargs.get('normalize_embeddings', False)
+        )
+        print(f"Embedding cache: {embeddings.stats()['cached']} vectors đã lưu "
+              f"({embeddings.directory})")
+    
+    return embeddings
 
 
 def create_vector_store_pinecone(chunks, embeddings, index_name="chatbot-study"):
@@ -311,7 +1042,7 @@ def create_vector_store_pinecone(chunks, embeddings, index_name="chatbot-study")
     Tạo Pinecone vector store (cloud-based, cần API key)
     
     Args:
-        chunks: List các text chunks
+        chunks: Iterable các text chunks (list hoặc generator từ iter_chunks)
         embeddings: Embedding model
         index_name: Tên Pinecone index
     
@@ -328,33 +1059,154 @@ def create_vector_store_pinecone(chunks, embeddings, index_name="chatbot-study")
     
     # Initialize Pinecone
     pc = Pinecone(api_key=pinecone_api_key)
+    index = pc.Index(index_name)
     
-    texts = [chunk['text'] for chunk in chunks]
-    metadatas = [{'source': chunk['source'], 'chunk_id': chunk['chunk_id']} 
-                 for chunk in chunks]
+    # Embed + upsert theo batch (streaming), không giữ toàn bộ vector trong bộ nhớ
+    run_ingestion_pipeline(
+        ({**chunk, 'id': make_vector_id(chunk['source'], chunk['chunk_id'])}
+         for chunk in chunks),
+        embeddings,
+        upsert_fn=lambda vectors: index.upsert(vectors=vectors)
+    )
     
-    vector_store = PineconeVectorStore.from_texts(
-        texts=texts,
-        embedding=embeddings,
-        metadatas=metadatas,
-        index_name=index_name
+    vector_store = CachedVectorPineconeStore(
+        index_name=index_name,
+        embedding=embeddings
     )
     
     print(f"Đã tạo Pinecone index: {index_name}")
     return vector_store
 
 
+def create_vector_store_local(chunks, embeddings, index_name="chatbot-study"):
+    """
+    Tạo vector store local (file memory-mapped trong .cache/vector_store, không cần mạng)
+    
+    Args:
+        chunks: Iterable các text chunks (list hoặc generator từ iter_chunks)
+        embeddings: Embedding model
+        index_name: Tên index (tên thư mục)
+    
+    Returns:
+        vector_store: LocalVectorStore
+    """
+    print("Đang tạo local vector store...")
+    
+    vector_store = LocalVectorStore(embeddings, name=index_name)
+    run_ingestion_pipeline(
+        ({**chunk, 'id': make_vector_id(chunk['source'], chunk['chunk_id'])}
+         for chunk in chunks),
+        embeddings,
+        upsert_fn=vector_store.upsert
+    )
+    
+    print(f"Đã tạo local index: {index_name} ({len(vector_store)} vectors)")
+    return vector_store
+
+
+def load_vector_store(embeddings, index_name="studychatbot", backend=None):
+    """
+    Mở vector store đã được upload_to_pinecone.py tạo sẵn
+    
+    Args:
+        embeddings: Embedding model (phải trùng model lúc upload)
+        index_name: Tên index
+        backend: "pinecone" hoặc "local" (mặc định: biến môi trường VECTOR_BACKEND)
+    
+    Returns:
+        vector_store: CachedVectorPineconeStore hoặc LocalVectorStore
+    """
+    backend = backend or VECTOR_BACKEND
+    
+    if backend == "local":
+        vector_store = LocalVectorStore(embeddings, name=index_name, nprobe=VECTOR_NPROBE)
+        if len(vector_store) == 0:
+            print(f"Local index '{index_name}' đang trống - hãy chạy upload_to_pinecone.py "
+                  "với VECTOR_BACKEND=local")
+        else:
+            print(f"Đã mở local index: {index_name} ({len(vector_store)} vectors)")
+        return vector_store
+    
+    if backend != "pinecone":
+        raise ValueError(f"VECTOR_BACKEND không hợp lệ: {backend} (pinecone | local)")
+    
+    return CachedVectorPineconeStore(
+        index_name=index_name,
+        embedding=embeddings
+    )
+
+
+def index_manifest_path(index_name="studychatbot", backend=None):
+    """
+    Đường dẫn manifest mà upload_to_pinecone.py ghi sau mỗi lần cập nhật index
+    """
+    backend = backend or VECTOR_BACKEND
+    file_name = (f"{index_name}_manifest.json" if backend == "pinecone"
+                 else f"{index_name}_{backend}_manifest.json")
+    return os.path.join(CACHE_DIR, file_name)
+
+
+def open_keyword_index(index_name="studychatbot", backend=None):
+    """
+    BM25 keyword index đi cùng vector store (chưa load, xem BM25Index.load)
+    
+    Mỗi backend có index riêng như manifest (chunk có thể khác nhau)
+    """
+    backend = backend or VECTOR_BACKEND
+    return BM25Index(index_name if backend == "pinecone" else f"{index_name}_{backend}")
+
+
+def get_index_version(index_name="studychatbot", backend=None):
+    """
+    Phiên bản của index (thời điểm manifest được ghi lần cuối, None nếu chưa có)
+    
+    Đổi sau mỗi lần upload/rebuild → dùng để xóa các cache câu trả lời cũ
+    """
+    try:
+        return os.path.getmtime(index_manifest_path(index_name, backend))
+    except OSError:
+        return None
+
+
+def _build_answer_prompt(prompt_template, system_prompt=None):
+    """
+    Prompt cho bước trả lời (combine docs)
+    
+    Có system_prompt → ChatPromptTemplate: system block cố định đánh dấu
+    cache_control (Anthropic prompt caching), chỉ phần human (context + câu hỏi)
+    thay đổi giữa các request.
+    """
+    if system_prompt is None:
+        return PromptTemplate(
+            template=prompt_template,
+            input_variables=["context", "question"]
+        )
+    system_message = SystemMessage(content=[{
+        "type": "text",
+        "text": system_prompt.format(),  # Bỏ ngoặc kép {{ }} của template
+        "cache_control": {"type": "ephemeral"}
+    }])
+    return ChatPromptTemplate.from_messages([system_message, ("human", prompt_template)])
+
+
 def create_chatbot(vector_store, prompt_template, use_memory=True, 
-                   use_advanced_retrieval=True, retrieval_mode="mmr"):
+                   use_advanced_retrieval=True, retrieval_mode="mmr",
+                   session_memory=False, system_prompt=None, keyword_index=None):
     """
     Tạo chatbot với Conversational Retrieval chain - sử dụng Claude + Memory + Advanced Retrieval
     
     Args:
-        vector_store: Vector store (FAISS hoặc Pinecone)
-        prompt_template: Template cho prompt
+        vector_store: Vector store (Pinecone hoặc LocalVectorStore)
+        prompt_template: Template cho prompt (biến {context}, {question})
         use_memory: True = Nhớ lịch sử chat, False = Mỗi câu độc lập
         use_advanced_retrieval: True = Dùng re-ranking/hybrid search
         retrieval_mode: "mmr" (default), "rerank", "hybrid", "similarity"
+        session_memory: True = Chain không giữ memory, lịch sử truyền vào theo
+            từng session (ChatSession) khi gọi ask_question / stream_question
+        system_prompt: Phần prompt cố định (vd. src.prompt.system_prompt), gửi làm
+            system block được Anthropic prompt caching cache lại; khi đó
+            prompt_template chỉ còn phần thay đổi (src.prompt.question_prompt)
+        keyword_index: BM25Index đã load (src.keyword_index), cần cho retrieval_mode="hybrid"
     
     Returns:
         qa_chain: ConversationalRetrievalChain với memory + advanced retrieval
@@ -372,7 +1224,8 @@ def create_chatbot(vector_store, prompt_template, use_memory=True,
         model="claude-sonnet-4-20250514",
         temperature=0.3,
         api_key=anthropic_api_key,
-        max_tokens=2000
+        max_tokens=2000,
+        streaming=True  # Phát token qua callback (dùng cho /api/ask/stream)
     )
     
     # Chọn retrieval strategy
@@ -396,13 +1249,18 @@ def create_chatbot(vector_store, prompt_template, use_memory=True,
         retriever = create_reranking_retriever(base_retriever, anthropic_api_key)
         print("Retrieval: Re-ranking với Claude (20 -> 6 chunks)")
     elif retrieval_mode == "hybrid" and use_advanced_retrieval and ADVANCED_RETRIEVAL_AVAILABLE:
-        # Hybrid: Vector search + BM25 keyword search
-        # Cần truyền documents để tạo BM25 index
-        print("Hybrid search cần documents list - fallback sang MMR")
-        retriever = vector_store.as_retriever(
-            search_type="mmr",
-            search_kwargs={"k": 8, "fetch_k": 20, "lambda_mult": 0.7}
-        )
+        # Hybrid: Vector search (MMR) + BM25 keyword search chạy song song, gộp theo thứ hạng
+        # BM25 index do upload_to_pinecone.py build sẵn, app.py đọc lúc khởi động
+        if keyword_index is not None and len(keyword_index):
+            retriever = create_hybrid_retriever(vector_store, keyword_index,
+                                                k=12, fetch_k=30, lambda_mult=0.5)
+            print(f"Retrieval: Hybrid (MMR k=12 + BM25 trên {len(keyword_index)} chunks, RRF)")
+        else:
+            print("Chưa có BM25 index (chạy upload_to_pinecone.py) - fallback sang MMR")
+            retriever = vector_store.as_retriever(
+                search_type="mmr",
+                search_kwargs={"k": 12, "fetch_k": 30, "lambda_mult": 0.5}
+            )
     else:
         # Default: Similarity search
         retriever = vector_store.as_retriever(
@@ -411,30 +1269,51 @@ def create_chatbot(vector_store, prompt_template, use_memory=True,
         )
         print("Retrieval: Similarity Search")
     
+    answer_prompt = _build_answer_prompt(prompt_template, system_prompt)
+    
     if use_memory:
-        # Tạo memory để nhớ lịch sử hội thoại
-        memory = ConversationBufferMemory(
+        # Memory dùng chung: chỉ giữ MEMORY_WINDOW lượt gần nhất
+        # (ConversationBufferMemory bỏ qua max_token_limit → history không giới hạn)
+        # Serve nhiều người dùng: session_memory=True, mỗi session có lịch sử riêng
+        memory = None if session_memory else ConversationBufferWindowMemory(
             memory_key="chat_history",
             return_messages=True,
             output_key="answer",
-            max_token_limit=2000  # Giới hạn 2000 tokens cho history
+            k=MEMORY_WINDOW
         )
         
+        # Viết lại câu hỏi nối tiếp bằng model nhỏ (nếu cấu hình), không stream
+        condense_llm = None
+        if CONDENSE_MODEL:
+            condense_llm = ChatAnthropic(
+                model=CONDENSE_MODEL,
+                temperature=0,
+                api_key=anthropic_api_key,
+                max_tokens=300
+            )
+        
         # Tạo Conversational chain với memory
-        qa_chain = ConversationalRetrievalChain.from_llm(
+        # (câu hỏi tự đủ nghĩa không qua bước viết lại, xem FastConversationalRetrievalChain)
+        qa_chain = FastConversationalRetrievalChain.from_llm(
             llm=llm,
             retriever=retriever,
+            condense_question_llm=condense_llm,
             memory=memory,
+            speculative_retrieval=SPECULATIVE_RETRIEVAL,
+            speculative_threshold=SPECULATIVE_THRESHOLD,
+            speculative_merge_weight=SPECULATIVE_MERGE_WEIGHT,
+            pack_context=True,
+            context_token_budget=CONTEXT_TOKEN_BUDGET,
             return_source_documents=True,
             verbose=False,
             combine_docs_chain_kwargs={
-                "prompt": PromptTemplate(
-                    template=prompt_template,
-                    input_variables=["context", "question"]
-                )
+                "prompt": answer_prompt
             }
         )
-        print("Chatbot đã sẵn sàng (với Conversation Memory)!")
+        if session_memory:
+            print("Chatbot đã sẵn sàng (Conversation Memory theo session)!")
+        else:
+            print("Chatbot đã sẵn sàng (với Conversation Memory)!")
     else:
         # Tạo chain không có memory (như cũ)
         from langchain.chains import RetrievalQA
@@ -444,10 +1323,7 @@ def create_chatbot(vector_store, prompt_template, use_memory=True,
             retriever=retriever,
             return_source_documents=True,
             chain_type_kwargs={
-                "prompt": PromptTemplate(
-                    template=prompt_template,
-                    input_variables=["context", "question"]
-                )
+                "prompt": answer_prompt
             }
         )
         print("Chatbot đã sẵn sàng (không có memory)!")
@@ -455,36 +1331,669 @@ def create_chatbot(vector_store, prompt_template, use_memory=True,
     return qa_chain
 
 
-def ask_question(qa_chain, question):
+def is_self_contained(question):
+    """
+    Phân loại nhanh (không gọi LLM): câu hỏi hiểu được mà không cần lịch sử chat?
+    
+    Câu hỏi có đại từ / chỉ từ ("nó", "cái đó", "công thức này"), mở đầu bằng
+    "còn", "vậy"..., yêu cầu nói tiếp không kèm nội dung ("cho ví dụ cụ thể",
+    "tại sao vậy") hoặc quá ngắn → False (cần viết lại).
+    """
+    text = unicodedata.normalize("NFC", question).strip().lower()
+    if len(text.split()) < MIN_SELF_CONTAINED_WORDS:
+        return False
+    if FOLLOWUP_PATTERN.search(text) or FOLLOWUP_START_PATTERN.search(text):
+        return False
+    if FOLLOWUP_REQUEST_PATTERN.search(text):
+        content = [word for word in re.findall(r"\w+", FOLLOWUP_REQUEST_PATTERN.sub(" ", text))
+                   if word not in FOLLOWUP_FILLER_WORDS]
+        return len(content) >= MIN_FOLLOWUP_CONTENT_WORDS
+    return True
+
+
+# Số lần đi qua từng nhánh của bước viết lại câu hỏi (xem condense_stats)
+_condense_lock = threading.Lock()
+_condense_counts = {"no_history": 0, "skipped": 0, "rewritten": 0}
+_speculative_counts = {"speculative_hits": 0, "speculative_misses": 0}
+
+# Thread tìm tài liệu theo câu hỏi gốc song song với bước viết lại (chain đồng bộ)
+_speculative_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speculative-retrieval")
+atexit.register(_speculative_executor.shutdown, wait=False, cancel_futures=True)
+
+
+def _record_condense(path):
+    with _condense_lock:
+        if path in _speculative_counts:
+            _speculative_counts[path] += 1
+        else:
+            _condense_counts[path] += 1
+
+
+def condense_stats():
+    """
+    Returns:
+        stats: Dict {"no_history", "skipped", "rewritten", "rewrite_rate",
+            "speculative_hits", "speculative_misses", "speculative_hit_rate",
+            "extra_retrievals"} - số câu hỏi không có lịch sử, câu nối tiếp được bỏ
+            qua bước viết lại (tự đủ nghĩa), câu phải gọi LLM viết lại, và trong số
+            đó: số lần dùng luôn kết quả tìm trước theo câu hỏi gốc / phải tìm lại
+            theo câu viết lại; extra_retrievals = số lần tìm thêm so với không tìm
+            trước (tăng nhanh → hạ SPECULATIVE_THRESHOLD hoặc tắt SPECULATIVE_RETRIEVAL)
+    """
+    with _condense_lock:
+        stats = dict(_condense_counts)
+        speculative = dict(_speculative_counts)
+    total = sum(stats.values())
+    stats["rewrite_rate"] = stats["rewritten"] / total if total else 0.0
+    stats.update(speculative)
+    attempts = speculative["speculative_hits"] + speculative["speculative_misses"]
+    stats["speculative_hit_rate"] = speculative["speculative_hits"] / attempts if attempts else 0.0
+    stats["extra_retrievals"] = speculative["speculative_misses"]
+    return stats
+
+
+class FastConversationalRetrievalChain(ConversationalRetrievalChain):
+    """
+    ConversationalRetrievalChain bỏ qua bước viết lại câu hỏi (một lượt gọi Claude)
+    khi câu hỏi tự đủ nghĩa theo is_self_contained
+    
+    Câu phải viết lại (speculative_retrieval=True): tìm tài liệu theo câu hỏi gốc
+    cùng lúc với lượt gọi LLM viết lại. Câu viết lại gần câu gốc (cosine embedding
+    ≥ speculative_threshold) → dùng luôn kết quả đó; ngược lại tìm lại theo câu
+    viết lại rồi gộp với kết quả tìm trước bằng reciprocal_rank_fusion (kết quả
+    tìm trước không bị bỏ đi, trọng số speculative_merge_weight).
+    
+    pack_context=True: chunk tìm được đi qua pack_documents (ghép chunk chồng lấp,
+    giới hạn context_token_budget) trước khi đưa vào prompt; số token tiết kiệm
+    được báo qua custom event CONTEXT_PACKED_EVENT (PromptUsageHandler).
+    """
+    
+    speculative_retrieval: bool = False
+    speculative_threshold: float = 0.9
+    speculative_merge_weight: float = 0.5
+    pack_context: bool = False
+    context_token_budget: int = 0
+    
+    def _route(self, inputs):
+        if not inputs["chat_history"]:
+            _record_condense("no_history")
+        elif is_self_contained(inputs["question"]):
+            _record_condense("skipped")
+            # Lịch sử rỗng → chain dùng nguyên câu hỏi để tìm tài liệu
+            inputs = {**inputs, "chat_history": []}
+        else:
+            _record_condense("rewritten")
+        return inputs
+    
+    def _packed(self, docs, run_manager):
+        if not self.pack_context:
+            return docs
+        docs, stats = pack_documents(docs, self.context_token_budget)
+        run_manager.get_child().on_custom_event(CONTEXT_PACKED_EVENT, stats)
+        return docs
+    
+    async def _apacked(self, docs, run_manager):
+        if not self.pack_context:
+            return docs
+        docs, stats = pack_documents(docs, self.context_token_budget)
+        await run_manager.get_child().on_custom_event(CONTEXT_PACKED_EVENT, stats)
+        return docs
+    
+    def _get_docs(self, question, inputs, *, run_manager):
+        docs = super()._get_docs(question, inputs, run_manager=run_manager)
+        return self._packed(docs, run_manager)
+    
+    async def _aget_docs(self, question, inputs, *, run_manager):
+        docs = await super()._aget_docs(question, inputs, run_manager=run_manager)
+        return await self._apacked(docs, run_manager)
+    
+    def _close_enough(self, question, new_question):
+        """Câu viết lại đủ gần câu gốc để dùng kết quả tìm trước?"""
+        if new_question.strip() == question.strip():
+            return True
+        vectorstore = getattr(self.retriever, "vectorstore", None)
+        embeddings = getattr(vectorstore, "embeddings", None)
+        if embeddings is None:
+            return False
+        vectors = normalize_rows([embeddings.embed_query(question),
+                                  embeddings.embed_query(new_question)])
+        return float(vectors[0] @ vectors[1]) >= self.speculative_threshold
+    
+    def _merge_speculative(self, docs, speculative_docs):
+        """Gộp kết quả theo câu viết lại với kết quả tìm trước theo câu gốc (giữ số lượng)"""
+        return reciprocal_rank_fusion(
+            [docs, speculative_docs], max(len(docs), 1),
+            weights=[1.0, self.speculative_merge_weight]
+        )
+    
+    def _output(self, docs, new_question, answer):
+        output = {self.output_key: answer}
+        if self.return_source_documents:
+            output["source_documents"] = docs
+        if self.return_generated_question:
+            output["generated_question"] = new_question
+        return output
+    
+    def _answer_inputs(self, inputs, new_question, chat_history_str):
+        new_inputs = inputs.copy()
+        if self.rephrase_question:
+            new_inputs["question"] = new_question
+        new_inputs["chat_history"] = chat_history_str
+        return new_inputs
+    
+    def _call(self, inputs, run_manager=None):
+        inputs = self._route(inputs)
+        if not (self.speculative_retrieval and inputs["chat_history"]):
+            return super()._call(inputs, run_manager=run_manager)
+        
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        question = inputs["question"]
+        chat_history_str = (self.get_chat_history or _get_chat_history)(inputs["chat_history"])
+        # Tài liệu chỉ đóng gói một lần, sau khi chọn xong kết quả tìm theo câu nào
+        retrieve = super()._get_docs
+        speculative = _speculative_executor.submit(
+            retrieve, question, inputs, run_manager=_run_manager
+        )
+        try:
+            new_question = (self.question_generator.invoke(
+                {"question": question, "chat_history": chat_history_str},
+                config={"callbacks": _run_manager.get_child()}
+            ))[self.question_generator.output_key]
+            docs = speculative.result()
+        finally:
+            speculative.cancel()
+        
+        if self._close_enough(question, new_question):
+            _record_condense("speculative_hits")
+        else:
+            _record_condense("speculative_misses")
+            docs = self._merge_speculative(
+                retrieve(new_question, inputs, run_manager=_run_manager), docs
+            )
+        docs = self._packed(docs, _run_manager)
+        
+        if self.response_if_no_docs_found is not None and not docs:
+            return self._output(docs, new_question, self.response_if_no_docs_found)
+        answer = (self.combine_docs_chain.invoke(
+            {**self._answer_inputs(inputs, new_question, chat_history_str), "input_documents": docs},
+            config={"callbacks": _run_manager.get_child()}
+        ))[self.combine_docs_chain.output_key]
+        return self._output(docs, new_question, answer)
+    
+    async def _acall(self, inputs, run_manager=None):
+        inputs = self._route(inputs)
+        if not (self.speculative_retrieval and inputs["chat_history"]):
+            return await super()._acall(inputs, run_manager=run_manager)
+        
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        question = inputs["question"]
+        chat_history_str = (self.get_chat_history or _get_chat_history)(inputs["chat_history"])
+        retrieve = super()._aget_docs
+        speculative = asyncio.ensure_future(
+            retrieve(question, inputs, run_manager=_run_manager)
+        )
+        try:
+            new_question = (await self.question_generator.ainvoke(
+                {"question": question, "chat_history": chat_history_str},
+                config={"callbacks": _run_manager.get_child()}
+            ))[self.question_generator.output_key]
+            docs = await speculative
+        finally:
+            speculative.cancel()
+        
+        # Embedding model chạy trên CPU → không chặn event loop
+        if await asyncio.to_thread(self._close_enough, question, new_question):
+            _record_condense("speculative_hits")
+        else:
+            _record_condense("speculative_misses")
+            docs = self._merge_speculative(
+                await retrieve(new_question, inputs, run_manager=_run_manager), docs
+            )
+        docs = await self._apacked(docs, _run_manager)
+        
+        if self.response_if_no_docs_found is not None and not docs:
+            return self._output(docs, new_question, self.response_if_no_docs_found)
+        answer = (await self.combine_docs_chain.ainvoke(
+            {**self._answer_inputs(inputs, new_question, chat_history_str), "input_documents": docs},
+            config={"callbacks": _run_manager.get_child()}
+        ))[self.combine_docs_chain.output_key]
+        return self._output(docs, new_question, answer)
+
+
+def _chat_history(qa_chain, session=None):
+    """Lịch sử hội thoại của session, hoặc trong memory của chain (list rỗng nếu không có)"""
+    if session is not None:
+        return session.chat_history()
+    memory = getattr(qa_chain, 'memory', None)
+    if memory is None:
+        return []
+    return memory.chat_memory.messages
+
+
+def _save_turn(qa_chain, question, answer, session=None):
+    """Ghi lượt hỏi-đáp vào session (memory của chain tự ghi khi invoke)"""
+    if session is not None:
+        session.add(question, answer)
+    elif getattr(qa_chain, 'memory', None) is not None:
+        qa_chain.memory.save_context({"question": question}, {"answer": answer})
+
+
+def _active_caches(qa_chain, answer_cache, response_cache, session=None):
+    """
+    Các cache áp dụng được cho câu hỏi hiện tại (khớp chính xác trước)
+    
+    Chỉ dùng cho câu hỏi đầu hội thoại, vì câu hỏi nối tiếp phụ thuộc vào lịch sử chat
+    """
+    if _chat_history(qa_chain, session):
+        return []
+    return [c for c in (response_cache, answer_cache) if c is not None]
+
+
+def _lookup_caches(qa_chain, question, caches, session=None):
+    """
+    Tra lần lượt các cache, trả về response đã cache hoặc None
+    """
+    for i, cache in enumerate(caches):
+        cached = cache.lookup(question)
+        if cached is not None:
+            # Cache phía trước (khớp chính xác) học lại câu trả lời của cache ngữ nghĩa
+            _store_caches(caches[:i], question, cached)
+            # Vẫn ghi lượt hỏi-đáp vào lịch sử để câu hỏi sau có ngữ cảnh
+            _save_turn(qa_chain, question, cached['answer'], session)
+            return {
+                'answer': cached['answer'],
+                'sources': cached['sources'],
+                'cached': True
+            }
+    return None
+
+
+def _store_caches(caches, question, response):
+    """
+    Lưu câu trả lời mới vào các cache đang áp dụng
+    
+    Lỗi khi ghi cache (SQLite bị khóa, đầy đĩa, lỗi embedding...) chỉ được ghi log:
+    câu trả lời đã có, không để cache làm hỏng request
+    """
+    for cache in caches:
+        try:
+            cache.store(question, response['answer'], response['sources'])
+        except Exception as e:
+            print(f"Lỗi khi lưu cache {type(cache).__name__}: {e}")
+
+
+def ask_question(qa_chain, question, answer_cache=None, response_cache=None, session=None):
     """
     Đặt câu hỏi cho chatbot (hỗ trợ cả memory và non-memory chains)
     
     Args:
         qa_chain: ConversationalRetrievalChain hoặc RetrievalQA chain
         question: Câu hỏi
+        answer_cache: SemanticAnswerCache (tùy chọn)
+        response_cache: ResponseCache (tùy chọn) - tra trước answer_cache,
+            không cần embedding
+        session: ChatSession (tùy chọn) - lịch sử hội thoại riêng của người dùng,
+            dùng với chain tạo bằng session_memory=True
     
     Returns:
         response: Câu trả lời và source documents
     """
-    try:
-        # ConversationalRetrievalChain dùng key "question"
-        # RetrievalQA dùng key "query"
-        if hasattr(qa_chain, 'memory'):
-            # Có memory → ConversationalRetrievalChain
-            result = qa_chain.invoke({"question": question})
-            return {
-                'answer': result['answer'],
-                'sources': [doc.metadata for doc in result['source_documents']]
-            }
-        else:
-            # Không memory → RetrievalQA
-            result = qa_chain.invoke({"query": question})
-            return {
-                'answer': result['result'],
-                'sources': [doc.metadata for doc in result['source_documents']]
-            }
-    except Exception as e:
+    # Câu hỏi trong cùng session xử lý tuần tự (câu sau cần lịch sử của câu trước)
+    with session.lock if session is not None else nullcontext():
+        caches = _active_caches(qa_chain, answer_cache, response_cache, session)
+        cached = _lookup_caches(qa_chain, question, caches, session)
+        if cached is not None:
+            return cached
+        
+        response = _invoke_chain(qa_chain, question, chat_history=_history_input(session))
+        if not response.get('error'):
+            if session is not None:
+                session.add(question, response['answer'])
+            _store_caches(caches, question, response)
+        return response
+
+
+class _AnswerTokenHandler(BaseCallbackHandler):
+    """
+    Callback chuyển token của câu trả lời vào queue
+    
+    Chỉ lấy token của LLM nằm trong combine docs chain (StuffDocumentsChain);
+    token của bước viết lại câu hỏi (question generator) bị bỏ qua.
+    """
+    
+    # Chạy ngay trong event loop khi chain chạy async (không qua thread pool)
+    run_inline = True
+    
+    def __init__(self, on_token):
+        self.on_token = on_token
+        self._answer_runs = set()
+    
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name", "")
+        if name == "StuffDocumentsChain" or parent_run_id in self._answer_runs:
+            self._answer_runs.add(run_id)
+    
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        if parent_run_id in self._answer_runs:
+            self._answer_runs.add(run_id)
+    
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        if parent_run_id in self._answer_runs:
+            self._answer_runs.add(run_id)
+    
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        if run_id in self._answer_runs and token:
+            self.on_token(token)
+
+
+class PromptUsageHandler(BaseCallbackHandler):
+    """
+    Đếm token các lần gọi Claude trong một request, gồm token đọc / ghi prompt cache
+    
+    Khi stream, usage đến theo chunk (message_start, message_delta - giá trị cộng
+    dồn) → mỗi lần gọi lấy giá trị lớn nhất của từng trường.
+    """
+    
+    run_inline = True
+    FIELDS = ("input_tokens", "output_tokens", "cache_read", "cache_creation")
+    # Token (ước lượng) của {context} sau khi đóng gói và số token đã bỏ bớt
+    CONTEXT_FIELDS = ("context_tokens", "context_tokens_saved")
+    
+    def __init__(self):
+        self.usage = dict.fromkeys(self.FIELDS + self.CONTEXT_FIELDS, 0)
+        self._streamed = {}  # {run_id: usage} của các lần gọi đang stream
+    
+    @staticmethod
+    def _fields(usage_metadata):
+        details = usage_metadata.get("input_token_details") or {}
         return {
-            'answer': f"Xin lỗi, có lỗi xảy ra: {str(e)}",
-            'sources': []
+            "input_tokens": usage_metadata.get("input_tokens") or 0,
+            "output_tokens": usage_metadata.get("output_tokens") or 0,
+            "cache_read": details.get("cache_read") or 0,
+            "cache_creation": details.get("cache_creation") or 0,
         }
+    
+    def on_llm_new_token(self, token, *, chunk=None, run_id, **kwargs):
+        usage_metadata = getattr(getattr(chunk, "message", None), "usage_metadata", None)
+        if usage_metadata:
+            current = self._streamed.setdefault(run_id, dict.fromkeys(self.FIELDS, 0))
+            for key, value in self._fields(usage_metadata).items():
+                current[key] = max(current[key], value)
+    
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = self._streamed.pop(run_id, None)
+        if usage is None:
+            for generations in response.generations:
+                for generation in generations:
+                    message = getattr(generation, "message", None)
+                    if getattr(message, "usage_metadata", None):
+                        usage = self._fields(message.usage_metadata)
+        if usage:
+            for key, value in usage.items():
+                self.usage[key] += value
+    
+    def on_custom_event(self, name, data, *, run_id, **kwargs):
+        if name == CONTEXT_PACKED_EVENT:
+            self.usage["context_tokens"] += data["tokens"]
+            self.usage["context_tokens_saved"] += data["tokens_saved"]
+
+
+# Tổng token từ đầu process (xem prompt_usage_stats)
+_prompt_usage_lock = threading.Lock()
+_prompt_usage_totals = {
+    "requests": 0,
+    **dict.fromkeys(PromptUsageHandler.FIELDS + PromptUsageHandler.CONTEXT_FIELDS, 0)
+}
+
+
+def _record_usage(usage):
+    with _prompt_usage_lock:
+        _prompt_usage_totals["requests"] += 1
+        for key, value in usage.items():
+            _prompt_usage_totals[key] += value
+
+
+def prompt_usage_stats():
+    """
+    Tổng token đã gửi Claude từ khi khởi động
+    
+    Returns:
+        stats: Dict {"requests", "input_tokens", "output_tokens", "cache_read",
+            "cache_creation", "context_tokens", "context_tokens_saved",
+            "cache_read_ratio"} - cache_read_ratio = tỷ lệ token input được đọc từ
+            prompt cache, context_tokens_saved = token context bỏ được nhờ ghép chunk
+            chồng lấp / giới hạn CONTEXT_TOKEN_BUDGET
+    """
+    with _prompt_usage_lock:
+        stats = dict(_prompt_usage_totals)
+    stats["cache_read_ratio"] = (stats["cache_read"] / stats["input_tokens"]
+                                 if stats["input_tokens"] else 0.0)
+    return stats
+
+
+def stream_question(qa_chain, question, answer_cache=None, response_cache=None, session=None):
+    """
+    Đặt câu hỏi và nhận câu trả lời dạng stream (từng token)
+    
+    Chain chạy trong thread riêng; token của câu trả lời được đẩy ra ngay khi
+    Claude sinh, sources gửi ở event cuối cùng.
+    
+    Args:
+        qa_chain: ConversationalRetrievalChain hoặc RetrievalQA chain
+        question: Câu hỏi
+        answer_cache, response_cache, session: Như ask_question
+    
+    Yields:
+        event: Dict {'type': 'token', 'text'} | {'type': 'sources', 'sources', 'cached'}
+            | {'type': 'error', 'message'}
+    """
+    lock = session.lock if session is not None else None
+    if lock is not None:
+        lock.acquire()
+    worker_owns_lock = False
+    try:
+        caches = _active_caches(qa_chain, answer_cache, response_cache, session)
+        cached = _lookup_caches(qa_chain, question, caches, session)
+        if cached is not None:
+            yield {'type': 'token', 'text': cached['answer']}
+            yield {'type': 'sources', 'sources': cached['sources'], 'cached': True}
+            return
+        
+        token_queue = queue.Queue()
+        chat_history = _history_input(session)
+        
+        def worker():
+            # Worker giữ lock của session tới khi ghi xong lịch sử,
+            # kể cả khi client ngắt kết nối giữa chừng
+            response = {'answer': '', 'sources': [], 'error': True}
+            try:
+                response = _invoke_chain(qa_chain, question,
+                                         callbacks=[_AnswerTokenHandler(
+                                             lambda token: token_queue.put(("token", token)))],
+                                         chat_history=chat_history)
+                if session is not None and not response.get('error'):
+                    session.add(question, response['answer'])
+            finally:
+                if lock is not None:
+                    lock.release()
+                token_queue.put(("done", response))
+        
+        threading.Thread(target=worker, name="stream-question", daemon=True).start()
+        worker_owns_lock = True
+    finally:
+        if lock is not None and not worker_owns_lock:
+            lock.release()
+    
+    streamed = False
+    while True:
+        kind, value = token_queue.get()
+        if kind == "token":
+            streamed = True
+            yield {'type': 'token', 'text': value}
+            continue
+        
+        response = value
+        if response.get('error'):
+            yield {'type': 'error', 'message': response['answer']}
+            return
+        if not streamed:
+            # LLM không stream (vd. câu trả lời cố định khi không tìm thấy tài liệu)
+            yield {'type': 'token', 'text': response['answer']}
+        _store_caches(caches, question, response)
+        yield {'type': 'sources', 'sources': response['sources'], 'cached': False,
+               'usage': response['usage']}
+        return
+
+
+def _history_input(session):
+    """chat_history truyền vào chain (None = chain tự lấy từ memory)"""
+    return session.chat_history() if session is not None else None
+
+
+def _chain_inputs(qa_chain, question, chat_history=None):
+    """Input của chain theo loại chain"""
+    # ConversationalRetrievalChain dùng key "question"
+    # RetrievalQA dùng key "query"
+    # (mọi chain đều có thuộc tính memory, nên phân biệt theo kiểu chain)
+    if isinstance(qa_chain, ConversationalRetrievalChain):
+        inputs = {"question": question}
+        if chat_history is not None or qa_chain.memory is None:
+            # Lịch sử theo session: [(câu hỏi, câu trả lời)]
+            inputs["chat_history"] = chat_history or []
+        return inputs
+    # Không memory → RetrievalQA
+    return {"query": question}
+
+
+def _chain_response(result, usage):
+    """Chuẩn hóa kết quả của chain thành {'answer', 'sources', 'usage'}"""
+    _record_usage(usage)
+    return {
+        'answer': result['answer'] if 'answer' in result else result['result'],
+        'sources': [doc.metadata for doc in result['source_documents']],
+        'usage': usage
+    }
+
+
+def _error_response(error):
+    return {
+        'answer': f"Xin lỗi, có lỗi xảy ra: {str(error)}",
+        'sources': [],
+        'error': True
+    }
+
+
+def _invoke_chain(qa_chain, question, callbacks=None, chat_history=None):
+    """Gọi chain và chuẩn hóa kết quả thành {'answer', 'sources', 'usage'}"""
+    usage_handler = PromptUsageHandler()
+    config = {"callbacks": [*(callbacks or []), usage_handler]}
+    try:
+        result = qa_chain.invoke(_chain_inputs(qa_chain, question, chat_history), config=config)
+        return _chain_response(result, usage_handler.usage)
+    except Exception as e:
+        return _error_response(e)
+
+
+# ==================== ASYNC (asgi.py) ====================
+# Cùng logic với ask_question / stream_question nhưng await LLM và retrieval:
+# trong lúc chờ Claude / Pinecone, event loop phục vụ request khác.
+# Phần tốn CPU (embedding câu hỏi, cache ngữ nghĩa) chạy trong thread pool.
+
+async def _ainvoke_chain(qa_chain, question, callbacks=None, chat_history=None):
+    """Như _invoke_chain, dùng ainvoke"""
+    usage_handler = PromptUsageHandler()
+    config = {"callbacks": [*(callbacks or []), usage_handler]}
+    try:
+        result = await qa_chain.ainvoke(_chain_inputs(qa_chain, question, chat_history),
+                                        config=config)
+        return _chain_response(result, usage_handler.usage)
+    except Exception as e:
+        return _error_response(e)
+
+
+async def _alookup_caches(qa_chain, question, caches, session=None):
+    """_lookup_caches trong thread pool (cache ngữ nghĩa phải embedding câu hỏi)"""
+    if not caches:
+        return None
+    return await asyncio.to_thread(_lookup_caches, qa_chain, question, caches, session)
+
+
+async def aask_question(qa_chain, question, answer_cache=None, response_cache=None,
+                        session=None):
+    """
+    Phiên bản async của ask_question (dùng trong asgi.py)
+    
+    Args:
+        Như ask_question
+    
+    Returns:
+        response: Câu trả lời và source documents
+    """
+    async with session.async_lock if session is not None else nullcontext():
+        caches = _active_caches(qa_chain, answer_cache, response_cache, session)
+        cached = await _alookup_caches(qa_chain, question, caches, session)
+        if cached is not None:
+            return cached
+        
+        response = await _ainvoke_chain(qa_chain, question, chat_history=_history_input(session))
+        if not response.get('error'):
+            if session is not None:
+                # Session dùng chung (SQLite) ghi lượt mới xuống đĩa → không chạy trong event loop
+                await asyncio.to_thread(session.add, question, response['answer'])
+            if caches:
+                await asyncio.to_thread(_store_caches, caches, question, response)
+        return response
+
+
+async def astream_question(qa_chain, question, answer_cache=None, response_cache=None,
+                           session=None):
+    """
+    Phiên bản async của stream_question (dùng trong asgi.py)
+    
+    Yields:
+        event: Như stream_question
+    """
+    async with session.async_lock if session is not None else nullcontext():
+        caches = _active_caches(qa_chain, answer_cache, response_cache, session)
+        cached = await _alookup_caches(qa_chain, question, caches, session)
+        if cached is not None:
+            yield {'type': 'token', 'text': cached['answer']}
+            yield {'type': 'sources', 'sources': cached['sources'], 'cached': True}
+            return
+        
+        loop = asyncio.get_running_loop()
+        token_queue = asyncio.Queue()
+        # Callback đồng bộ có thể chạy trong thread khác → đẩy token về event loop
+        handler = _AnswerTokenHandler(
+            lambda token: loop.call_soon_threadsafe(token_queue.put_nowait, token)
+        )
+        task = asyncio.ensure_future(_ainvoke_chain(
+            qa_chain, question, callbacks=[handler], chat_history=_history_input(session)
+        ))
+        
+        streamed = False
+        try:
+            while not task.done() or not token_queue.empty():
+                getter = asyncio.ensure_future(token_queue.get())
+                await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    streamed = True
+                    yield {'type': 'token', 'text': getter.result()}
+                else:
+                    getter.cancel()
+            response = task.result()
+        finally:
+            # Client ngắt kết nối → dừng gọi Claude
+            task.cancel()
+        
+        if response.get('error'):
+            yield {'type': 'error', 'message': response['answer']}
+            return
+        if not streamed:
+            yield {'type': 'token', 'text': response['answer']}
+        if session is not None:
+            await asyncio.to_thread(session.add, question, response['answer'])
+        if caches:
+            await asyncio.to_thread(_store_caches, caches, question, response)
+        yield {'type': 'sources', 'sources': response['sources'], 'cached': False,
+               'usage': response['usage']}
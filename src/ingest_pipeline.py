@@ -0,0 +1,291 @@
+"""
+Pipeline ingestion dạng streaming: pages → chunks → embedding batches → upsert batches
+
+Mỗi giai đoạn chạy trong thread riêng, nối với nhau bằng queue có giới hạn:
+- Thread chính: đọc PDF + chia chunk (generator), gom thành embedding batch
+- Thread embedding: tính vector cho từng batch (PyTorch nhả GIL khi tính toán)
+- Thread upsert: gom vector thành upsert batch và gửi lên vector store qua một
+  pool request song song, tự retry (exponential backoff) khi lỗi tạm thời
+
+Bộ nhớ tối đa chỉ phụ thuộc vào kích thước batch và queue, không phụ thuộc
+kích thước corpus; embedding (CPU) chạy chồng lên upsert (network).
+"""
+
+import time
+import queue
+import asyncio
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from itertools import islice
+
+
+# Đánh dấu kết thúc stream trong queue
+_DONE = object()
+
+# HTTP status đáng retry (rate limit, quá tải, lỗi server tạm thời; 529 = Anthropic overloaded)
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504, 529}
+
+
+def batched(iterable, size):
+    """
+    Chia iterable thành các list có tối đa size phần tử
+
+    Yields:
+        batch: List phần tử
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _put(q, item, stop_event):
+    """Đưa item vào queue, dừng chờ nếu pipeline đã bị hủy"""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop_event):
+    """Lấy item từ queue, trả về _DONE nếu pipeline đã bị hủy"""
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def is_retryable(error):
+    """
+    Lỗi tạm thời (rate limit, 5xx, mất kết nối, timeout) → nên retry
+    """
+    status = getattr(error, "status", None) or getattr(error, "status_code", None)
+    if status is not None:
+        try:
+            return int(status) in RETRYABLE_STATUS
+        except (TypeError, ValueError):
+            return False
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # Lỗi mạng của urllib3 (client REST của Pinecone) và của client Anthropic
+    return type(error).__name__ in ("MaxRetryError", "ProtocolError", "ReadTimeoutError",
+                                    "NewConnectionError", "ConnectTimeoutError",
+                                    "APIConnectionError", "APITimeoutError")
+
+
+def retry_delay(error, attempt, base_delay=0.5, max_delay=30.0):
+    """
+    Thời gian chờ trước lần retry thứ attempt + 1: theo header Retry-After nếu
+    server gửi (429/529), ngược lại exponential backoff + jitter
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return min(max_delay, float(headers.get("retry-after")))
+    except (TypeError, ValueError):
+        return min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def call_with_retry(fn, *args, max_retries=5, base_delay=0.5, max_delay=30.0,
+                    on_retry=None, **kwargs):
+    """
+    Gọi fn, retry lỗi tạm thời với exponential backoff + jitter
+
+    Args:
+        fn: Hàm cần gọi
+        max_retries: Số lần retry tối đa (0 = không retry)
+        base_delay: Thời gian chờ lần retry đầu (giây), nhân đôi mỗi lần
+        max_delay: Thời gian chờ tối đa giữa hai lần
+        on_retry: Callback(attempt, error, delay) trước mỗi lần retry
+
+    Returns:
+        Kết quả của fn
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = retry_delay(e, attempt, base_delay, max_delay)
+            attempt += 1
+            if on_retry is not None:
+                on_retry(attempt, e, delay)
+            time.sleep(delay)
+
+
+async def acall_with_retry(fn, *args, max_retries=5, base_delay=0.5, max_delay=30.0,
+                           on_retry=None, **kwargs):
+    """
+    Như call_with_retry cho coroutine function (chờ bằng asyncio.sleep)
+    """
+    attempt = 0
+    while True:
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = retry_delay(e, attempt, base_delay, max_delay)
+            attempt += 1
+            if on_retry is not None:
+                on_retry(attempt, e, delay)
+            await asyncio.sleep(delay)
+
+
+def _chunk_metadata(chunk, text_key):
+    """
+    Metadata lưu kèm vector: text + mọi field khác của chunk (source, chunk_id,
+    page...), bỏ giá trị None vì Pinecone không nhận null
+    """
+    metadata = {
+        key: value for key, value in chunk.items()
+        if key not in ('id', 'text') and value is not None
+    }
+    metadata[text_key] = chunk['text']
+    return metadata
+
+
+def run_ingestion_pipeline(chunks, embeddings, upsert_fn, embed_batch_size=64,
+                           upsert_batch_size=100, queue_size=4, text_key="text",
+                           upsert_workers=4, max_retries=5):
+    """
+    Chạy pipeline chunks → embeddings → upsert với bộ nhớ giới hạn
+
+    Args:
+        chunks: Iterable (thường là generator) các dict
+            {'id', 'text', 'source', 'chunk_id', ...}
+        embeddings: Embedding model (có embed_documents)
+        upsert_fn: Hàm nhận list vector dạng
+            {'id', 'values', 'metadata'} và upsert lên vector store
+        embed_batch_size: Số chunk mỗi lần gọi embed_documents
+        upsert_batch_size: Số vector mỗi lần gọi upsert_fn
+        queue_size: Số batch tối đa chờ giữa hai giai đoạn
+        text_key: Key metadata chứa text (PineconeVectorStore mặc định "text")
+        upsert_workers: Số request upsert chạy song song
+        max_retries: Số lần retry mỗi batch khi gặp lỗi tạm thời
+
+    Returns:
+        stats: Dict {'chunks', 'upserted', 'retries', 'elapsed'}
+    """
+    embed_queue = queue.Queue(maxsize=queue_size)
+    upsert_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+    stats = {"chunks": 0, "upserted": 0, "retries": 0, "elapsed": 0.0}
+    stats_lock = threading.Lock()
+
+    def on_retry(attempt, error, delay):
+        if stop_event.is_set():
+            raise error  # Pipeline đã hủy → không chờ retry nữa
+        with stats_lock:
+            stats["retries"] += 1
+        print(f"⚠️  Upsert lỗi ({type(error).__name__}: {error}) → retry lần {attempt} "
+              f"sau {delay:.1f}s")
+
+    def upsert_batch(records):
+        if stop_event.is_set():
+            return
+        call_with_retry(upsert_fn, records, max_retries=max_retries, on_retry=on_retry)
+        with stats_lock:
+            stats["upserted"] += len(records)
+
+    def embed_worker():
+        try:
+            while True:
+                batch = _get(embed_queue, stop_event)
+                if batch is _DONE:
+                    break
+                vectors = embeddings.embed_documents([chunk['text'] for chunk in batch])
+                records = [
+                    {
+                        'id': chunk['id'],
+                        'values': list(vector),
+                        'metadata': _chunk_metadata(chunk, text_key)
+                    }
+                    for chunk, vector in zip(batch, vectors)
+                ]
+                if not _put(upsert_queue, records, stop_event):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+        finally:
+            _put(upsert_queue, _DONE, stop_event)
+
+    def upsert_worker():
+        # Giới hạn số batch đang chờ gửi → bộ nhớ vẫn bị chặn trên
+        max_in_flight = upsert_workers * 2
+        in_flight = set()
+
+        def collect(return_when):
+            done, _ = wait(in_flight, return_when=return_when)
+            for future in done:
+                in_flight.discard(future)
+                future.result()  # Ném lại lỗi không retry được
+
+        try:
+            with ThreadPoolExecutor(max_workers=upsert_workers,
+                                    thread_name_prefix="upsert") as executor:
+                try:
+                    pending = []
+                    while True:
+                        records = _get(upsert_queue, stop_event)
+                        if records is _DONE:
+                            break
+                        pending.extend(records)
+                        while len(pending) >= upsert_batch_size:
+                            if len(in_flight) >= max_in_flight:
+                                collect(FIRST_COMPLETED)
+                            in_flight.add(executor.submit(upsert_batch, pending[:upsert_batch_size]))
+                            pending = pending[upsert_batch_size:]
+                    if pending and not stop_event.is_set():
+                        in_flight.add(executor.submit(upsert_batch, pending))
+                    if in_flight:
+                        collect(ALL_COMPLETED)
+                except BaseException:
+                    stop_event.set()
+                    raise
+        except Exception as e:
+            errors.append(e)
+            stop_event.set()
+
+    start_time = time.perf_counter()
+    threads = [
+        threading.Thread(target=embed_worker, name="embed-worker", daemon=True),
+        threading.Thread(target=upsert_worker, name="upsert-worker", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for batch in batched(chunks, embed_batch_size):
+            stats["chunks"] += len(batch)
+            if not _put(embed_queue, batch, stop_event):
+                break
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        _put(embed_queue, _DONE, stop_event)
+        for thread in threads:
+            thread.join()
+        stats["elapsed"] = time.perf_counter() - start_time
+
+    if errors:
+        raise errors[0]
+
+    elapsed = stats["elapsed"]
+    rate = stats["upserted"] / elapsed if elapsed > 0 else 0
+    print(f"Pipeline: {stats['chunks']} chunks → {stats['upserted']} vectors "
+          f"trong {elapsed:.1f}s ({rate:.1f} vectors/giây, {upsert_workers} upsert song song, "
+          f"{stats['retries']} lần retry)")
+    return stats
@@ -0,0 +1,268 @@
+"""
+Keyword search BM25 cho tiếng Việt: inverted index build sẵn lúc upload, đọc lúc khởi động
+
+Tiếng Việt viết cách nhau theo âm tiết, một từ thường gồm nhiều âm tiết
+("nhiệt độ", "hạt nhân") → mỗi câu được tách thành âm tiết (bỏ hư từ) và cặp
+âm tiết liền nhau ("nhiệt_độ").
+
+Cấu trúc thư mục (mặc định .cache/keyword_index/<tên index>/):
+- records.jsonl: log chỉ ghi thêm, mỗi dòng {"id", "text", "metadata", "terms"}
+  (chunk mới/thay đổi, terms = số lần xuất hiện của từng term) hoặc
+  {"id", "deleted": true}; dòng sau ghi đè dòng trước cùng id. upload_to_pinecone.py
+  ghi từng chunk khi chunk đi qua pipeline → không giữ các chunk thay đổi trong RAM
+- bm25.npz: inverted index - danh sách term, với mỗi term là các chunk chứa nó
+  kèm điểm BM25 tính sẵn (build lại sau mỗi lần upload từ terms đã tách sẵn,
+  chỉ chunk mới phải tách từ; log được thu gọn khi build)
+
+Tìm kiếm chỉ cộng điểm trên posting list của các term trong câu hỏi rồi lấy
+top-k bằng argpartition → không chấm điểm / sắp xếp toàn bộ corpus.
+"""
+
+import os
+import re
+import json
+import threading
+import unicodedata
+from collections import Counter
+from contextlib import contextmanager
+import numpy as np
+from langchain_core.documents import Document
+
+from src.cache import CACHE_DIR
+from src.local_vector_store import top_k_indices
+
+
+# Hư từ xuất hiện ở hầu hết các câu, không giúp phân biệt tài liệu
+STOPWORDS = frozenset(
+    "là gì của và các những có được cho trong với một này đó thì như thế nào "
+    "khi nếu để do vì bị từ ra vào lên theo về tại sao hãy em tôi bạn ạ nhé "
+    "không cũng đã đang sẽ rất hay hoặc mà nên lại còn".split()
+)
+
+# Dấu câu ngắt cụm từ → không ghép cặp âm tiết qua ranh giới này
+PHRASE_BREAK_PATTERN = re.compile(r"[^\w\s]+")
+SYLLABLE_PATTERN = re.compile(r"\w+")
+
+
+def tokenize_vietnamese(text):
+    """
+    Tách text thành term: âm tiết (trừ hư từ) + cặp âm tiết liền nhau trong cùng cụm
+
+    Ví dụ: "Nhiệt độ là gì?" → ["nhiệt", "độ", "nhiệt_độ"]
+    """
+    text = unicodedata.normalize("NFC", text).lower()
+    terms = []
+    for phrase in PHRASE_BREAK_PATTERN.split(text):
+        syllables = SYLLABLE_PATTERN.findall(phrase)
+        terms.extend(s for s in syllables if s not in STOPWORDS)
+        terms.extend(
+            f"{a}_{b}" for a, b in zip(syllables, syllables[1:])
+            if a not in STOPWORDS and b not in STOPWORDS
+        )
+    return terms
+
+
+class BM25Index:
+    """
+    BM25 (Okapi) trên các chunk đã upload, cùng id với vector store
+    """
+
+    def __init__(self, name="studychatbot", directory=None, k1=1.5, b=0.75):
+        """
+        Args:
+            name: Tên index (tên thư mục con trong .cache/keyword_index)
+            directory: Thư mục lưu (ghi đè name)
+            k1: Độ bão hòa theo số lần xuất hiện của term
+            b: Mức chuẩn hóa theo độ dài chunk
+        """
+        self.directory = directory or os.path.join(CACHE_DIR, "keyword_index", name)
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._term_ids = {}
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._doc_ids = np.zeros(0, dtype=np.int32)
+        self._impacts = np.zeros(0, dtype=np.float32)
+        self._records = []
+
+    @property
+    def _records_path(self):
+        return os.path.join(self.directory, "records.jsonl")
+
+    @property
+    def _index_path(self):
+        return os.path.join(self.directory, "bm25.npz")
+
+    def __len__(self):
+        return len(self._records)
+
+    # ------------------------------------------------------------------
+    # Cập nhật chunk (upload_to_pinecone.py)
+    # ------------------------------------------------------------------
+
+    def _read_records(self):
+        """{id: record} còn hiệu lực (dòng sau ghi đè dòng trước, bỏ dòng ghi dở)"""
+        records = {}
+        if os.path.exists(self._records_path):
+            with open(self._records_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # Dòng ghi dở
+                    record = json.loads(line)
+                    if record.get("deleted"):
+                        records.pop(record["id"], None)
+                    else:
+                        records[record["id"]] = record
+        return records
+
+    def has_records(self):
+        return os.path.exists(self._records_path)
+
+    @contextmanager
+    def appender(self):
+        """
+        Mở records.jsonl để ghi thêm chunk lần lượt (chunk được tách từ ngay khi ghi)
+
+        Yields:
+            add: Hàm add(chunk), chunk = dict {'id', 'text', 'source', 'chunk_id', ...}
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(self._records_path, "a", encoding="utf-8") as f:
+            def add(chunk):
+                metadata = {key: value for key, value in chunk.items() if key not in ("id", "text")}
+                record = {"id": chunk["id"], "text": chunk["text"], "metadata": metadata,
+                          "terms": Counter(tokenize_vietnamese(chunk["text"]))}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            yield add
+
+    def upsert(self, chunks):
+        """
+        Thêm / ghi đè chunk
+
+        Args:
+            chunks: Iterable dict {'id', 'text', 'source', 'chunk_id', ...} (như iter_chunks)
+        """
+        with self.appender() as add:
+            for chunk in chunks:
+                add(chunk)
+
+    def delete(self, ids=None, delete_all=False):
+        """Xóa chunk theo id (ghi thêm dòng xóa), hoặc toàn bộ với delete_all=True"""
+        with self._lock:
+            if delete_all:
+                for path in (self._records_path, self._index_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return
+            if not ids:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._records_path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps({"id": chunk_id, "deleted": True}) + "\n"
+                                for chunk_id in ids))
+
+    def build(self):
+        """
+        Build inverted index từ records.jsonl, lưu bm25.npz và thu gọn records.jsonl
+
+        Returns:
+            num_docs: Số chunk trong index
+        """
+        with self._lock:
+            records = list(self._read_records().values())
+            counts = [record.get("terms") or Counter(tokenize_vietnamese(record["text"]))
+                      for record in records]
+            lengths = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+            avg_length = float(lengths.mean()) if len(lengths) else 0.0
+
+            postings = {}  # {term: [(doc, tf)]}
+            for doc, term_counts in enumerate(counts):
+                for term, tf in term_counts.items():
+                    postings.setdefault(term, []).append((doc, tf))
+
+            terms = sorted(postings)
+            offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+            doc_ids = np.empty(offsets[-1], dtype=np.int32)
+            impacts = np.empty(offsets[-1], dtype=np.float32)
+            num_docs = len(records)
+            for i, term in enumerate(terms):
+                docs, tfs = zip(*postings[term])
+                docs = np.array(docs, dtype=np.int32)
+                tfs = np.array(tfs, dtype=np.float32)
+                # Điểm BM25 của term trong từng chunk tính sẵn → lúc tìm chỉ cần cộng
+                idf = np.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lengths[docs] / max(avg_length, 1e-6))
+                doc_ids[offsets[i]:offsets[i + 1]] = docs
+                impacts[offsets[i]:offsets[i + 1]] = idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+            # Thu gọn log: mỗi chunk còn một dòng, bỏ các dòng xóa (ghi file tạm rồi rename)
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = self._records_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record, term_counts in zip(records, counts):
+                    f.write(json.dumps({**record, "terms": term_counts}, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self._records_path)
+
+            tmp_path = self._index_path + ".tmp.npz"
+            np.savez(tmp_path, terms=np.array(terms, dtype=str), offsets=offsets,
+                     doc_ids=doc_ids, impacts=impacts,
+                     ids=np.array([record["id"] for record in records], dtype=str))
+            os.replace(tmp_path, self._index_path)
+        return num_docs
+
+    # ------------------------------------------------------------------
+    # Tìm kiếm (app.py)
+    # ------------------------------------------------------------------
+
+    def load(self):
+        """
+        Đọc index đã build
+
+        Returns:
+            loaded: False nếu chưa có index hoặc index không khớp records.jsonl
+        """
+        if not os.path.exists(self._index_path):
+            return False
+        with self._lock:
+            records = self._read_records()
+            with np.load(self._index_path) as data:
+                ids = data["ids"].tolist()
+                if any(record_id not in records for record_id in ids):
+                    return False
+                self._term_ids = {term: i for i, term in enumerate(data["terms"].tolist())}
+                self._offsets = data["offsets"]
+                self._doc_ids = data["doc_ids"]
+                self._impacts = data["impacts"]
+            # Term đã nằm trong inverted index, không cần giữ trong RAM
+            self._records = [
+                {key: records[record_id][key] for key in ("id", "text", "metadata")}
+                for record_id in ids
+            ]
+        return True
+
+    def search(self, query, k=8):
+        """
+        Returns:
+            results: List (Document, điểm BM25), điểm giảm dần
+        """
+        query_terms = Counter(tokenize_vietnamese(query))
+        spans = [(self._offsets[i], self._offsets[i + 1], count)
+                 for i, count in ((self._term_ids.get(term), count)
+                                  for term, count in query_terms.items())
+                 if i is not None]
+        if not spans:
+            return []
+
+        # Chỉ các chunk có chứa ít nhất một term của câu hỏi được cộng điểm
+        doc_ids = np.concatenate([self._doc_ids[start:end] for start, end, _ in spans])
+        weights = np.concatenate([self._impacts[start:end] * count for start, end, count in spans])
+        candidates, inverse = np.unique(doc_ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        return [(self._to_document(int(candidates[i])), float(scores[i]))
+                for i in top_k_indices(scores, k)]
+
+    def _to_document(self, row):
+        record = self._records[row]
+        return Document(page_content=record["text"], metadata=dict(record["metadata"]),
+                        id=record["id"])
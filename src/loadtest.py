@@ -0,0 +1,153 @@
+"""
+Load test cho server chatbot (app.py hoặc asgi.py)
+
+Gửi câu hỏi trong src/evaluate.py tới server với nhiều client đồng thời, đo
+throughput, latency và time-to-first-token (endpoint stream).
+
+Mục tiêu (asgi.py, 4 worker): 100 client đồng thời, không lỗi, p95 latency
+không quá 1.5 lần p95 khi chỉ có 1 client (server không làm request phải xếp hàng,
+thời gian chủ yếu là thời gian chờ Claude).
+
+Chạy:
+    python -m src.loadtest --url http://localhost:5000 --concurrency 100 --requests 300
+    python -m src.loadtest --stream --unique   # Đo TTFT, bỏ qua cache câu trả lời
+"""
+
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import numpy as np
+import httpx
+
+from src.evaluate import TEST_CASES
+
+
+# Tỷ lệ p95 (tải cao) / p95 (1 client) tối đa để đạt mục tiêu
+TARGET_P95_RATIO = 1.5
+
+
+async def _ask(client, url, question, stream):
+    """
+    Gửi một câu hỏi
+
+    Returns:
+        (latency, ttft, ok): Thời gian tới khi xong, tới token đầu (giây), thành công?
+    """
+    payload = {"question": question, "session_id": uuid.uuid4().hex}
+    start = time.perf_counter()
+    if not stream:
+        response = await client.post(f"{url}/api/ask", json=payload)
+        ok = response.status_code == 200 and response.json().get("success", False)
+        latency = time.perf_counter() - start
+        return latency, latency, ok
+
+    ttft = None
+    ok = False
+    async with client.stream("POST", f"{url}/api/ask/stream", json=payload) as response:
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                if event == "token" and ttft is None:
+                    ttft = time.perf_counter() - start
+                elif event == "sources":
+                    ok = True
+                elif event == "error":
+                    print(f"  Lỗi: {json.loads(line[len('data: '):]).get('message')}")
+    latency = time.perf_counter() - start
+    return latency, ttft if ttft is not None else latency, ok
+
+
+async def run_load(url, concurrency, num_requests, stream=False, unique=False, timeout=120):
+    """
+    Chạy num_requests câu hỏi với tối đa concurrency request cùng lúc
+
+    Args:
+        url: Địa chỉ server
+        concurrency: Số client đồng thời
+        num_requests: Tổng số câu hỏi
+        stream: True = dùng /api/ask/stream (đo được TTFT)
+        unique: True = thêm số thứ tự vào câu hỏi để không trúng cache
+        timeout: Timeout mỗi request (giây)
+
+    Returns:
+        stats: Dict {'requests', 'errors', 'throughput', 'p50', 'p95', 'p99', 'ttft_p50', 'ttft_p95'}
+    """
+    questions = [test["question"] for test in TEST_CASES]
+    semaphore = asyncio.Semaphore(concurrency)
+    run_id = uuid.uuid4().hex[:6]
+    results = []
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        async def one(i):
+            question = questions[i % len(questions)]
+            if unique:
+                question = f"{question} ({run_id}-{i})"
+            async with semaphore:
+                try:
+                    results.append(await _ask(client, url, question, stream))
+                except httpx.HTTPError as e:
+                    print(f"  Lỗi kết nối: {type(e).__name__}: {e}")
+                    results.append((None, None, False))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(num_requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = np.array([r[0] for r in results if r[2]])
+    ttfts = np.array([r[1] for r in results if r[2]])
+    stats = {
+        "requests": num_requests,
+        "errors": sum(1 for r in results if not r[2]),
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+    }
+    for name, values in (("", latencies), ("ttft_", ttfts)):
+        for q in (50, 95, 99):
+            stats[f"{name}p{q}"] = float(np.percentile(values, q)) if len(values) else None
+    return stats
+
+
+def _print_stats(label, stats):
+    def ms(value):
+        return f"{value * 1000:.0f}ms" if value is not None else "-"
+    print(f"{label}: {stats['requests']} request, {stats['errors']} lỗi, "
+          f"{stats['throughput']:.2f} request/giây | latency p50 {ms(stats['p50'])}, "
+          f"p95 {ms(stats['p95'])}, p99 {ms(stats['p99'])} | "
+          f"TTFT p50 {ms(stats['ttft_p50'])}, p95 {ms(stats['ttft_p95'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test server chatbot")
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--baseline-requests", type=int, default=10,
+                        help="Số request đo với 1 client (0 = bỏ qua so sánh)")
+    parser.add_argument("--stream", action="store_true", help="Dùng /api/ask/stream")
+    parser.add_argument("--unique", action="store_true", help="Không dùng lại câu hỏi (tránh cache)")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline_requests:
+        baseline = asyncio.run(run_load(args.url, 1, args.baseline_requests,
+                                        args.stream, args.unique, args.timeout))
+        _print_stats("1 client", baseline)
+
+    loaded = asyncio.run(run_load(args.url, args.concurrency, args.requests,
+                                  args.stream, args.unique, args.timeout))
+    _print_stats(f"{args.concurrency} client", loaded)
+
+    if baseline is not None and baseline["p95"] and loaded["p95"]:
+        ratio = loaded["p95"] / baseline["p95"]
+        passed = loaded["errors"] == 0 and ratio <= TARGET_P95_RATIO
+        print(f"p95 tải cao / p95 1 client = {ratio:.2f} (mục tiêu ≤ {TARGET_P95_RATIO}, "
+              f"không lỗi) → {'ĐẠT' if passed else 'CHƯA ĐẠT'}")
+
+
+if __name__ == "__main__":
+    main()
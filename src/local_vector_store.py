@@ -0,0 +1,568 @@
+"""
+Vector store chạy local: vector chuẩn hóa trong file memory-mapped + text/metadata đi kèm
+
+Dùng thay Pinecone khi muốn chạy offline hoặc bỏ round trip mạng ở mỗi câu hỏi.
+Cấu trúc thư mục (mặc định .cache/vector_store/<tên index>/):
+- vectors.float16 (hoặc .float32): ma trận N x dim đã chuẩn hóa L2, đọc bằng np.memmap
+- records.jsonl: dòng thứ i = {"id", "metadata"} của hàng thứ i trong ma trận
+- meta.json: dim, dtype, generation
+- ann.npz (tùy chọn): index IVF / IVF-PQ, xem src/ann_index.py
+
+Mỗi lần thu gọn ghi ra bộ file thế hệ mới (vectors.<n>.float16, records.<n>.jsonl,
+ann.<n>.npz) rồi đổi generation trong meta.json; file thế hệ cũ chỉ bị xóa khi
+không còn câu hỏi nào đang đọc (Windows không cho xóa/ghi đè file đang được map).
+
+Cùng interface với PineconeVectorStore ở những chỗ project dùng: as_retriever
+(similarity / mmr) trong create_chatbot và upsert/delete theo id trong
+upload_to_pinecone.py.
+"""
+
+import os
+import copy
+import json
+import uuid
+import threading
+from contextlib import contextmanager
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+from src.cache import CACHE_DIR
+from src.ann_index import IVFIndex
+
+
+# Số hàng nhân ma trận mỗi lần khi quét (giới hạn bộ nhớ tạm khi đổi float16 → float32)
+SCAN_BLOCK_ROWS = 65536
+
+
+def normalize_rows(matrix):
+    """Chuẩn hóa L2 từng hàng (cosine = tích vô hướng)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def top_k_indices(scores, k):
+    """
+    Chỉ số của k điểm cao nhất, sắp xếp giảm dần (bỏ qua -inf)
+
+    Dùng argpartition: O(N) thay vì sort toàn bộ O(N log N)
+    """
+    k = min(k, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def mmr_select(query_vector, candidates, k, lambda_mult=0.5, query_scores=None):
+    """
+    Chọn k vector theo Maximal Marginal Relevance (vector hóa bằng NumPy)
+
+    Ma trận tương đồng giữa các candidate tính một lần; mỗi bước chỉ cập nhật
+    độ tương đồng lớn nhất với tập đã chọn bằng np.maximum.
+
+    Args:
+        query_vector: Vector câu hỏi đã chuẩn hóa (dim,)
+        candidates: Ma trận candidate đã chuẩn hóa (n, dim)
+        k: Số kết quả cần chọn
+        lambda_mult: 1 = chỉ relevance, 0 = chỉ diversity
+        query_scores: Cosine candidate-câu hỏi nếu đã có sẵn
+
+    Returns:
+        selected: List chỉ số candidate theo thứ tự chọn
+    """
+    n = len(candidates)
+    if n == 0 or k <= 0:
+        return []
+    candidates = np.asarray(candidates, dtype=np.float32)
+    if query_scores is None:
+        query_scores = candidates @ np.asarray(query_vector, dtype=np.float32)
+    query_scores = np.asarray(query_scores, dtype=np.float32)
+
+    pairwise = candidates @ candidates.T
+    first = int(np.argmax(query_scores))
+    selected = [first]
+    max_similarity = pairwise[first].copy()
+    available = np.ones(n, dtype=bool)
+    available[first] = False
+
+    for _ in range(min(k, n) - 1):
+        mmr_scores = lambda_mult * query_scores - (1 - lambda_mult) * max_similarity
+        mmr_scores[~available] = -np.inf
+        best = int(np.argmax(mmr_scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, pairwise[best], out=max_similarity)
+    return selected
+
+
+def _matches(metadata, filter):
+    """Kiểm tra metadata có khớp filter kiểu Pinecone ($eq, $ne, $in, $nin) không"""
+    for key, condition in filter.items():
+        value = metadata.get(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, expected in condition.items():
+            if op == "$eq" and value != expected:
+                return False
+            if op == "$ne" and value == expected:
+                return False
+            if op == "$in" and value not in expected:
+                return False
+            if op == "$nin" and value in expected:
+                return False
+    return True
+
+
+class _Snapshot:
+    """Trạng thái store tại một thời điểm, dùng cho một lần tìm kiếm"""
+
+    __slots__ = ("matrix", "alive", "ids", "metadatas", "ann")
+
+    def __init__(self, matrix, alive, ids, metadatas, ann):
+        self.matrix = matrix
+        self.alive = alive
+        self.ids = ids
+        self.metadatas = metadatas
+        self.ann = ann
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Vector store local dựa trên file memory-mapped, tìm kiếm brute-force bằng NumPy
+
+    - Cosine top-k: một phép nhân ma trận + argpartition (hoặc index IVF nếu đã build)
+    - MMR: mmr_select trên fetch_k candidate lấy thẳng từ memmap
+    - upsert/delete theo id giống Pinecone index → dùng được trong pipeline ingestion
+
+    Tìm kiếm chỉ giữ _lock để lấy snapshot (ma trận, cờ sống, id/metadata, ANN
+    index) rồi tính ngoài lock: ghi không sửa tại chỗ các mảng đã công bố mà tạo
+    mảng / ANN index / file thế hệ mới rồi gán lại → các câu hỏi không chờ nhau hay
+    chờ upsert / thu gọn.
+    """
+
+    def __init__(self, embedding, name="studychatbot", directory=None, dtype="float16",
+                 text_key="text", nprobe=8, refine=4):
+        """
+        Args:
+            embedding: Embedding model (dùng embed_query khi tìm kiếm)
+            name: Tên index (tên thư mục con trong .cache/vector_store)
+            directory: Thư mục lưu (ghi đè name)
+            dtype: "float16" (nửa dung lượng) hoặc "float32" cho index mới
+            text_key: Key metadata chứa text của chunk
+            nprobe: Số cụm IVF quét mỗi câu hỏi (chỉ dùng khi đã build ANN index)
+            refine: Hệ số candidate xếp hạng lại chính xác với IVF-PQ
+        """
+        self._embedding = embedding
+        self.directory = directory or os.path.join(CACHE_DIR, "vector_store", name)
+        self.text_key = text_key
+        self.nprobe = nprobe
+        self.refine = refine
+        self._lock = threading.Lock()
+        self._readers = {}  # {generation: số snapshot đang đọc}
+        self._retired = set()  # Thế hệ cũ chờ xóa file
+        self._load(dtype)
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    # ------------------------------------------------------------------
+    # Lưu trữ
+    # ------------------------------------------------------------------
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.directory, "meta.json")
+
+    def _generation_paths(self, generation):
+        """
+        (vectors, records, ann) của một thế hệ (thế hệ 0 giữ tên file cũ)
+        """
+        tag = f".{generation}" if generation else ""
+        return (os.path.join(self.directory, f"vectors{tag}.{self.dtype.name}"),
+                os.path.join(self.directory, f"records{tag}.jsonl"),
+                os.path.join(self.directory, f"ann{tag}.npz"))
+
+    @property
+    def _vectors_path(self):
+        return self._generation_paths(self._generation)[0]
+
+    @property
+    def _records_path(self):
+        return self._generation_paths(self._generation)[1]
+
+    @property
+    def _ann_path(self):
+        return self._generation_paths(self._generation)[2]
+
+    def _load(self, dtype):
+        """Đọc index từ đĩa (cắt bỏ phần ghi dở nếu lần trước bị ngắt)"""
+        self.dim = None
+        self.dtype = np.dtype(dtype)
+        self._generation = 0
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+            self._generation = meta.get("generation", 0)
+
+        self._ids = []
+        self._metadatas = []
+        self._row_of = {}
+        self._alive = np.zeros(0, dtype=bool)
+        self._vectors = None
+
+        records = []
+        if os.path.exists(self._records_path):
+            with open(self._records_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # Dòng ghi dở
+                    records.append(json.loads(line))
+
+        num_rows = 0
+        if self.dim and os.path.exists(self._vectors_path):
+            row_bytes = self.dim * self.dtype.itemsize
+            num_rows = min(os.path.getsize(self._vectors_path) // row_bytes, len(records))
+            if os.path.getsize(self._vectors_path) != num_rows * row_bytes:
+                with open(self._vectors_path, "r+b") as f:
+                    f.truncate(num_rows * row_bytes)
+        if len(records) != num_rows:
+            records = records[:num_rows]
+            self._rewrite_records(records)
+
+        self._append_rows(records)
+
+        self._ann = None
+        if os.path.exists(self._ann_path):
+            ann = IVFIndex.load(self._ann_path)
+            if ann.num_rows <= len(self._ids) and ann.centroids.shape[1] == self.dim:
+                self._ann = ann
+
+    def _append_rows(self, records):
+        """Cập nhật id/metadata trong bộ nhớ; id trùng → hàng cũ bị đánh dấu xóa"""
+        start = len(self._ids)
+        # Mảng mới: snapshot đang được tìm kiếm vẫn giữ mảng cũ
+        alive = np.concatenate([self._alive, np.ones(len(records), dtype=bool)])
+        for offset, record in enumerate(records):
+            old_row = self._row_of.get(record["id"])
+            if old_row is not None:
+                alive[old_row] = False
+            self._row_of[record["id"]] = start + offset
+            self._ids.append(record["id"])
+            self._metadatas.append(record["metadata"])
+        self._alive = alive
+
+    def _rewrite_records(self, records, path=None):
+        """Ghi lại toàn bộ records.jsonl (ghi file tạm rồi rename)"""
+        path = path or self._records_path
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+
+    def _write_meta(self):
+        """Ghi meta.json (file tạm rồi rename: đổi generation là bước chốt khi thu gọn)"""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "dtype": self.dtype.name,
+                       "generation": self._generation}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _retire(self, generation):
+        """Đánh dấu thế hệ cũ để xóa file (ngay, hoặc khi snapshot cuối nhả ra)"""
+        self._retired.add(generation)
+        self._remove_retired()
+
+    def _remove_retired(self):
+        """Xóa file của các thế hệ cũ không còn snapshot nào đọc (gọi khi giữ _lock)"""
+        for generation in list(self._retired):
+            if self._readers.get(generation):
+                continue
+            try:
+                for path in self._generation_paths(generation):
+                    if os.path.exists(path):
+                        os.remove(path)
+            except OSError:
+                continue  # Windows: memmap chưa được giải phóng hẳn → thử lại lần sau
+            self._retired.discard(generation)
+
+    def _matrix(self):
+        """Ma trận vector (memmap chỉ đọc, mở lại sau mỗi lần ghi)"""
+        if self._vectors is None:
+            if not self._ids:
+                return np.zeros((0, self.dim or 0), dtype=self.dtype)
+            self._vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode="r",
+                                      shape=(len(self._ids), self.dim))
+        return self._vectors
+
+    @contextmanager
+    def _snapshot(self):
+        """
+        Trạng thái để tìm kiếm ngoài lock (with self._snapshot() as snapshot)
+
+        Hàng chỉ được thêm vào cuối _ids/_metadatas (thu gọn thì tạo list mới) →
+        list giữ nguyên nghĩa với các hàng < len(matrix) của snapshot. File của thế
+        hệ đang đọc không bị xóa tới khi ra khỏi khối with.
+
+        Yields:
+            snapshot: _Snapshot
+        """
+        with self._lock:
+            snapshot = _Snapshot(self._matrix(), self._alive, self._ids, self._metadatas,
+                                 self._ann)
+            generation = self._generation
+            self._readers[generation] = self._readers.get(generation, 0) + 1
+        try:
+            yield snapshot
+        finally:
+            snapshot.matrix = None  # Nhả memmap trước khi xóa file
+            with self._lock:
+                self._readers[generation] -= 1
+                if self._retired:
+                    self._remove_retired()
+
+    @property
+    def vectors(self):
+        """Ma trận vector đã chuẩn hóa (memmap, gồm cả hàng đã bị ghi đè)"""
+        return self._matrix()
+
+    def __len__(self):
+        return int(self._alive.sum())
+
+    def upsert(self, vectors, **kwargs):
+        """
+        Thêm/ghi đè vector theo id (cùng định dạng với Pinecone index.upsert)
+
+        Args:
+            vectors: List dict {'id', 'values', 'metadata'}
+
+        Returns:
+            Dict {'upserted_count'}
+        """
+        if not vectors:
+            return {"upserted_count": 0}
+        matrix = normalize_rows([v['values'] for v in vectors])
+        records = [{"id": v['id'], "metadata": v.get('metadata', {})} for v in vectors]
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._write_meta()
+            elif matrix.shape[1] != self.dim:
+                raise ValueError(f"Vector {matrix.shape[1]} chiều, index cần {self.dim} chiều")
+
+            # Đóng memmap trước khi ghi thêm (Windows không cho ghi file đang map)
+            self._vectors = None
+            with open(self._vectors_path, "ab") as f:
+                f.write(matrix.astype(self.dtype).tobytes())
+            with open(self._records_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._append_rows(records)
+        return {"upserted_count": len(vectors)}
+
+    def delete(self, ids=None, delete_all=False, **kwargs):
+        """
+        Xóa vector theo id (hoặc toàn bộ với delete_all=True), rồi thu gọn file
+        """
+        with self._lock:
+            if delete_all:
+                # Bỏ dim → index mới có thể đổi model; sang thế hệ mới (file cũ có thể đang được đọc)
+                self._vectors = None
+                old_generation = self._generation
+                self.dim = None
+                self._generation += 1
+                self._write_meta()
+                self._retire(old_generation)
+                self._load(self.dtype)
+                return True
+            alive = self._alive.copy()
+            for vector_id in ids or []:
+                row = self._row_of.pop(vector_id, None)
+                if row is not None:
+                    alive[row] = False
+            self._alive = alive
+            self._compact()
+        return True
+
+    def _compact(self):
+        """
+        Ghi các hàng còn sống sang bộ file thế hệ mới rồi chuyển sang dùng thế hệ đó
+
+        Snapshot đang tìm kiếm vẫn đọc file thế hệ cũ; file cũ bị xóa khi được nhả ra.
+        """
+        if not self._ids:
+            return
+        keep = np.flatnonzero(self._alive)
+        matrix = self._matrix()
+        old_generation = self._generation
+        vectors_path, records_path, ann_path = self._generation_paths(old_generation + 1)
+        with open(vectors_path, "wb") as f:
+            for start in range(0, len(keep), SCAN_BLOCK_ROWS):
+                f.write(np.ascontiguousarray(matrix[keep[start:start + SCAN_BLOCK_ROWS]]).tobytes())
+        self._vectors = None
+        del matrix
+        self._rewrite_records(
+            [{"id": self._ids[row], "metadata": self._metadatas[row]} for row in keep],
+            path=records_path
+        )
+        if self._ann is not None:
+            # Giữ ANN index: chỉ đổi chỉ số hàng, không cần train lại
+            new_row_of = np.full(len(self._ids), -1, dtype=np.int64)
+            new_row_of[keep] = np.arange(len(keep))
+            ann = copy.copy(self._ann)
+            ann.remap(new_row_of)
+            ann.save(ann_path)
+
+        self._generation = old_generation + 1
+        self._write_meta()
+        self._retire(old_generation)
+        self._load(self.dtype)
+
+    def build_ann_index(self, index_type="ivf", retrain=False, **kwargs):
+        """
+        Build (hoặc cập nhật) ANN index và lưu xuống đĩa
+
+        Hàng mới từ lần build trước chỉ được gán vào cụm có sẵn; train lại
+        k-means khi retrain=True, đổi loại index, hoặc số hàng mới vượt số hàng
+        đã được index (phân bố cụm đã lệch nhiều).
+
+        Args:
+            index_type: "flat" (xóa ANN index, quét toàn bộ), "ivf" hoặc "ivfpq"
+            retrain: True = luôn train lại từ đầu
+            **kwargs: Tham số cho IVFIndex.build (nlist, pq_m, iters...)
+        """
+        with self._lock:
+            if index_type == "flat" or not self._ids:
+                self._ann = None
+                if os.path.exists(self._ann_path):
+                    os.remove(self._ann_path)
+                return None
+
+            matrix = self._matrix()
+            ann = self._ann
+            if (retrain or ann is None or ann.index_type != index_type
+                    or len(self._ids) - ann.num_rows > ann.num_rows):
+                print(f"Đang train ANN index {index_type} trên {len(self._ids)} vectors...")
+                ann = IVFIndex.build(matrix, index_type=index_type, **kwargs)
+            else:
+                ann = copy.copy(ann)  # Snapshot đang tìm kiếm vẫn dùng bản cũ
+                ann.extend(matrix)
+            ann.save(self._ann_path)
+            self._ann = ann
+            print(f"ANN index {index_type}: {ann.nlist} cụm, {ann.num_rows} vectors")
+            return ann
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [uuid.uuid4().hex for _ in texts]
+        vectors = self._embedding.embed_documents(texts)
+        self.upsert([
+            {'id': vector_id, 'values': vector, 'metadata': {**metadata, self.text_key: text}}
+            for vector_id, vector, metadata, text in zip(ids, vectors, metadatas, texts)
+        ])
+        return ids
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, **kwargs):
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+    # ------------------------------------------------------------------
+    # Tìm kiếm
+    # ------------------------------------------------------------------
+
+    def _embed_query(self, query):
+        return normalize_rows(self._embedding.embed_query(query))
+
+    def _search_rows(self, snapshot, query_vector, k, filter=None):
+        """
+        Top-k hàng theo cosine (giảm dần): qua ANN index nếu có, ngược lại quét toàn bộ
+
+        Filter luôn quét toàn bộ; hàng thêm sau lần build ANN được quét riêng.
+
+        Returns:
+            (rows, scores)
+        """
+        matrix, alive, ann = snapshot.matrix, snapshot.alive, snapshot.ann
+        if ann is None or filter:
+            scores = self._scores(snapshot, query_vector, filter)
+            rows = top_k_indices(scores, k)
+            return rows, scores[rows]
+
+        rows, scores = ann.search(query_vector, matrix, k,
+                                  nprobe=self.nprobe, refine=self.refine)
+        if ann.num_rows < len(matrix):
+            tail = matrix[ann.num_rows:].astype(np.float32) @ query_vector
+            rows = np.concatenate([rows, np.arange(ann.num_rows, len(matrix))])
+            scores = np.concatenate([scores, tail])
+        scores[~alive[rows]] = -np.inf
+        top = top_k_indices(scores, k)
+        return rows[top], scores[top]
+
+    def _scores(self, snapshot, query_vector, filter=None):
+        """Cosine của câu hỏi với mọi hàng (-inf cho hàng đã xóa / không khớp filter)"""
+        matrix, alive, metadatas = snapshot.matrix, snapshot.alive, snapshot.metadatas
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        scores = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), SCAN_BLOCK_ROWS):
+            block = matrix[start:start + SCAN_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query_vector
+
+        mask = alive[:len(matrix)].copy()
+        if filter:
+            mask &= np.fromiter((_matches(metadatas[row], filter) for row in range(len(matrix))),
+                                dtype=bool, count=len(matrix))
+        scores[~mask] = -np.inf
+        return scores
+
+    def _to_document(self, snapshot, row):
+        metadata = dict(snapshot.metadatas[row])
+        text = metadata.pop(self.text_key, "")
+        return Document(page_content=text, metadata=metadata, id=snapshot.ids[row])
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        query_vector = normalize_rows(embedding)
+        with self._snapshot() as snapshot:
+            rows, scores = self._search_rows(snapshot, query_vector, k, filter)
+        return [(self._to_document(snapshot, row), float(score))
+                for row, score in zip(rows, scores)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_with_score_by_vector(
+            self._embed_query(query), k=k, filter=filter
+        )
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        # Điểm đã là cosine similarity
+        return lambda score: score
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20,
+                                                lambda_mult=0.5, filter=None, **kwargs):
+        query_vector = normalize_rows(embedding)
+        with self._snapshot() as snapshot:
+            rows, scores = self._search_rows(snapshot, query_vector, fetch_k, filter)
+            candidates = snapshot.matrix[rows].astype(np.float32)
+        selected = mmr_select(query_vector, candidates, k, lambda_mult, query_scores=scores)
+        return [self._to_document(snapshot, rows[i]) for i in selected]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5,
+                                      filter=None, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(
+            self._embed_query(query), k=k, fetch_k=fetch_k,
+            lambda_mult=lambda_mult, filter=filter
+        )
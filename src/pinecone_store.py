@@ -0,0 +1,176 @@
+"""
+PineconeVectorStore với MMR nhanh: không tải vector từ Pinecone mỗi câu hỏi
+
+PineconeVectorStore gốc query fetch_k kết quả kèm include_values=True (30 x 768
+số float dạng JSON mỗi câu hỏi) rồi chạy MMR bằng vòng lặp Python. Ở đây:
+- Query chỉ lấy id + score + metadata (text cần để tạo Document)
+- Vector candidate lấy từ cache embedding local (CachedEmbeddings, key = text
+  chunk - đã có sẵn sau khi chạy upload_to_pinecone.py trên cùng máy)
+- Vector chưa có trong cache: fetch theo id từ Pinecone, giữ trong LRU của process
+  (không ghi vào cache embedding trên đĩa - file đó chỉ upload_to_pinecone.py ghi,
+  các worker của asgi.py ghi cùng lúc sẽ làm lệch index/vector)
+- MMR: mmr_select (một phép nhân ma trận + cập nhật vector hóa)
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.documents import Document
+from langchain_pinecone import PineconeVectorStore
+
+from src.local_vector_store import mmr_select, normalize_rows
+
+
+# Số vector fetch từ Pinecone giữ trong RAM mỗi process (theo id)
+FETCHED_CACHE_SIZE = 4096
+
+
+class CachedVectorPineconeStore(PineconeVectorStore):
+    """
+    PineconeVectorStore dùng vector candidate từ cache local cho MMR
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._fetched = OrderedDict()  # LRU {id: vector} đã fetch từ Pinecone
+        self._fetched_lock = threading.Lock()
+
+    def _cached_vectors(self, ids, texts):
+        """
+        Vector candidate có sẵn: trong cache embedding (chỉ đọc), rồi trong LRU
+
+        Returns:
+            (vectors, found): ma trận vector (hoặc None), mask đã có
+        """
+        if hasattr(self.embeddings, "get_cached"):
+            vectors, found = self.embeddings.get_cached(texts)
+        else:
+            vectors, found = None, np.zeros(len(texts), dtype=bool)
+
+        fetched = self._fetched
+        with self._fetched_lock:
+            for i in np.flatnonzero(~found):
+                vector = fetched.get(ids[i])
+                if vector is None:
+                    continue
+                fetched.move_to_end(ids[i])
+                if vectors is None or vectors.shape[1] == 0:
+                    vectors = np.zeros((len(ids), len(vector)), dtype=np.float32)
+                vectors[i] = vector
+                found[i] = True
+        return vectors, found
+
+    def _merge_fetched(self, vectors, ids, missing, fetched):
+        """
+        Ghép vector vừa fetch từ Pinecone vào ma trận candidate và LRU
+
+        Returns:
+            (vectors, keep): keep = mask candidate có vector (id bị xóa giữa lúc
+                query và fetch - upload incremental - không có trong kết quả fetch)
+        """
+        keep = np.ones(len(ids), dtype=bool)
+        keep[[i for i in missing if ids[i] not in fetched]] = False
+        present = [i for i in missing if ids[i] in fetched]
+        if not present:
+            return vectors, keep
+        missing_vectors = np.asarray([fetched[ids[i]].values for i in present],
+                                     dtype=np.float32)
+        if vectors is None or vectors.shape[1] == 0:
+            vectors = np.zeros((len(ids), missing_vectors.shape[1]), dtype=np.float32)
+        vectors[present] = missing_vectors
+
+        with self._fetched_lock:
+            for i, vector in zip(present, missing_vectors):
+                self._fetched[ids[i]] = vector
+                self._fetched.move_to_end(ids[i])
+            while len(self._fetched) > FETCHED_CACHE_SIZE:
+                self._fetched.popitem(last=False)
+        return vectors, keep
+
+    def _candidate_vectors(self, ids, texts, namespace):
+        """
+        Vector của các candidate: từ cache embedding / LRU, thiếu thì fetch từ Pinecone
+
+        Returns:
+            (vectors, keep): Ma trận float32 (len(ids), dim), mask candidate có vector
+        """
+        vectors, found = self._cached_vectors(ids, texts)
+        missing = np.flatnonzero(~found)
+        if len(missing):
+            fetched = self.index.fetch(ids=[ids[i] for i in missing], namespace=namespace).vectors
+            return self._merge_fetched(vectors, ids, missing, fetched)
+        return vectors, np.ones(len(ids), dtype=bool)
+
+    def _select(self, embedding, matches, vectors, k, lambda_mult, keep=None):
+        """Chạy MMR trên các match (bỏ match không có vector, xem keep) và tạo Document"""
+        if keep is not None and not keep.all():
+            if not keep.any():
+                return []
+            matches = [m for m, kept in zip(matches, keep) if kept]
+            vectors = vectors[keep]
+        ids = [m["id"] for m in matches]
+        selected = mmr_select(
+            normalize_rows(embedding), normalize_rows(vectors), k, lambda_mult,
+            query_scores=np.array([m["score"] for m in matches], dtype=np.float32)
+        )
+
+        documents = []
+        for i in selected:
+            metadata = dict(matches[i]["metadata"])
+            text = metadata.pop(self._text_key)
+            documents.append(Document(id=ids[i], page_content=text, metadata=metadata))
+        return documents
+
+    def _query_kwargs(self, embedding, fetch_k, namespace, filter):
+        return dict(
+            vector=list(embedding),
+            top_k=fetch_k,
+            include_values=False,
+            include_metadata=True,
+            namespace=namespace,
+            filter=filter,
+        )
+
+    def _text_matches(self, results):
+        return [m for m in results["matches"] if self._text_key in (m["metadata"] or {})]
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20,
+                                                lambda_mult=0.5, filter=None,
+                                                namespace=None, **kwargs):
+        if namespace is None:
+            namespace = self._namespace
+        results = self.index.query(**self._query_kwargs(embedding, fetch_k, namespace, filter))
+        matches = self._text_matches(results)
+        if not matches:
+            return []
+
+        ids = [m["id"] for m in matches]
+        texts = [m["metadata"][self._text_key] for m in matches]
+        vectors, keep = self._candidate_vectors(ids, texts, namespace)
+        return self._select(embedding, matches, vectors, k, lambda_mult, keep)
+
+    async def amax_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20,
+                                                       lambda_mult=0.5, filter=None,
+                                                       namespace=None, **kwargs):
+        """
+        Như bản đồng bộ, dùng client async của Pinecone (giữ kết nối nếu store
+        đã được mở bằng `async with` / __aenter__, xem asgi.py)
+        """
+        if namespace is None:
+            namespace = self._namespace
+        async with self._async_index_context() as idx:
+            results = await idx.query(**self._query_kwargs(embedding, fetch_k, namespace, filter))
+            matches = self._text_matches(results)
+            if not matches:
+                return []
+
+            ids = [m["id"] for m in matches]
+            texts = [m["metadata"][self._text_key] for m in matches]
+            vectors, found = self._cached_vectors(ids, texts)
+            keep = None
+            missing = np.flatnonzero(~found)
+            if len(missing):
+                fetched = (await idx.fetch(ids=[ids[i] for i in missing],
+                                           namespace=namespace)).vectors
+                vectors, keep = self._merge_fetched(vectors, ids, missing, fetched)
+        return self._select(embedding, matches, vectors, k, lambda_mult, keep)
@@ -2,7 +2,10 @@
 Prompt templates cho chatbot học tập
 """
 
-prompt_template = """
+# Phần cố định (vai trò, kiến thức cơ bản, quy tắc): gửi làm system block có
+# cache_control → Claude cache lại, các câu hỏi sau chỉ tính phí đọc cache
+# (không có biến; ngoặc nhọn viết {{ }} như template, dùng system_prompt.format())
+system_prompt = """
 Bạn là trợ lý học tập VẬT LÝ 12, hỗ trợ sinh viên học 4 chương: Vật lý nhiệt, Khí lý tưởng, Từ trường, và Vật lý hạt nhân.
 
 KIẾN THỨC CƠ BẢN VẬT LÝ (luôn biết):
@@ -87,8 +90,10 @@ QUY TẮC TRẢ LỜI:
    - Vector dùng: $\\vec{{F}}$, $\\vec{{E}}$, $\\vec{{B}}$ (KHÔNG dùng mũi tên Unicode)
    - Greek letters: $\\alpha$, $\\beta$, $\\gamma$, $\\Delta$, $\\Omega$
 7. Nếu học sinh hỏi "Giải thích thêm", "Ví dụ cụ thể" → Sử dụng lịch sử hội thoại để hiểu context
+"""
 
-NGỮ CẢNH TỪ TÀI LIỆU HỌC TẬP VẬT LÝ 12:
+# Phần thay đổi theo từng câu hỏi
+question_prompt = """NGỮ CẢNH TỪ TÀI LIỆU HỌC TẬP VẬT LÝ 12:
 {context}
 
 CÂU HỎI CỦA HỌC SINH:
@@ -97,6 +102,9 @@ CÂU HỎI CỦA HỌC SINH:
 TRẢ LỜI (ưu tiên ngữ cảnh, bổ sung kiến thức cơ bản nếu cần):
 """
 
+# Prompt đầy đủ dạng một khối (chain không dùng system prompt)
+prompt_template = system_prompt + "\n" + question_prompt
+
 welcome_message = """
 Xin chào! Tôi là trợ lý học tập Vật Lý 12 của bạn.
 
@@ -0,0 +1,168 @@
+"""
+Lịch sử hội thoại theo từng phiên (session) của người dùng
+
+Mỗi session giữ tối đa `window` lượt hỏi-đáp gần nhất → prompt không phình ra theo
+số request; session không hoạt động bị xóa theo TTL / LRU → bộ nhớ không tăng
+theo số người dùng. Chain dùng chung (không có memory), lịch sử được truyền vào
+qua input "chat_history" ở mỗi lần gọi.
+
+Chạy nhiều worker process (asgi.py): đặt path → lịch sử ghi vào SQLite dùng chung,
+request của một session tới worker nào cũng thấy cùng lịch sử.
+"""
+
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+
+
+class ChatSession:
+    """
+    Lịch sử hội thoại của một session
+
+    Request đồng thời trong cùng session được xếp hàng qua `lock` (thread)
+    hoặc `async_lock` (event loop của asgi.py) - câu hỏi sau cần câu trả lời
+    của câu trước làm ngữ cảnh.
+    """
+
+    def __init__(self, session_id, window=4, max_answer_chars=1500, on_add=None):
+        """
+        Args:
+            session_id: Id session do client gửi lên
+            window: Số lượt hỏi-đáp gần nhất được giữ lại
+            max_answer_chars: Độ dài tối đa của câu trả lời lưu trong lịch sử
+            on_add: Callback(session_id, question, answer) sau mỗi lượt (ghi xuống SQLite)
+        """
+        self.session_id = session_id
+        self.max_answer_chars = max_answer_chars
+        self.on_add = on_add
+        self.history = deque(maxlen=window)  # [(câu hỏi, câu trả lời)]
+        self.lock = threading.Lock()
+        self.async_lock = asyncio.Lock()
+        self.last_used = time.time()
+
+    def add(self, question, answer):
+        """Ghi một lượt hỏi-đáp (câu trả lời dài bị cắt bớt)"""
+        if len(answer) > self.max_answer_chars:
+            answer = answer[:self.max_answer_chars] + " ..."
+        self.history.append((question, answer))
+        if self.on_add is not None:
+            self.on_add(self.session_id, question, answer)
+
+    def chat_history(self):
+        """List (câu hỏi, câu trả lời) - định dạng chat_history của ConversationalRetrievalChain"""
+        return list(self.history)
+
+    def clear(self):
+        self.history.clear()
+
+
+class SessionStore:
+    """
+    Kho session giới hạn số lượng (LRU) và thời gian không hoạt động (TTL)
+    """
+
+    def __init__(self, max_sessions=1000, ttl=30 * 60, window=4, max_answer_chars=1500,
+                 path=None):
+        """
+        Args:
+            max_sessions: Số session tối đa giữ trong RAM
+            ttl: Session không hoạt động quá ttl giây sẽ bị xóa
+            window: Số lượt hỏi-đáp giữ trong mỗi session
+            max_answer_chars: Độ dài tối đa câu trả lời lưu trong lịch sử
+            path: File SQLite dùng chung giữa các worker process (None = chỉ trong RAM)
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.window = window
+        self.max_answer_chars = max_answer_chars
+        self.path = path
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # {session_id: ChatSession}, cũ nhất ở đầu
+        self._conn = None
+        self.evictions = 0
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_turns (session_id TEXT NOT NULL, "
+                "question TEXT NOT NULL, answer TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS session_turns_id ON session_turns (session_id, created)"
+            )
+            self._conn.commit()
+
+    def _evict(self):
+        deadline = time.time() - self.ttl
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_used >= deadline and len(self._sessions) <= self.max_sessions:
+                break
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM session_turns WHERE created < ?", (deadline,))
+            self._conn.commit()
+
+    def _load_history(self, session):
+        """Đọc window lượt gần nhất từ SQLite (worker khác có thể vừa ghi thêm)"""
+        rows = self._conn.execute(
+            "SELECT question, answer FROM session_turns WHERE session_id = ? "
+            "ORDER BY created DESC LIMIT ?",
+            (session.session_id, self.window)
+        ).fetchall()
+        session.history.clear()
+        session.history.extend(reversed(rows))
+
+    def _save_turn(self, session_id, question, answer):
+        with self._lock:
+            self._conn.execute("INSERT INTO session_turns VALUES (?, ?, ?, ?)",
+                               (session_id, question, answer, time.time()))
+            self._conn.commit()
+
+    def get(self, session_id):
+        """
+        Lấy session (tạo mới nếu chưa có hoặc đã hết hạn)
+
+        Returns:
+            session: ChatSession, hoặc None nếu session_id rỗng
+        """
+        if not session_id:
+            return None
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(
+                    session_id, window=self.window, max_answer_chars=self.max_answer_chars,
+                    on_add=self._save_turn if self._conn is not None else None
+                )
+                self._sessions[session_id] = session
+            session.last_used = time.time()
+            self._sessions.move_to_end(session_id)
+            self._evict()
+            if self._conn is not None:
+                self._load_history(session)
+            return session
+
+    def reset(self, session_id):
+        """Xóa lịch sử của một session"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM session_turns WHERE session_id = ?", (session_id,))
+                self._conn.commit()
+        if session is not None:
+            session.clear()
+
+    def stats(self):
+        """
+        Returns:
+            stats: Dict {"sessions", "evictions"}
+        """
+        with self._lock:
+            self._evict()
+            return {"sessions": len(self._sessions), "evictions": self.evictions}
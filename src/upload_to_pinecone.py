@@ -1,10 +1,16 @@
 """
 Script để upload dữ liệu từ PDF lên Pinecone
 Chạy script này để đẩy toàn bộ PDF lên Pinecone index
+(hoặc vào local vector store khi VECTOR_BACKEND=local)
+
+Mặc định chạy incremental: chỉ embed + upsert chunk mới/thay đổi và xóa vector
+của chunk đã bị xóa, dựa trên manifest lưu hash của từng file và từng chunk.
 """
 
 import os
 import sys
+import json
+import time
 from dotenv import load_dotenv
 from pinecone import Pinecone, ServerlessSpec
 
@@ -12,15 +18,44 @@ from pinecone import Pinecone, ServerlessSpec
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from src.helper import (
-    load_all_pdfs,
-    split_text_into_chunks,
-    create_embeddings
+    iter_pdf_documents,
+    iter_chunks,
+    create_embeddings,
+    get_embedding_tokenizer,
+    print_token_histogram,
+    make_vector_id,
+    hash_text,
+    hash_file,
+    index_manifest_path,
+    open_keyword_index,
+    VECTOR_BACKEND,
+    VECTOR_INDEX
 )
+from src.local_vector_store import LocalVectorStore
+from src.ingest_pipeline import run_ingestion_pipeline, batched, call_with_retry
 
 # Load environment variables
 load_dotenv()
 
 INDEX_NAME = "studychatbot"
+NUM_WORKERS = os.cpu_count()  # Số process đọc PDF song song
+# Chỉ hình nhúng trong trang được gửi cho Claude Vision (bỏ qua trang chỉ có text)
+# và mô tả được cache → bật vision mặc định không còn tốn kém
+EXTRACT_IMAGES = True
+EMBED_BATCH_SIZE = 256  # Số chunk mỗi lần embed (được xếp theo độ dài token bên trong)
+UPSERT_BATCH_SIZE = 100  # Số vector mỗi request upsert
+UPSERT_WORKERS = 4  # Số request upsert song song
+UPSERT_MAX_RETRIES = 5  # Retry (exponential backoff) khi lỗi tạm thời: 429, 5xx, mất mạng
+# Host data plane của index (vd. Pinecone Local: http://localhost:5081) → bỏ qua bước
+# tạo/xóa index qua API quản lý, dùng để chạy thử với index server local
+PINECONE_HOST = os.getenv("PINECONE_HOST")
+# Kích thước chunk tính theo token của embedding model
+CHUNK_SIZE = None  # None = max_seq_length của model (trừ 2 token đặc biệt)
+CHUNK_OVERLAP = 50
+DATA_DIR = "data"
+# Manifest lưu hash file/chunk đã upload → dùng cho chế độ incremental
+# (app.py theo dõi file này để xóa cache câu trả lời khi index được build lại)
+MANIFEST_PATH = index_manifest_path(INDEX_NAME)
 
 def delete_and_create_index(use_phobert=True):
     """Xóa index cũ và tạo mới với dimension phù hợp"""
@@ -42,7 +77,6 @@ def delete_and_create_index(use_phobert=True):
         pc.delete_index(INDEX_NAME)
         print("✅ Đã xóa index cũ!")
         
-        import time
         print("⏳ Đợi 10 giây...")
         time.sleep(10)
     
@@ -65,68 +99,250 @@ def delete_and_create_index(use_phobert=True):
     
     print("✅ Đã tạo index mới!")
     print("⏳ Đợi index sẵn sàng (20 giây)...")
-    import time
     time.sleep(20)
     
     return True
 
-def upload_data_to_pinecone(use_phobert=True):
-    """Upload dữ liệu từ PDF lên Pinecone"""
+def create_index_if_missing(use_phobert=True):
+    """Tạo index nếu chưa có (KHÔNG xóa dữ liệu cũ)"""
+    api_key = os.getenv("PINECONE_API_KEY")
+    if not api_key:
+        print("❌ Không tìm thấy PINECONE_API_KEY trong file .env!")
+        return False
+    
+    pc = Pinecone(api_key=api_key)
+    existing_indexes = [index.name for index in pc.list_indexes()]
+    
+    if INDEX_NAME in existing_indexes:
+        print(f"✅ Dùng lại index có sẵn: {INDEX_NAME}")
+        return True
+    
+    return delete_and_create_index(use_phobert)
+
+
+def open_index():
+    """Mở Pinecone index (theo PINECONE_HOST nếu có, ngược lại theo tên)"""
+    pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY") or "pclocal")
+    if PINECONE_HOST:
+        return pc.Index(host=PINECONE_HOST)
+    return pc.Index(INDEX_NAME)
+
+
+def load_manifest():
+    """Đọc manifest của lần upload trước (trả về manifest rỗng nếu chưa có)"""
+    if os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {"index_name": INDEX_NAME, "embedding_model": None, "files": {}}
+
+
+def save_manifest(manifest):
+    """Ghi manifest (ghi file tạm rồi rename để không hỏng khi bị ngắt giữa chừng)"""
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def upload_data_to_pinecone(use_phobert=True, incremental=True):
+    """
+    Upload dữ liệu từ PDF lên Pinecone
+    
+    Args:
+        use_phobert: True = PhoBERT (768D), False = Multilingual MiniLM (384D)
+        incremental: True = chỉ upload phần thay đổi so với manifest,
+            False = xóa index và upload lại toàn bộ
+    """
     print("\n" + "=" * 60)
     print("🚀 BẮT ĐẦU UPLOAD DỮ LIỆU LÊN PINECONE")
     print("=" * 60)
     
     model_name = "🇻🇳 PhoBERT" if use_phobert else "🌍 Multilingual MiniLM"
     print(f"📊 Embedding Model: {model_name}")
+    print(f"🗄️  Vector store: {VECTOR_BACKEND}")
+    print(f"🔁 Chế độ: {'Incremental' if incremental else 'Full rebuild'}")
     
-    # Step 1: Delete and create index
-    if not delete_and_create_index(use_phobert):
-        return
+    # Step 1: Create embeddings (cần biết model thật sự được dùng để so với manifest)
+    print("\n🧠 BƯỚC 1: Tạo embeddings")
+    embeddings = create_embeddings(use_phobert=use_phobert)
+    embedding_model = getattr(embeddings, "model_name", model_name)
+    tokenizer, max_seq_length = get_embedding_tokenizer(embeddings)
+    chunking = {
+        "unit": "token",
+        "chunk_size": CHUNK_SIZE or max_seq_length - 2,
+        "chunk_overlap": CHUNK_OVERLAP
+    }
+    print(f"✅ Embeddings đã sẵn sàng (chunk {chunking['chunk_size']} token, "
+          f"overlap {CHUNK_OVERLAP})")
     
-    # Step 2: Load PDFs
-    print("\n📚 BƯỚC 1: Đọc file PDF từ thư mục data/")
-    documents = load_all_pdfs("data", extract_images=False)  # Tắt vision để tiết kiệm
+    # Step 2: Chuẩn bị index
+    manifest = load_manifest()
+    if incremental and manifest["embedding_model"] != embedding_model:
+        if manifest["files"]:
+            print(f"⚠️  Embedding model đã đổi ({manifest['embedding_model']} → "
+                  f"{embedding_model}) → chuyển sang full rebuild")
+        incremental = False
+    elif incremental and manifest.get("chunking") != chunking:
+        if manifest["files"]:
+            print("⚠️  Cấu hình chia chunk đã đổi → chuyển sang full rebuild")
+        incremental = False
     
-    if not documents:
-        print("❌ Không tìm thấy file PDF nào!")
-        return
+    # BM25 keyword index (hybrid search) cập nhật cùng các chunk với vector store
+    keyword_index = open_keyword_index(INDEX_NAME)
+    if incremental and manifest["files"] and not keyword_index.has_records():
+        print("⚠️  Chưa có BM25 keyword index → chuyển sang full rebuild")
+        incremental = False
+    if not incremental:
+        keyword_index.delete(delete_all=True)
     
-    print(f"✅ Đã đọc {len(documents)} file PDF")
+    if VECTOR_BACKEND == "local":
+        if not incremental:
+            LocalVectorStore(embeddings, name=INDEX_NAME).delete(delete_all=True)
+    elif PINECONE_HOST:
+        print(f"🔌 Dùng index tại {PINECONE_HOST}")
+        if not incremental:
+            try:
+                open_index().delete(delete_all=True, namespace="")
+            except Exception as e:
+                # Namespace chưa tồn tại (index trống) cũng báo lỗi
+                print(f"   (Bỏ qua khi xóa dữ liệu cũ: {e})")
+    elif incremental:
+        if not create_index_if_missing(use_phobert):
+            return
+    else:
+        if not delete_and_create_index(use_phobert):
+            return
+    if not incremental:
+        manifest = {"index_name": INDEX_NAME, "embedding_model": embedding_model,
+                    "chunking": chunking, "files": {}}
+        save_manifest(manifest)
+    
+    # Step 3: So sánh file với manifest
+    print(f"\n🔍 BƯỚC 2: Kiểm tra thay đổi trong thư mục {DATA_DIR}/")
+    if not os.path.exists(DATA_DIR):
+        print(f"❌ Thư mục {DATA_DIR} không tồn tại!")
+        return
     
-    # Step 3: Split into chunks
-    print("\n✂️  BƯỚC 2: Chia text thành chunks")
-    chunks = split_text_into_chunks(documents, chunk_size=1000, chunk_overlap=200)
-    print(f"✅ Đã tạo {len(chunks)} chunks")
+    file_hashes = {
+        f: hash_file(os.path.join(DATA_DIR, f))
+        for f in sorted(os.listdir(DATA_DIR)) if f.endswith('.pdf')
+    }
+    changed_files = [
+        f for f, file_hash in file_hashes.items()
+        if manifest["files"].get(f, {}).get("file_hash") != file_hash
+    ]
+    removed_files = [f for f in manifest["files"] if f not in file_hashes]
     
-    # Step 4: Create embeddings
-    print("\n🧠 BƯỚC 3: Tạo embeddings")
-    embeddings = create_embeddings(use_phobert=use_phobert)
-    print("✅ Embeddings đã sẵn sàng")
+    print(f"   Không đổi: {len(file_hashes) - len(changed_files)} | "
+          f"Mới/thay đổi: {len(changed_files)} | Đã xóa: {len(removed_files)}")
     
-    # Step 5: Upload to Pinecone
-    print("\n☁️  BƯỚC 4: Upload lên Pinecone (có thể mất vài phút...)")
+    if not changed_files and not removed_files:
+        if not keyword_index.load():
+            keyword_index.build()
+        print("✅ Index đã cập nhật, không có gì để upload!")
+        return
     
-    from langchain_pinecone import PineconeVectorStore
+    # Step 4: Pipeline streaming: đọc PDF → chunk → so sánh manifest → embed → upsert
+    print(f"\n📚 BƯỚC 3: Đọc {len(changed_files)} file PDF thay đổi, "
+          "chia chunk, embed và upsert (streaming)")
     
-    texts = [chunk['text'] for chunk in chunks]
-    metadatas = [{'source': chunk['source'], 'chunk_id': chunk['chunk_id']} 
-                 for chunk in chunks]
+    new_entries = {}  # {source: {vector_id: chunk_hash}} của các file vừa đọc
+    counts = {"chunks": 0}
+    token_stats = []
     
-    print(f"📤 Đang upload {len(texts)} chunks lên Pinecone...")
+    def changed_chunks():
+        """Yield các chunk mới/thay đổi so với manifest"""
+        documents = iter_pdf_documents(DATA_DIR, extract_images=EXTRACT_IMAGES,
+                                       num_workers=NUM_WORKERS, image_mode="figures",
+                                       files=changed_files)
+        # Chunk mới/thay đổi được ghi thêm vào BM25 index ngay khi đi qua
+        # (chạy lại sau khi bị ngắt: chunk được ghi lại, dòng sau ghi đè dòng trước)
+        with keyword_index.appender() as add_keyword_chunk:
+            for chunk in iter_chunks(documents, chunk_size=chunking["chunk_size"],
+                                     chunk_overlap=CHUNK_OVERLAP, tokenizer=tokenizer,
+                                     token_stats=token_stats):
+                counts["chunks"] += 1
+                vector_id = make_vector_id(chunk['source'], chunk['chunk_id'])
+                chunk_hash = hash_text(chunk['text'])
+                new_entries.setdefault(chunk['source'], {})[vector_id] = chunk_hash
+                
+                old_chunks = manifest["files"].get(chunk['source'], {}).get("chunks", {})
+                if old_chunks.get(vector_id) != chunk_hash:
+                    add_keyword_chunk({**chunk, 'id': vector_id})
+                    yield {**chunk, 'id': vector_id}
     
     try:
-        vector_store = PineconeVectorStore.from_texts(
-            texts=texts,
-            embedding=embeddings,
-            metadatas=metadatas,
-            index_name=INDEX_NAME,
-            namespace=""  # default namespace
+        if VECTOR_BACKEND == "local":
+            index = LocalVectorStore(embeddings, name=INDEX_NAME)
+        else:
+            index = open_index()
+        
+        stats = run_ingestion_pipeline(
+            changed_chunks(),
+            embeddings,
+            upsert_fn=lambda vectors: index.upsert(vectors=vectors, namespace=""),
+            embed_batch_size=EMBED_BATCH_SIZE,
+            upsert_batch_size=UPSERT_BATCH_SIZE,
+            # Local store ghi file tuần tự, không lợi gì khi upsert song song
+            upsert_workers=UPSERT_WORKERS if VECTOR_BACKEND == "pinecone" else 1,
+            max_retries=UPSERT_MAX_RETRIES
         )
+        if hasattr(embeddings, "stats"):
+            cache_stats = embeddings.stats()
+            print(f"🧠 Embedding cache: {cache_stats['hits']} hit, "
+                  f"{cache_stats['misses']} miss (encode mới)")
+        print_token_histogram(token_stats, max_tokens=max_seq_length - 2)
+        
+        # Vector của chunk/file đã bị xóa
+        stale_ids = []
+        for source in removed_files:
+            stale_ids.extend(manifest["files"][source]["chunks"])
+        # File thay đổi nhưng đọc lỗi / không còn text → không có trong new_entries:
+        # vẫn xóa vector cũ và ghi hash mới (không đọc lại ở mọi lần chạy sau)
+        empty_files = [source for source in changed_files if source not in new_entries]
+        if empty_files:
+            print(f"⚠️  {len(empty_files)} file không có chunk nào (đọc lỗi hoặc không có text): "
+                  f"{', '.join(empty_files)}")
+        for source in changed_files:
+            entries = new_entries.get(source, {})
+            old_chunks = manifest["files"].get(source, {}).get("chunks", {})
+            stale_ids.extend(vid for vid in old_chunks if vid not in entries)
+        
+        if stale_ids:
+            print(f"🗑️  Đang xóa {len(stale_ids)} vector cũ...")
+            if VECTOR_BACKEND == "local":
+                index.delete(ids=stale_ids)  # Thu gọn file một lần
+            else:
+                for ids in batched(stale_ids, 1000):
+                    call_with_retry(index.delete, ids=ids, namespace="",
+                                    max_retries=UPSERT_MAX_RETRIES)
+        
+        if VECTOR_BACKEND == "local":
+            # ANN index build lúc ingestion, lưu cạnh file vector
+            index.build_ann_index(VECTOR_INDEX, retrain=not incremental)
+        
+        # BM25 inverted index build lúc ingestion, app.py chỉ việc đọc file
+        keyword_index.delete(ids=stale_ids)
+        print(f"🔤 BM25 index: {keyword_index.build()} chunks")
+        
+        # Cập nhật manifest sau khi vector store đã cập nhật thành công
+        manifest["embedding_model"] = embedding_model
+        manifest["chunking"] = chunking
+        for source in removed_files:
+            del manifest["files"][source]
+        for source in changed_files:
+            manifest["files"][source] = {
+                "file_hash": file_hashes[source],
+                "chunks": new_entries.get(source, {})
+            }
+        save_manifest(manifest)
         
         print("\n" + "=" * 60)
         print("✅ ✅ ✅ HOÀN THÀNH! ✅ ✅ ✅")
         print("=" * 60)
-        print(f"📊 Đã upload {len(texts)} chunks vào index '{INDEX_NAME}'")
+        print(f"📊 {counts['chunks']} chunks trong file thay đổi → upsert "
+              f"{stats['upserted']}, xóa {len(stale_ids)} vector trong index '{INDEX_NAME}'")
         print("🎉 Bây giờ bạn có thể chạy app và hỏi câu hỏi!")
         print("=" * 60)
         
@@ -136,8 +352,16 @@ def upload_data_to_pinecone(use_phobert=True):
         traceback.print_exc()
 
 if __name__ == "__main__":
-    print("\n⚠️  CẢNH BÁO: Script này sẽ XÓA toàn bộ dữ liệu cũ trong Pinecone!")
-    print(f"⚠️  Index '{INDEX_NAME}' sẽ bị xóa và tạo lại từ đầu.")
+    print("\n🔁 Chọn chế độ upload:")
+    print("  1. Incremental - chỉ upload PDF/chunk mới hoặc thay đổi ✅")
+    print("  2. Full rebuild - XÓA toàn bộ index và upload lại từ đầu")
+    
+    mode_choice = input("\n❓ Chọn chế độ (1 hoặc 2, mặc định 1): ").strip()
+    incremental = mode_choice != '2'
+    
+    if not incremental:
+        print("\n⚠️  CẢNH BÁO: Chế độ này sẽ XÓA toàn bộ dữ liệu cũ trong Pinecone!")
+        print(f"⚠️  Index '{INDEX_NAME}' sẽ bị xóa và tạo lại từ đầu.")
     
     print("\n📊 Chọn Embedding Model:")
     print("  1. PhoBERT (768D) - Tối ưu tiếng Việt, chính xác cao ✅")
@@ -149,6 +373,6 @@ if __name__ == "__main__":
     response = input("\n❓ Bạn có chắc chắn muốn tiếp tục? (yes/no): ")
     
     if response.lower() in ['yes', 'y']:
-        upload_data_to_pinecone(use_phobert=use_phobert)
+        upload_data_to_pinecone(use_phobert=use_phobert, incremental=incremental)
     else:
         print("❌ Đã hủy!")
@@ -0,0 +1,150 @@
+"""
+Pipeline Claude Vision bất đồng bộ cho bước đọc PDF
+
+- Một AsyncAnthropic client dùng chung (pool kết nối) chạy trên event loop
+  trong thread riêng → load_pdf gửi ảnh đi rồi đọc tiếp text các trang sau,
+  mô tả được ghép lại theo thứ tự trang khi đọc xong
+- Giới hạn số request đồng thời (semaphore) và tốc độ gửi (token bucket)
+- Retry 429 / 529 (overloaded) / lỗi mạng theo Retry-After hoặc exponential backoff
+
+Mỗi process (process pool của iter_pdf_documents) có pipeline và giới hạn riêng.
+"""
+
+import os
+import time
+import asyncio
+import threading
+import anthropic
+
+from src.ingest_pipeline import acall_with_retry
+
+
+class TokenBucket:
+    """
+    Token bucket giới hạn tốc độ: trung bình `rate` request/giây, tối đa `capacity`
+    request liền nhau
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Chờ tới khi lấy được một token (lần lượt theo thứ tự gọi)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class VisionPipeline:
+    """
+    Gửi ảnh tới Claude Vision bất đồng bộ, trả về concurrent.futures.Future
+    dùng được từ code đồng bộ (load_pdf)
+    """
+
+    def __init__(self, model, concurrency=4, requests_per_minute=50, max_retries=5,
+                 max_tokens=500, max_pending=None, api_key=None):
+        """
+        Args:
+            model: Model Claude Vision
+            concurrency: Số request tối đa đang chờ Claude cùng lúc
+            requests_per_minute: Tốc độ gửi tối đa (token bucket)
+            max_retries: Số lần retry mỗi ảnh khi gặp 429/529/lỗi mạng
+            max_tokens: max_tokens của câu trả lời
+            max_pending: Số ảnh tối đa đã gửi vào pipeline mà chưa xong; submit()
+                chờ khi vượt quá (mặc định 4 * concurrency)
+            api_key: ANTHROPIC_API_KEY (mặc định: biến môi trường)
+        """
+        self.model = model
+        self.max_retries = max_retries
+        self.max_tokens = max_tokens
+        self.stats = {"requests": 0, "retries": 0, "errors": 0}
+        self._pid = os.getpid()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending = threading.BoundedSemaphore(max_pending or 4 * concurrency)
+        self._bucket = TokenBucket(requests_per_minute / 60.0, capacity=concurrency)
+        # Retry do pipeline tự xử lý (theo token bucket), client không retry thêm
+        self._client = anthropic.AsyncAnthropic(
+            api_key=api_key or os.getenv("ANTHROPIC_API_KEY"), max_retries=0
+        )
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name="vision-pipeline", daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self):
+        """False nếu pipeline được tạo ở process cha (thread không còn sau fork)"""
+        return self._pid == os.getpid() and self._thread.is_alive()
+
+    def _on_retry(self, attempt, error, delay):
+        self.stats["retries"] += 1
+        print(f"  Claude Vision lỗi ({type(error).__name__}) → retry lần {attempt} "
+              f"sau {delay:.1f}s")
+
+    async def _create_message(self, image_base64, prompt):
+        await self._bucket.acquire()
+        self.stats["requests"] += 1
+        message = await self._client.messages.create(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "image/png",
+                                "data": image_base64,
+                            },
+                        },
+                        {
+                            "type": "text",
+                            "text": prompt
+                        }
+                    ],
+                }
+            ],
+        )
+        return message.content[0].text
+
+    async def _analyze(self, image_base64, prompt):
+        async with self._semaphore:
+            try:
+                return await acall_with_retry(self._create_message, image_base64, prompt,
+                                              max_retries=self.max_retries,
+                                              on_retry=self._on_retry)
+            except Exception:
+                self.stats["errors"] += 1
+                raise
+
+    def submit(self, image_base64, prompt):
+        """
+        Gửi một ảnh (PNG base64) kèm prompt
+
+        Returns:
+            future: concurrent.futures.Future → mô tả (str), ném lỗi nếu thất bại
+        """
+        self._pending.acquire()
+        future = asyncio.run_coroutine_threadsafe(self._analyze(image_base64, prompt), self._loop)
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def close(self):
+        """Đóng client và dừng event loop"""
+        if not self.alive:
+            return
+        asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
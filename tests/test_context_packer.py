@@ -0,0 +1,25 @@
+"""
+Ghép chunk liền kề trong pack_documents: chỉ cắt phần chồng lấp thật (từ nguyên vẹn)
+"""
+
+from langchain_core.documents import Document
+
+from src.context_packer import overlap_length, pack_documents
+
+
+def _chunk(text, chunk_id):
+    return Document(page_content=text, metadata={"source": "a.pdf", "chunk_id": chunk_id})
+
+
+def test_partial_word_is_not_overlap():
+    assert overlap_length("abc def n", "nhân xyz") == 0
+    packed, stats = pack_documents([_chunk("abc def n", 0), _chunk("nhân xyz", 1)])
+    assert packed[0].page_content == "abc def n\nnhân xyz"
+    assert stats["tokens_saved"] >= 0
+
+
+def test_word_overlap_is_merged():
+    left, right = "một hai ba bốn năm", "ba bốn năm sáu bảy"
+    assert overlap_length(left, right) == len("ba bốn năm")
+    packed, _ = pack_documents([_chunk(left, 0), _chunk(right, 1)])
+    assert packed[0].page_content == "một hai ba bốn năm sáu bảy"
@@ -0,0 +1,39 @@
+"""
+CachedEmbeddings dùng chung thư mục cache giữa nhiều process
+"""
+
+import numpy as np
+
+from src.embeddings import CachedEmbeddings
+from src.fake_pinecone import HashEmbeddings
+
+
+def test_two_writers_keep_each_others_rows(tmp_path):
+    model = HashEmbeddings(dim=16)
+    # Hai instance = hai process (asgi.py, upload_to_pinecone.py) với index trong RAM riêng
+    first = CachedEmbeddings(model, "m", cache_dir=str(tmp_path))
+    second = CachedEmbeddings(model, "m", cache_dir=str(tmp_path))
+    first.embed_documents(["a", "b"])
+    second.embed_documents(["c"])  # second chưa biết a, b
+    first.embed_documents(["d"])
+
+    texts = ["a", "b", "c", "d"]
+    vectors, found = CachedEmbeddings(model, "m", cache_dir=str(tmp_path)).get_cached(texts)
+    assert found.all()
+    np.testing.assert_allclose(vectors, model.embed_documents(texts), atol=1e-2)
+
+
+def test_interrupted_append_is_skipped(tmp_path):
+    model = HashEmbeddings(dim=16)
+    cache = CachedEmbeddings(model, "m", cache_dir=str(tmp_path))
+    cache.embed_documents(["a"])
+    # Lần ghi bị ngắt: nửa dòng vector, dòng index chưa xuống dòng
+    with open(cache._vectors_path, "ab") as f:
+        f.write(b"\1" * 10)
+    with open(cache._index_path, "a", encoding="ascii") as f:
+        f.write("0" * 64)
+
+    CachedEmbeddings(model, "m", cache_dir=str(tmp_path)).embed_documents(["b"])
+    vectors, found = CachedEmbeddings(model, "m", cache_dir=str(tmp_path)).get_cached(["a", "b"])
+    assert found.all()
+    np.testing.assert_allclose(vectors, model.embed_documents(["a", "b"]), atol=1e-2)
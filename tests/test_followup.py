@@ -0,0 +1,37 @@
+"""
+Phân loại câu hỏi nối tiếp (is_self_contained): câu tự đủ nghĩa bỏ qua bước
+viết lại câu hỏi bằng LLM
+"""
+
+import pytest
+
+from src.helper import is_self_contained
+
+
+@pytest.mark.parametrize("question", [
+    "Chu kỳ bán rã là gì?",
+    "Định luật Ôm phát biểu như thế nào?",
+    "Tại sao bầu trời có màu xanh?",
+    "Cho ví dụ về chuyển động tròn đều",
+    "Số hạt nhân còn lại sau thời gian t tính thế nào?",
+    "Chúng ta đo nhiệt độ bằng dụng cụ gì?",
+    "Giải thích định luật bảo toàn năng lượng",
+])
+def test_standalone_questions(question):
+    assert is_self_contained(question)
+
+
+@pytest.mark.parametrize("question", [
+    "Nó là gì?",
+    "Nó được tính như thế nào?",
+    "Công thức này áp dụng khi nào?",
+    "Còn định luật Charles thì sao?",
+    "Tại sao?",
+    "Tại sao lại như vậy?",
+    "Cho ví dụ cụ thể",
+    "Cho thêm vài ví dụ nữa đi",
+    "Giải thích rõ hơn về điều đó",
+    "Chúng có khác nhau không?",
+])
+def test_followup_questions(question):
+    assert not is_self_contained(question)
@@ -0,0 +1,50 @@
+"""
+LocalVectorStore: thu gọn file trong lúc có câu hỏi đang đọc snapshot
+"""
+
+import os
+
+import numpy as np
+
+from src.fake_pinecone import HashEmbeddings
+from src.local_vector_store import LocalVectorStore
+
+
+def _store(tmp_path, num_vectors=20):
+    store = LocalVectorStore(HashEmbeddings(dim=8), directory=str(tmp_path))
+    rng = np.random.default_rng(0)
+    store.upsert([{"id": f"v{i}", "values": rng.normal(size=8), "metadata": {"text": f"t{i}"}}
+                  for i in range(num_vectors)])
+    return store
+
+
+def test_compact_while_snapshot_is_held(tmp_path):
+    store = _store(tmp_path)
+    old_paths = store._generation_paths(store._generation)
+    with store._snapshot() as snapshot:
+        expected = np.array(snapshot.matrix[:5])
+        store.delete(ids=["v0", "v1"])  # Thu gọn sang thế hệ mới
+
+        # Snapshot vẫn đọc được file cũ, file cũ chưa bị xóa / ghi đè
+        assert os.path.exists(old_paths[0])
+        np.testing.assert_array_equal(snapshot.matrix[:5], expected)
+        assert snapshot.ids[0] == "v0"
+        assert os.path.exists(store._vectors_path) and store._vectors_path != old_paths[0]
+
+    # Snapshot cuối được nhả → file thế hệ cũ bị xóa
+    assert not any(os.path.exists(path) for path in old_paths[:2])
+    assert len(store) == 18
+    assert {doc.id for doc in store.similarity_search("t5", k=20)} == {f"v{i}" for i in range(2, 20)}
+
+
+def test_reopen_after_compact(tmp_path):
+    store = _store(tmp_path)
+    store.delete(ids=["v3"])
+    store.delete(ids=["v4"])
+
+    reopened = LocalVectorStore(HashEmbeddings(dim=8), directory=str(tmp_path))
+    assert len(reopened) == 18
+    assert "v3" not in {doc.id for doc in reopened.similarity_search("t3", k=20)}
+
+    reopened.delete(delete_all=True)
+    assert len(LocalVectorStore(HashEmbeddings(dim=8), directory=str(tmp_path))) == 0
@@ -0,0 +1,65 @@
+"""
+CachedVectorPineconeStore với server giả lập (src/fake_pinecone.py)
+"""
+
+import asyncio
+
+import pytest
+from flask import request
+from pinecone import Pinecone
+
+from src.fake_pinecone import FakePineconeServer, HashEmbeddings
+from src.pinecone_store import CachedVectorPineconeStore
+
+
+@pytest.fixture
+def server():
+    server = FakePineconeServer()
+    deleted_ids = server.app.config["DELETE_BEFORE_FETCH"] = []
+
+    @server.app.before_request
+    def delete_before_fetch():
+        # Xóa vector ngay trước khi trả lời fetch (upload incremental chạy xen giữa query và fetch)
+        if request.path == "/vectors/fetch":
+            for vector_id in deleted_ids:
+                server.app.config["NAMESPACES"][""].pop(vector_id, None)
+
+    with server:
+        yield server
+
+
+def _store(server, num_vectors=30):
+    index = Pinecone(api_key="pclocal").Index(host=server.host)
+    embeddings = HashEmbeddings()
+    texts = [f"đoạn văn số {i}" for i in range(num_vectors)]
+    index.upsert(vectors=[
+        {"id": f"c{i}", "values": vector, "metadata": {"text": text}}
+        for i, (text, vector) in enumerate(zip(texts, embeddings.embed_documents(texts)))
+    ], namespace="")
+    return CachedVectorPineconeStore(index=index, embedding=embeddings, text_key="text")
+
+
+def _delete_before_fetch(server, ids):
+    server.app.config["DELETE_BEFORE_FETCH"].extend(ids)
+
+
+def test_mmr_skips_candidates_deleted_before_fetch(server):
+    store = _store(server)
+    _delete_before_fetch(server, ["c3", "c7"])
+    docs = store.max_marginal_relevance_search("đoạn văn số 3", k=5, fetch_k=30)
+    assert len(docs) == 5
+    assert not {"c3", "c7"} & {doc.id for doc in docs}
+
+
+def test_async_mmr_skips_candidates_deleted_before_fetch(server):
+    store = _store(server)
+    _delete_before_fetch(server, ["c3"])
+    docs = asyncio.run(store.amax_marginal_relevance_search("đoạn văn số 3", k=5, fetch_k=30))
+    assert len(docs) == 5
+    assert "c3" not in {doc.id for doc in docs}
+
+
+def test_mmr_returns_nothing_when_all_candidates_deleted(server):
+    store = _store(server, num_vectors=3)
+    _delete_before_fetch(server, ["c0", "c1", "c2"])
+    assert store.max_marginal_relevance_search("đoạn văn số 1", k=2, fetch_k=3) == []